@@ -0,0 +1,328 @@
+"""
+File: analytics_extract.py
+Purpose: Packing the star schema into one flat, columnar lunchbox for the notebooks.
+Author: Zulfia
+Date: January 2024
+
+# In a notebook: `SalesExtract('../data_management_etl/analytics_extract').run()` answers every business query without touching PostgreSQL.
+"""
+
+# External Libraries
+import json
+import logging
+import os
+import time
+import pandas as pd
+
+# Optional embedded SQL engine; the business queries fall back to pandas without it
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# Internal Libraries and Credentials
+from database_utils import DatabaseConnector, aws_credentials_file, local_credentials_file
+
+# Logging Configuration
+logging.basicConfig(level=logging.INFO)
+
+# Default Location
+analytics_extract_directory = 'analytics_extract'
+
+# Business queries of scripts_business_queries.sql, rewritten for the flat extract and named as in query_runner
+SALES_QUERIES = {
+    'task_1': """
+        SELECT country_code, COUNT(store_code) AS total_no_stores FROM stores
+        GROUP BY country_code ORDER BY total_no_stores DESC, country_code""",
+    'task_2': """
+        SELECT locality, COUNT(store_code) AS stores_total FROM stores
+        GROUP BY locality ORDER BY stores_total DESC, locality ASC LIMIT 7""",
+    'task_3': """
+        SELECT ROUND(SUM(total_sales), 2) AS total_sales, month FROM sales
+        WHERE month IS NOT NULL AND product_price IS NOT NULL
+        GROUP BY month ORDER BY total_sales DESC""",
+    'task_4': """
+        SELECT COUNT(product_code) AS number_of_sales, SUM(product_quantity) AS product_quantity_count,
+               CASE WHEN store_type = 'Web Portal' THEN 'Web' ELSE 'Offline' END AS location
+        FROM sales WHERE store_type IS NOT NULL AND product_price IS NOT NULL
+        GROUP BY location ORDER BY number_of_sales, product_quantity_count""",
+    'task_5': """
+        SELECT store_type, ROUND(SUM(total_sales), 2) AS total_sales,
+               ROUND(COUNT(date_uuid) * 100.0 / (SELECT COUNT(*) FROM sales), 2) AS "percentage_total(%)"
+        FROM sales GROUP BY store_type ORDER BY "percentage_total(%)" DESC, total_sales, store_type""",
+    'task_6': """
+        SELECT ROUND(SUM(total_sales), 2) AS total_sales, year, month FROM sales
+        GROUP BY year, month ORDER BY total_sales DESC, year, month""",
+    'task_6_2': """
+        SELECT SUM(staff_numbers) AS total_staff_number, country_code FROM stores
+        GROUP BY country_code ORDER BY total_staff_number DESC, country_code""",
+    'task_8': """
+        SELECT ROUND(SUM(total_sales), 2) AS total_sales, store_type, country_code FROM sales
+        WHERE country_code = 'DE'
+        GROUP BY store_type, country_code ORDER BY total_sales""",
+    'task_9': """
+        WITH time_lag AS (
+            SELECT year, epoch(ordered_at) - LAG(epoch(ordered_at)) OVER (ORDER BY ordered_at) AS time_difference
+            FROM sales WHERE ordered_at IS NOT NULL)
+        SELECT year, AVG(time_difference) AS average_seconds FROM time_lag
+        GROUP BY year ORDER BY average_seconds DESC""",
+}
+
+
+def read_sales_tables(db_connector):
+    """
+    Reads the fact and dimension columns the extract needs and joins them in pandas.
+    Keys are compared as text, so the join works before and after the schema script casts them to UUID.
+
+    Parameters:
+    ----------
+        - db_connector (DatabaseConnector): An instance of the DatabaseConnector class.
+
+    Returns:
+        - tuple: The denormalised sales DataFrame and the stores DataFrame.
+    """
+    engine = db_connector.local_data_engine
+    orders = pd.read_sql('SELECT date_uuid, user_uuid, store_code, product_code, product_quantity FROM orders_table', engine)
+    products = pd.read_sql('SELECT product_code, product_price, category FROM dim_products', engine)
+    stores = pd.read_sql('SELECT store_code, store_type, country_code, locality, staff_numbers FROM dim_store_details', engine)
+    dates = pd.read_sql('SELECT date_uuid, year, month, day, "timestamp", time_period FROM dim_date_times', engine)
+
+    for df, key in ((orders, 'date_uuid'), (orders, 'user_uuid'), (dates, 'date_uuid')):
+        df[key] = df[key].astype(str)
+
+    # Prices are text with a pound sign until the schema script has converted them
+    products['product_price'] = pd.to_numeric(products['product_price'].astype(str).str.replace('£', '', regex=False), errors='coerce')
+    stores['staff_numbers'] = pd.to_numeric(stores['staff_numbers'], errors='coerce')
+    for column in ('year', 'month', 'day'):
+        dates[column] = pd.to_numeric(dates[column], errors='coerce').astype('Int64')
+
+    # Timestamp of every order, for the time between transactions
+    dates['ordered_at'] = (pd.to_datetime(pd.DataFrame({'year': dates['year'], 'month': dates['month'], 'day': dates['day']}), errors='coerce')
+                           + pd.to_timedelta(dates['timestamp'].astype(str), errors='coerce'))
+    dates['timestamp'] = dates['timestamp'].astype(str)
+
+    sales = (orders
+             .merge(products.drop_duplicates('product_code'), on='product_code', how='left')
+             .merge(stores.drop(columns='staff_numbers').drop_duplicates('store_code'), on='store_code', how='left')
+             .merge(dates.drop_duplicates('date_uuid'), on='date_uuid', how='left'))
+    sales['total_sales'] = sales['product_quantity'] * sales['product_price']
+    return sales, stores
+
+
+def publish_sales_extract(db_connector, output_directory=analytics_extract_directory):
+    """
+    Writes sales.parquet, stores.parquet and manifest.json for the notebooks.
+    Every file is written under a temporary name and renamed, so readers never see a half-written file.
+    The manifest is renamed last: once it lists a publishing time, the Parquet files are at least that recent.
+
+    Parameters:
+    ----------
+        - db_connector (DatabaseConnector): An instance of the DatabaseConnector class.
+        - output_directory (str): Folder receiving the extract.
+
+    Returns:
+        - dict: The manifest (row counts, table load versions and publishing time), or None if publishing failed.
+    """
+    try:
+        start = time.perf_counter()
+        sales, stores = read_sales_tables(db_connector)
+        os.makedirs(output_directory, exist_ok=True)
+
+        for file_name, df in (('sales.parquet', sales), ('stores.parquet', stores)):
+            path = os.path.join(output_directory, file_name)
+            df.to_parquet(f'{path}.tmp', index=False)
+            os.replace(f'{path}.tmp', path)
+
+        manifest = {
+            'published_at': pd.Timestamp.now().isoformat(timespec='seconds'),
+            'rows': {'sales': len(sales), 'stores': len(stores)},
+            'load_versions': db_connector.read_load_versions(),
+        }
+        manifest_path = os.path.join(output_directory, 'manifest.json')
+        with open(f'{manifest_path}.tmp', 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        os.replace(f'{manifest_path}.tmp', manifest_path)
+
+        logging.info(f'sales extract published to {output_directory} in {time.perf_counter() - start:.2f}s ({len(sales)} rows)')
+        return manifest
+
+    except Exception as e:
+        logging.error(f'Error in analytics_extract method publish_sales_extract: {e}')
+        return None
+
+
+def format_time_between(seconds):
+    """ Formats average seconds between transactions like TO_CHAR in Task 9."""
+    if pd.isna(seconds):
+        return None
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f'"hours": {hours}, "minutes": {minutes}, "seconds": {seconds}, "milliseconds": {milliseconds}'
+
+
+# SalesExtract Class and Methods
+class SalesExtract:
+    """
+    Class for running the business queries against the published Parquet extract,
+    with DuckDB when it is installed and with pandas otherwise.
+
+    Attributes:
+    ----------
+        - directory (str): Folder holding sales.parquet and stores.parquet.
+        - engine (str): 'duckdb' or 'pandas'.
+        - timings (dict): Seconds taken by each query in the last run.
+
+    Methods:
+    --------
+        - __init__(self, directory, engine): Initialises the SalesExtract instance.
+        - def manifest(self): Returns the manifest written with the extract.
+        - def sql(self, query): Runs any SQL over the 'sales' and 'stores' views (DuckDB only).
+        - def run_query(self, name): Runs one business query.
+        - def run(self, names): Runs several business queries.
+    """
+
+    def __init__(self, directory=analytics_extract_directory, engine=None):
+        """
+        Initialises the SalesExtract instance.
+
+        Parameters:
+        ----------
+            - directory (str): Folder holding the extract.
+            - engine (str): 'duckdb' or 'pandas', defaults to DuckDB when it is installed.
+        """
+        self.directory = directory
+        self.engine = engine or ('duckdb' if duckdb is not None else 'pandas')
+        self.timings = {}
+        self.connection = None
+        self.frames = {}
+
+    def _path(self, table_name):
+        return os.path.join(self.directory, f'{table_name}.parquet')
+
+    def _duckdb(self):
+        """ Opens an in-memory DuckDB database with a view over each Parquet file, once."""
+        if self.connection is None:
+            self.connection = duckdb.connect()
+            for table_name in ('sales', 'stores'):
+                path = self._path(table_name).replace("'", "''")
+                self.connection.execute(f"CREATE VIEW {table_name} AS SELECT * FROM read_parquet('{path}')")
+        return self.connection
+
+    def _frame(self, table_name):
+        """ Reads a Parquet file into pandas, once."""
+        if table_name not in self.frames:
+            self.frames[table_name] = pd.read_parquet(self._path(table_name))
+        return self.frames[table_name]
+
+    def manifest(self):
+        """ Returns the manifest written with the extract: row counts, table load versions and publishing time."""
+        with open(os.path.join(self.directory, 'manifest.json'), 'r') as manifest_file:
+            return json.load(manifest_file)
+
+    def sql(self, query):
+        """
+        Runs any SQL over the 'sales' and 'stores' views.
+
+        Returns:
+            - pd.DataFrame: The query result.
+        """
+        if duckdb is None:
+            raise ImportError('ad hoc SQL over the sales extract requires duckdb')
+        return self._duckdb().execute(query).df()
+
+    def _pandas_query(self, name):
+        """ The business queries in pandas, for when DuckDB is not installed."""
+        sales, stores = self._frame('sales'), self._frame('stores')
+
+        def total(df, keys):
+            return df.groupby(keys, dropna=False)['total_sales'].sum().round(2).rename('total_sales').reset_index()
+
+        if name == 'task_1':
+            return stores.groupby('country_code', dropna=False)['store_code'].count().rename('total_no_stores').reset_index() \
+                .sort_values(['total_no_stores', 'country_code'], ascending=[False, True])
+        if name == 'task_2':
+            return stores.groupby('locality', dropna=False)['store_code'].count().rename('stores_total').reset_index() \
+                .sort_values(['stores_total', 'locality'], ascending=[False, True]).head(7)
+        if name == 'task_3':
+            matched = sales[sales['month'].notna() & sales['product_price'].notna()]
+            return total(matched, 'month').sort_values('total_sales', ascending=False)[['total_sales', 'month']]
+        if name == 'task_4':
+            matched = sales[sales['store_type'].notna() & sales['product_price'].notna()]
+            location = matched['store_type'].eq('Web Portal').map({True: 'Web', False: 'Offline'}).rename('location')
+            return matched.groupby(location).agg(number_of_sales=('product_code', 'count'), product_quantity_count=('product_quantity', 'sum')) \
+                .reset_index().sort_values(['number_of_sales', 'product_quantity_count'])[['number_of_sales', 'product_quantity_count', 'location']]
+        if name == 'task_5':
+            result = total(sales, 'store_type')
+            result['percentage_total(%)'] = (sales.groupby('store_type', dropna=False)['date_uuid'].count().to_numpy() * 100 / len(sales)).round(2)
+            return result.sort_values(['percentage_total(%)', 'total_sales', 'store_type'], ascending=[False, True, True])
+        if name == 'task_6':
+            return total(sales, ['year', 'month']).sort_values(['total_sales', 'year', 'month'], ascending=[False, True, True])[['total_sales', 'year', 'month']]
+        if name == 'task_6_2':
+            return stores.groupby('country_code', dropna=False)['staff_numbers'].sum().rename('total_staff_number').reset_index() \
+                .sort_values(['total_staff_number', 'country_code'], ascending=[False, True])[['total_staff_number', 'country_code']]
+        if name == 'task_8':
+            return total(sales[sales['country_code'] == 'DE'], ['store_type', 'country_code']) \
+                .sort_values('total_sales')[['total_sales', 'store_type', 'country_code']]
+        if name == 'task_9':
+            ordered = sales.loc[sales['ordered_at'].notna(), ['year', 'ordered_at']].sort_values('ordered_at', kind='stable')
+            ordered['time_difference'] = ordered['ordered_at'].diff().dt.total_seconds()
+            return ordered.groupby('year')['time_difference'].mean().rename('average_seconds').reset_index() \
+                .sort_values('average_seconds', ascending=False)
+        raise KeyError(name)
+
+    def run_query(self, name):
+        """
+        Runs one business query.
+
+        Parameters:
+        ----------
+            - name (str): A key of SALES_QUERIES, e.g. 'task_3'.
+
+        Returns:
+            - pd.DataFrame: The query result, or None if the query failed.
+        """
+        start = time.perf_counter()
+        try:
+            if self.engine == 'duckdb':
+                df = self.sql(SALES_QUERIES[name])
+            else:
+                df = self._pandas_query(name).reset_index(drop=True)
+
+            if name == 'task_9':
+                df['actual_time_taken'] = df['average_seconds'].map(format_time_between)
+
+            self.timings[name] = time.perf_counter() - start
+            return df
+
+        except Exception as e:
+            logging.error(f'Error in analytics_extract method run_query, {name}: {e}')
+            return None
+
+    def run(self, names=None):
+        """
+        Runs several business queries.
+
+        Parameters:
+        ----------
+            - names (list): Keys of SALES_QUERIES, defaults to all of them.
+
+        Returns:
+            - dict: Query names mapped to their result DataFrames.
+        """
+        self.timings = {}
+        return {name: self.run_query(name) for name in (names or SALES_QUERIES)}
+
+
+# Main Execution
+if __name__ == "__main__":
+    # Publish from the current database, then answer the business queries from the extract
+    db_connector = DatabaseConnector(aws_credentials_file, local_credentials_file)
+    publish_sales_extract(db_connector)
+
+    sales_extract = SalesExtract()
+    for name, df in sales_extract.run().items():
+        print(f'\n{name} ({sales_extract.timings.get(name, 0) * 1000:.1f} ms):\n{df}')
+
+# The script ends here
@@ -0,0 +1,322 @@
+"""
+File: cleaning_rules.py
+Purpose: Writing the cleaning recipes down once and cooking each column in a single pass.
+Author: Zulfia
+Date: January 2024
+
+# The rules reproduce the DataCleaning methods step by step; CleaningRuleEngine.compare checks they still agree.
+"""
+
+# External Libraries
+import contextlib
+import logging
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+# Logging Configuration
+logging.basicConfig(level=logging.INFO)
+
+
+# Cleaning rules per table, applied in order. Steps:
+#   ('drop_columns', [names])                 remove columns
+#   ('drop_first_column', None)               remove the first remaining column
+#   ('replace_all', mapping)                  replace values in every column
+#   ('transform', column, [operations])       replace a column with the result of its operations
+#   ('transform_in_place', column, [ops])     same, but an object column stays object, like df.loc[:, column] = ...
+#   ('require', column, predicate, argument)  keep only the rows satisfying a predicate on the column
+#   ('drop_missing_rows', 'any' or 'all')     drop rows with any or all values missing
+CLEANING_RULES = {
+    'users': [
+        ('drop_columns', ['index']),
+        ('replace_all', {'NULL': pd.NA}),
+        ('transform', 'date_of_birth', [('to_datetime', {'format': 'mixed', 'errors': 'coerce'})]),
+        ('transform', 'join_date', [('to_datetime', {'format': 'mixed', 'errors': 'coerce'})]),
+        ('drop_missing_rows', 'any'),
+        ('transform', 'country_code', [('replace', {'GGB': 'GB'})]),
+    ],
+    'cards': [
+        ('replace_all', {'NULL': pd.NA}),
+        ('drop_missing_rows', 'any'),
+        ('transform_in_place', 'card_number', [('astype', str)]),
+        ('require', 'card_number', 'no_letters', None),
+        ('transform', 'card_number', [('astype', str), ('lstrip', '?')]),
+    ],
+    'stores': [
+        ('drop_columns', ['index', 'lat']),
+        ('require', 'country_code', 'max_length', 3),
+        ('transform_in_place', 'opening_date', [('to_datetime', {'format': 'mixed', 'errors': 'coerce'})]),
+        ('transform_in_place', 'continent', [('replace', {'eeAmerica': 'America', 'eeEurope': 'Europe'})]),
+        ('transform_in_place', 'staff_numbers', [('remove_pattern', r'\D')]),
+    ],
+    'products': [
+        ('drop_first_column', None),
+        ('replace_all', {'NULL': pd.NA}),
+        ('drop_missing_rows', 'all'),
+        ('transform_in_place', 'product_price', [('strip', None)]),
+        ('require', 'product_price', 'max_length', 7),
+        ('transform', 'date_added', [('to_datetime', {'format': 'mixed', 'errors': 'coerce'})]),
+    ],
+    'orders': [
+        ('drop_columns', ['level_0', 'first_name', 'last_name', '1']),
+        ('drop_first_column', None),
+    ],
+    'dates': [
+        ('require', 'month', 'not_longer_than', 3),
+        ('transform_in_place', 'timestamp', [('to_datetime', {'format': '%H:%M:%S', 'errors': 'coerce'}), ('datetime_attribute', 'time')]),
+        ('transform_in_place', 'year', [('to_datetime', {'format': '%Y', 'errors': 'coerce'}), ('datetime_attribute', 'year')]),
+        ('transform_in_place', 'month', [('to_datetime', {'format': '%m', 'errors': 'coerce'}), ('datetime_attribute', 'month')]),
+    ],
+}
+
+def replace_values(series, mapping):
+    """ Replaces values in a Series; a single replacement uses the cheaper scalar form of Series.replace."""
+    if len(mapping) == 1:
+        (old_value, new_value), = mapping.items()
+        return series.replace(old_value, new_value)
+    return series.replace(mapping)
+
+
+# Element-wise column operations
+OPERATIONS = {
+    'replace': replace_values,
+    'to_datetime': lambda series, options: pd.to_datetime(series, **options),
+    'datetime_attribute': lambda series, attribute: getattr(series.dt, attribute),
+    'astype': lambda series, datatype: series.astype(datatype),
+    'strip': lambda series, _: series.str.strip(),
+    'lstrip': lambda series, characters: series.str.lstrip(characters),
+    'remove_pattern': lambda series, pattern: series.str.replace(pattern, '', regex=True),
+}
+
+# Row predicates returning a boolean Series
+PREDICATES = {
+    'not_missing': lambda series, _: series.notna(),
+    'no_letters': lambda series, _: ~series.str.contains(r'[a-zA-Z]'),
+    # Missing values have no length and are dropped
+    'max_length': lambda series, length: series.str.len() <= length,
+    # Missing values have no length and are kept
+    'not_longer_than': lambda series, length: ~(series.str.len() > length),
+}
+
+
+def copy_on_write():
+    """ Returns a context enabling pandas copy-on-write, or a no-op where it is not configurable (pandas 3 always copies on write)."""
+    try:
+        return pd.option_context('mode.copy_on_write', True)
+    except Exception:
+        return contextlib.nullcontext()
+
+
+# CleaningRuleEngine Class and Methods
+class CleaningRuleEngine:
+    """
+    Class for applying the declarative cleaning rules one column at a time.
+
+    Instead of a new DataFrame per step, the engine keeps one Series per column and a single array of surviving rows.
+    Row filters only shrink that array; a column is brought in line with it right before its next operation,
+    and the output DataFrame is assembled once at the end.
+
+    Attributes:
+    ----------
+        - rules (dict): Cleaning steps per table, see CLEANING_RULES.
+        - column_copies (int): Column Series created during the last apply.
+
+    Methods:
+    --------
+        - __init__(self, rules): Initialises the CleaningRuleEngine instance.
+        - def apply(self, table_kind, df): Cleans a DataFrame with the rules of one table.
+        - def compare(self, table_kind, df, legacy_function): Runs the engine and the step-by-step cleaning and reports the difference.
+    """
+
+    def __init__(self, rules=CLEANING_RULES):
+        """
+        Initialises the CleaningRuleEngine instance.
+
+        Parameters:
+        ----------
+            - rules (dict): Cleaning steps per table, defaults to CLEANING_RULES.
+        """
+        self.rules = rules
+        self.column_copies = 0
+
+    def apply(self, table_kind, df):
+        """
+        Cleans a DataFrame with the rules of one table.
+
+        Parameters:
+        ----------
+            - table_kind (str): Key of the rules, e.g. 'users' or 'dates'.
+            - df (pd.DataFrame): The extracted DataFrame, left unmodified.
+
+        Returns:
+            - pd.DataFrame: The cleaned DataFrame.
+        """
+        with copy_on_write():
+            self.column_copies = 0
+            columns = {name: df[name] for name in df.columns}
+
+            # Original positions of the surviving rows, and the rows each column currently holds
+            surviving_rows = np.arange(len(df))
+            surviving = np.ones(len(df), dtype=bool)
+            column_rows = {name: surviving_rows for name in columns}
+
+            # Replacements are deferred until a column is next touched, so they only run on the surviving rows
+            pending_replacements = {name: [] for name in columns}
+
+            def aligned(name):
+                # Drop the rows filtered out since this column was last touched, in one take.
+                # The values are taken without their index, which is rebuilt once for the output.
+                if column_rows[name] is not surviving_rows:
+                    columns[name] = pd.Series(columns[name].array[surviving[column_rows[name]]], name=name, copy=False)
+                    column_rows[name] = surviving_rows
+                    self.column_copies += 1
+                for mapping in pending_replacements[name]:
+                    columns[name] = replace_values(columns[name], mapping)
+                    self.column_copies += 1
+                pending_replacements[name] = []
+                return columns[name]
+
+            def missing(name):
+                # Missing values of a column on the surviving rows, counting values a pending replacement turns into NA
+                series = columns[name]
+                mask = series.isna().to_numpy()
+                for mapping in pending_replacements[name]:
+                    missing_values = [old_value for old_value, new_value in mapping.items() if pd.isna(new_value)]
+                    if missing_values:
+                        mask = mask | series.isin(missing_values).to_numpy()
+                return mask if column_rows[name] is surviving_rows else mask[surviving[column_rows[name]]]
+
+            def drop_column(name):
+                del columns[name], column_rows[name], pending_replacements[name]
+
+            for step in self.rules[table_kind]:
+                action = step[0]
+
+                if action == 'drop_columns':
+                    for name in step[1]:
+                        drop_column(name)
+
+                elif action == 'drop_first_column':
+                    drop_column(next(iter(columns)))
+
+                elif action == 'replace_all':
+                    for name in columns:
+                        pending_replacements[name].append(step[1])
+
+                elif action in ('transform', 'transform_in_place'):
+                    _, name, operations = step
+                    series = aligned(name)
+                    original_dtype = series.dtype
+                    for operation, argument in operations:
+                        series = OPERATIONS[operation](series, argument)
+                        self.column_copies += 1
+                    if action == 'transform_in_place' and original_dtype == object and series.dtype != object:
+                        # Setting values through .loc keeps an object column object
+                        series = series.astype(object)
+                    columns[name] = series
+
+                elif action == 'require':
+                    _, name, predicate, argument = step
+                    keep = PREDICATES[predicate](aligned(name), argument).fillna(False).to_numpy(dtype=bool)
+                    surviving[surviving_rows[~keep]] = False
+                    surviving_rows = surviving_rows[keep]
+                    columns[name] = pd.Series(columns[name].array[keep], name=name, copy=False)
+                    column_rows[name] = surviving_rows
+                    self.column_copies += 1
+
+                elif action == 'drop_missing_rows':
+                    # Only boolean masks are built here; no column is copied
+                    missing_values = np.column_stack([missing(name) for name in columns])
+                    keep = ~(missing_values.any(axis=1) if step[1] == 'any' else missing_values.all(axis=1))
+                    surviving[surviving_rows[~keep]] = False
+                    surviving_rows = surviving_rows[keep]
+
+                else:
+                    raise ValueError(f'unknown cleaning step {action}')
+
+            # Assemble the output once, every column filtered to the final rows
+            index = df.index if len(surviving_rows) == len(df) else df.index[surviving_rows]
+            return pd.DataFrame({name: aligned(name).set_axis(index) for name in list(columns)}, copy=False)
+
+    def compare(self, table_kind, df, legacy_function):
+        """
+        Runs the step-by-step cleaning and the engine on the same input, checking the outputs agree
+        and reporting the peak memory the engine saved and an estimate of the column copies it avoided.
+
+        Parameters:
+        ----------
+            - table_kind (str): Key of the rules, e.g. 'users'.
+            - df (pd.DataFrame): The extracted DataFrame.
+            - legacy_function (callable): The DataCleaning method cleaning the same table step by step.
+
+        Returns:
+            - dict: Timings, peak traced memory, estimated column copies and whether the outputs are identical.
+        """
+        legacy_df, legacy_seconds, legacy_peak = self._measure(legacy_function, df.copy())
+        engine_df, engine_seconds, engine_peak = self._measure(lambda frame: self.apply(table_kind, frame), df)
+
+        report = {
+            'table': table_kind,
+            'identical': legacy_df is not None and legacy_df.reset_index(drop=True).equals(engine_df.reset_index(drop=True)),
+            'legacy_column_copies_estimate': self._legacy_column_copies(table_kind, df),
+            'engine_column_copies': self.column_copies,
+            'legacy_peak_bytes': legacy_peak,
+            'engine_peak_bytes': engine_peak,
+            'legacy_seconds': legacy_seconds,
+            'engine_seconds': engine_seconds,
+        }
+        logging.info(f"{table_kind}: {(legacy_peak - engine_peak) / 2**20:.1f} MiB peak memory and an estimated "
+                     f"{report['legacy_column_copies_estimate'] - report['engine_column_copies']} column copies eliminated, identical output: {report['identical']}")
+        return report
+
+    def _legacy_column_copies(self, table_kind, df):
+        """ Estimates, without measuring, the column copies of the step-by-step cleaning: every frame-wide step is counted as copying every column."""
+        column_count = len(df.columns)
+        copies = 0
+        for step in self.rules[table_kind]:
+            action = step[0]
+            if action in ('drop_columns', 'drop_first_column'):
+                column_count -= len(step[1]) if action == 'drop_columns' else 1
+                copies += column_count
+            elif action in ('replace_all', 'require', 'drop_missing_rows'):
+                copies += column_count
+            else:
+                copies += len(step[2])
+        return copies
+
+    @staticmethod
+    def _measure(function, df):
+        """ Runs a cleaning function under tracemalloc, returning its output, duration and peak traced memory."""
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            result = function(df)
+            return result, time.perf_counter() - start, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+# Main Execution
+if __name__ == "__main__":
+    # Compare both cleaning paths on the raw tables the extractor saved in csv_files/
+    from data_cleaning import DataCleaning
+
+    step_by_step_cleaner = DataCleaning(None)
+    raw_tables = {
+        'users': ('legacy_users.csv', step_by_step_cleaner.clean_users_frame),
+        'cards': ('cards_table.csv', step_by_step_cleaner.clean_cards_frame),
+        'stores': ('stores_table.csv', step_by_step_cleaner.clean_store_data),
+        'products': ('products_table.csv', step_by_step_cleaner.clean_product_data),
+        'orders': ('orders_table.csv', step_by_step_cleaner.clean_orders_frame),
+        'dates': ('date_times_table.csv', step_by_step_cleaner.clean_dates),
+    }
+
+    engine = CleaningRuleEngine()
+    for table_kind, (csv_filename, legacy_function) in raw_tables.items():
+        try:
+            report = engine.compare(table_kind, pd.read_csv(f'csv_files/{csv_filename}'), legacy_function)
+            print(report)
+        except Exception as e:
+            logging.error(f'Error in cleaning_rules comparison of {table_kind}: {e}')
+
+# The script ends here
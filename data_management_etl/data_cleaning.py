@@ -9,12 +9,14 @@ Date: January 2024
 
 # External Libraries
 import logging 
+import numpy as np
 import pandas as pd
 import re
 
 # Internal Libraries and Credentials
 from database_utils import DatabaseConnector, aws_credentials_file, local_credentials_file
 from data_extraction import DataExtractor
+from cleaning_rules import CleaningRuleEngine
 
 # Logging Configuration
 logging.basicConfig(level=logging.INFO)
@@ -26,26 +28,33 @@ class DataCleaning:
 
     Parameters: 
         - extractor: An instance of the DataExtractor class for extracting data from various sources.
+        - use_rule_engine: Whether the declarative rules of cleaning_rules.py replace the step-by-step cleaning.
 
     Methods:
-        - __init__(self, extractor): Initialises the DataCleaning instance.
+        - __init__(self, extractor, use_rule_engine): Initialises the DataCleaning instance.
         - clean_user_data(table_name): Cleans user data.
+        - clean_users_frame(df): Cleans an extracted users DataFrame.
         - clean_card_data(pdf_url): Cleans card data.
+        - clean_cards_frame(df): Cleans an extracted cards DataFrame.
         - clean_store_data(df): Cleans stores data.
         - convert_product_weights(df): Converts product weights to a consistent format in kilos.
         - clean_product_data(df): Cleans converted product data.
         - clean_orders_data(table_name): Cleans orders data.
+        - clean_orders_frame(df): Cleans an extracted orders DataFrame.
+        - split_orphan_orders(df, dimension_frames): Separates orders whose keys are missing from the dimension tables.
         - clean_dates(df): Cleans date events data.
     """
 
-    def __init__(self, extractor):
+    def __init__(self, extractor, use_rule_engine=False):
         """
         Initialises the DataCleaning instance.
 
         Parameter: 
             - extractor (DataExtractor): An instance of the DataExtractor class for data extraction.
+            - use_rule_engine (bool): Clean with the single-pass CleaningRuleEngine instead of the step-by-step methods.
         """
         self.extractor = extractor
+        self.rule_engine = CleaningRuleEngine() if use_rule_engine else None
         
 
     def clean_user_data(self, table_name):
@@ -61,11 +70,30 @@ class DataCleaning:
         try:
             # Retrieve user data from the specified table
             df_users = self.extractor.read_rds_table(table_name)
-                        
+            return self.clean_users_frame(df_users)
+        
+        except Exception as e:
+            logging.error(f'Error in data_cleaning method clean_user_data: {e}')
+            return None
+
+    def clean_users_frame(self, df_users):
+        """
+        Cleans an extracted users DataFrame.
+
+        Parameter: 
+            - df_users (pd.DataFrame): Users data as read from the RDS table.
+
+        Returns: 
+            - A cleaned Pandas DataFrame ready for uploading or None if cleaning fails.
+        """
+        try:
             if df_users.empty:
                 logging.warning('Error in data_cleaning method clean_user_data, data retrieval')
                 return None
 
+            if self.rule_engine is not None:
+                return self.rule_engine.apply('users', df_users)
+
             # Drop rendundant index column
             df_users = df_users.drop('index', axis=1)
             
@@ -87,7 +115,7 @@ class DataCleaning:
             return df_users
         
         except Exception as e:
-            logging.error(f'Error in data_cleaning method clean_user_data: {e}')
+            logging.error(f'Error in data_cleaning method clean_users_frame: {e}')
             return None
     
     def clean_card_data(self, pdf_url):
@@ -104,11 +132,29 @@ class DataCleaning:
         try:
             # Retrieve card data from the specified PDF
             df_cards = self.extractor.retrieve_pdf_data(pdf_url)            
-                        
+            return self.clean_cards_frame(df_cards)
+        
+        except Exception as e:
+            logging.error(f'Error in data_cleaning method clean_card_data: {e}')
+
+    def clean_cards_frame(self, df_cards):
+        """
+        Cleans an extracted cards DataFrame.
+
+        Parameters:
+            - df_cards (pd.DataFrame): Card data as read from the PDF.
+
+        Returns:
+            - A cleaned Pandas DataFrame ready for uploading or None if cleaning fails.
+        """
+        try:
             if df_cards.empty:
                 logging.warning('Error in data_cleaning method clean_card_data, data retrieval')
                 return None
 
+            if self.rule_engine is not None:
+                return self.rule_engine.apply('cards', df_cards)
+
             # Replace "NULL" string with NaN 
             df_cards.replace("NULL", pd.NA, inplace=True) 
             
@@ -126,7 +172,7 @@ class DataCleaning:
             return df_cards
         
         except Exception as e:
-            logging.error(f'Error in data_cleaning method clean_card_data: {e}')
+            logging.error(f'Error in data_cleaning method clean_cards_frame: {e}')
         
 
     def clean_store_data(self, df_stores):
@@ -144,6 +190,9 @@ class DataCleaning:
             # Check that the DataFrame is not empty
             if not df_stores.empty:  
 
+                if self.rule_engine is not None:
+                    return self.rule_engine.apply('stores', df_stores)
+
                 # Remove redundant columns 'index' and 'lat' 
                 columns_to_drop = ['index', 'lat']
                 df_stores.drop(columns=columns_to_drop, inplace=True)
@@ -232,6 +281,9 @@ class DataCleaning:
                 logging.warning('Error in data_cleaning method clean_product_data, data retrieval')
                 return None
 
+            if self.rule_engine is not None:
+                return self.rule_engine.apply('products', df_products)
+
             # Remove redundant columns by their index
             df_products = df_products.drop(df_products.columns[0], axis=1)
 
@@ -272,10 +324,29 @@ class DataCleaning:
         try:
             # Retrieve orders data from the specified table
             df_orders = self.extractor.read_rds_table(table_name)
-            
+            return self.clean_orders_frame(df_orders)
+        
+        except Exception as e:
+            logging.error(f'Error in data_cleaning method clean_orders_data: {e}')
+            return None
+
+    def clean_orders_frame(self, df_orders):
+        """
+        Cleans an extracted orders DataFrame.
+
+        Parameters:
+            - df_orders (pd.DataFrame): Orders data as read from the RDS table.
+
+        Returns:
+            - A cleaned Pandas DataFrame ready for uploading or None if cleaning fails.
+        """
+        try:
             if df_orders.empty:
                 logging.warning('Error in data_cleaning method clean_orders_data, data retrieval')
                 return None
+
+            if self.rule_engine is not None:
+                return self.rule_engine.apply('orders', df_orders)
             
             # Remove redundant columns by their names, if available, or else by their index number
             columns_to_drop = ['level_0', 'first_name', 'last_name', '1']
@@ -285,9 +356,50 @@ class DataCleaning:
             return df_orders
         
         except Exception as e:
-            logging.error(f'Error in data_cleaning method clean_orders_data: {e}')
+            logging.error(f'Error in data_cleaning method clean_orders_frame: {e}')
             return None
 
+    def split_orphan_orders(self, df_orders, dimension_frames):
+        """
+        Separates the orders whose keys do not exist in the cleaned dimension tables, so the foreign keys
+        of the star schema can be added without cleaning up the database first.
+        Each key column is checked with one hashed isin lookup against the unique keys of its dimension, compared as text
+        after _key_text has made numeric keys read the same whatever their dtype. Orders with a missing key are orphans too.
+
+        Parameters:
+            - df_orders (pd.DataFrame): Cleaned orders data.
+            - dimension_frames (dict): Key column names mapped to the cleaned dimension DataFrame holding that key,
+              e.g. {'user_uuid': df_users}. Dimensions that failed to load are left out and not checked.
+
+        Returns:
+            - tuple: The orders with every key present, and the orphan orders with an 'orphan_keys' column naming the missing keys.
+        """
+        orphan_keys = np.full(len(df_orders), '', dtype=object)
+        orphaned = np.zeros(len(df_orders), dtype=bool)
+
+        for key_column, df_dimension in dimension_frames.items():
+            dimension_keys = pd.unique(self._key_text(df_dimension[key_column]).dropna())
+            missing = ~self._key_text(df_orders[key_column]).isin(dimension_keys).to_numpy()
+            if missing.any():
+                orphan_keys = np.where(missing, orphan_keys + key_column + ' ', orphan_keys)
+                orphaned |= missing
+            logging.info(f'{missing.sum()} orders reference a {key_column} missing from its dimension')
+
+        df_orphans = df_orders[orphaned].assign(orphan_keys=pd.Series(orphan_keys[orphaned], index=df_orders.index[orphaned]).str.strip())
+        return df_orders[~orphaned], df_orphans
+
+    @staticmethod
+    def _key_text(keys):
+        """ Returns keys as text, with whole floats such as 1234.0 written as '1234' and missing keys as None."""
+        if pd.api.types.is_float_dtype(keys):
+            whole = keys.notna() & (keys % 1 == 0)
+            text = keys.astype(str).astype(object)
+            text[whole] = keys[whole].astype('int64').astype(str)
+        else:
+            # Object columns can mix numbers read from different sources with text
+            text = keys.map(lambda key: str(int(key)) if isinstance(key, float) and key.is_integer() else str(key), na_action='ignore')
+        return text.where(keys.notna(), None)
+
 
     def clean_dates(self, df_dates): 
         """
@@ -304,6 +416,9 @@ class DataCleaning:
                 logging.warning('Error in data_cleaning method clean_dates, data retrieval')
                 return None
 
+            if self.rule_engine is not None:
+                return self.rule_engine.apply('dates', df_dates)
+
             # Remove rows where month length is over 3 characters (incorrect values)
             month_over_3_characters = df_dates['month'].str.len() > 3
             df_dates = df_dates[~month_over_3_characters]
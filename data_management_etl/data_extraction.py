@@ -10,10 +10,17 @@ Date: January 2024
 # External Libraries
 import boto3
 import logging
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import tabula
 import requests
 
+# Optional streaming JSON parser, only needed by stream_json_from_url
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 # Internal Libraries and Database Credentials
 from database_utils import DatabaseConnector, aws_credentials_file, local_credentials_file
 
@@ -35,16 +42,23 @@ class DataExtractor:
     -----------
         db_connector (DatabaseConnector): An instance of the DatabaseConnector class.
         api_config (dict): A dictionary containing API configuration details.
+        prefetched_tables (dict): RDS tables read ahead by read_rds_tables, handed out once by read_rds_table.
+        stream_json (bool): Whether extract_json_from_url parses the response incrementally while it downloads.
 
     Methods:
     -----------
         __init__(self, db_connector, api_config): Initialises the DataExtractor instance.
         def read_rds_table(self, table_name): Reads data from an RDS table.
+        def read_rds_tables(self, table_names, max_workers): Reads several RDS tables concurrently, largest first.
+        def iter_rds_table(self, table_name, chunk_rows): Reads an RDS table in batches of rows.
         def retrieve_pdf_data(self, pdf_url): Converts  pdf file into a pandas DataFrame.
         def list_number_of_stores(self): Lists the number of stores.
         def retrieve_stores_data(self, store_details_endpoint, number_of_stores): Retrieves data for multiple stores.
+        def iter_stores_data(self, store_details_endpoint, number_of_stores, batch_size): Retrieves store data in batches of stores.
         def extract_from_s3(self, s3_address): Extracts data from an S3 bucket.
+        def iter_s3_csv(self, s3_address, chunk_rows): Reads a CSV file from an S3 bucket in batches of rows.
         def extract_json_from_url(self, json_url): Extracts data from a JSON file at the specified URL.
+        def stream_json_from_url(self, json_url, chunk_rows): Parses a JSON file while it downloads, optionally in chunks.
     """
 
     def __init__(self, db_connector):
@@ -59,6 +73,8 @@ class DataExtractor:
         try:
             # Assign input parameters to instance variables
             self.db_connector = db_connector
+            self.prefetched_tables = {}
+            self.stream_json = False
             
            # Assign API configuration dictionary
             self.api_config = db_connector.read_api_config()
@@ -78,6 +94,10 @@ class DataExtractor:
             - A Panda DataFrame containing the data from the specified RDS table.
         """
         
+        # Hand out a table already read by read_rds_tables, only once to free its memory
+        if table_name in self.prefetched_tables:
+            return self.prefetched_tables.pop(table_name)
+
         try:
             # Build the SQL query to extract all data from the specified RDS table.
             extracted_table_query  = f"SELECT * FROM {table_name};"
@@ -94,6 +114,67 @@ class DataExtractor:
         except Exception as e:
             logging.error(f'Error in data_extraction method read_rds_table: {e}')
     
+    def read_rds_tables(self, table_names=None, max_workers=4):
+        """
+        Reads several RDS tables concurrently, each on its own pooled connection.
+        Tables are started largest first, so the total time stays close to that of the largest table.
+
+        Parameters:
+        -----------
+            - table_names (list): Tables to read, defaults to every table discovered in the RDS database.
+            - max_workers (int): Number of tables read at the same time.
+
+        Returns:
+            - dict: Table names mapped to Pandas DataFrames; the frames are also kept for read_rds_table.
+        """
+
+        try:
+            available_tables = self.db_connector.list_db_tables()
+            if table_names is None:
+                table_names = available_tables
+            
+            missing_tables = [table_name for table_name in table_names if table_name not in available_tables]
+            if missing_tables:
+                logging.warning(f'tables not found in the RDS database: {missing_tables}')
+            table_names = [table_name for table_name in table_names if table_name in available_tables]
+
+            # Longest processing time first: the pool starts tasks in submission order
+            sizes = self.db_connector.estimate_table_sizes(table_names)
+            table_names = sorted(table_names, key=lambda table_name: sizes.get(table_name, 0), reverse=True)
+            logging.info(f'extracting RDS tables largest first: {table_names}')
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                frames = dict(zip(table_names, executor.map(self.read_rds_table, table_names)))
+
+            self.prefetched_tables.update({table_name: df for table_name, df in frames.items() if df is not None})
+            return frames
+        
+        except Exception as e:
+            logging.error(f'Error in data_extraction method read_rds_tables: {e}')
+            return {}
+
+    def iter_rds_table(self, table_name, chunk_rows=10000):
+        """
+        Reads an RDS table in batches of rows, so cleaning and loading can start before the whole table has arrived.
+        Unlike read_rds_table, errors are raised to the caller, which is usually a pipeline thread.
+
+        Parameters:
+        -----------
+            - table_name (str): Name of the RDS table.
+            - chunk_rows (int): Rows per batch.
+
+        Yields:
+            - Pandas DataFrames of up to chunk_rows rows; the batches are also appended to csv_files/{table_name}.csv.
+        """
+
+        with self.db_connector.external_data_engine.connect() as connection:
+            # Stream the result set from the server instead of buffering all of it in the driver
+            connection = connection.execution_options(stream_results=True)
+            chunks = pd.read_sql(f"SELECT * FROM {table_name};", connection, chunksize=chunk_rows)
+            for chunk_number, df in enumerate(chunks):
+                df.to_csv(f'csv_files/{table_name}.csv', mode='w' if chunk_number == 0 else 'a', header=chunk_number == 0, index=False)
+                yield df
+
     def retrieve_pdf_data(self, pdf_url):
         """
         Converts pdf file into a Pandas DataFrame.
@@ -154,37 +235,11 @@ class DataExtractor:
         """
 
         try:
-            # Initialise a list to store data for each store.
-            stores_data = []
-
-            # Initialise a list to store store numbers for which data retrieval failed.
-            failed_stores = []  
-
-             # Iterate over the specified number of stores.
-            for store_number in range(0, number_stores):
-                stores_url = f"{store_details_endpoint}{store_number}"
-            
-                # Send a GET request to the API endpoint for store details.
-                response = requests.get(stores_url, headers=self.api_config['headers'])
-                try:
-                    # Check if the response status code indicates a successful request (200 OK).
-                    if response.status_code == 200:
-                        # Parse the JSON data from the response and append it to the list of store data.
-                        store_data = response.json()
-                        stores_data.append(store_data)
-                    else: 
-                        # If the request was not successful, add the store number to the list of failed stores.
-                        failed_stores.append(store_number)
-                
-                except Exception as e:
-                    logging.error(f'Error in data_extraction method retrieve_stores_data, data retrieval: {e}')
-        
-            # If there are failed stores, log a warning with information about the failures.
-            if failed_stores:
-                logging.warning(f'failed to retrieve data for {len(failed_stores)} stores: {failed_stores}')
+            # Retrieve every store in a single batch
+            batches = list(self.iter_stores_data(store_details_endpoint, number_stores, number_stores))
 
             # Create a Pandas DataFrame from the list of store data.
-            df = pd.DataFrame(stores_data)
+            df = batches[0] if batches else pd.DataFrame()
 
             # Save the DataFrame to a CSV file locally.
             df.to_csv('csv_files/stores_table.csv', index=False)
@@ -195,6 +250,54 @@ class DataExtractor:
             logging.error(f'Error in data_extraction method retrieve_stores_data: {e}')
             return None
 
+    def iter_stores_data(self, store_details_endpoint, number_stores, batch_size=50):
+        """
+        Retrieves data for multiple stores from an API endpoint, handing it out in batches of stores.
+
+        Parameters:
+        ----------
+            - store_details_endpoint (string): The API endpoint for store details.
+            - number_stores (integer): The number of stores to retrieve data for.
+            - batch_size (integer): Number of stores requested per batch.
+
+        Yields:
+            - pd.DataFrame: Pandas DataFrames with the data of the stores retrieved in each batch.
+        """
+
+        # Initialise a list to store data for each store.
+        stores_data = []
+
+        # Initialise a list to store store numbers for which data retrieval failed.
+        failed_stores = []  
+
+        # Iterate over the specified number of stores.
+        for store_number in range(0, number_stores):
+            stores_url = f"{store_details_endpoint}{store_number}"
+        
+            # Send a GET request to the API endpoint for store details.
+            response = requests.get(stores_url, headers=self.api_config['headers'])
+            try:
+                # Check if the response status code indicates a successful request (200 OK).
+                if response.status_code == 200:
+                    # Parse the JSON data from the response and append it to the list of store data.
+                    store_data = response.json()
+                    stores_data.append(store_data)
+                else: 
+                    # If the request was not successful, add the store number to the list of failed stores.
+                    failed_stores.append(store_number)
+            
+            except Exception as e:
+                logging.error(f'Error in data_extraction method iter_stores_data, data retrieval: {e}')
+
+            # Hand out a full batch, or the remaining stores after the last request
+            if stores_data and (len(stores_data) >= batch_size or store_number == number_stores - 1):
+                yield pd.DataFrame(stores_data)
+                stores_data = []
+    
+        # If there are failed stores, log a warning with information about the failures.
+        if failed_stores:
+            logging.warning(f'failed to retrieve data for {len(failed_stores)} stores: {failed_stores}')
+
    ############################     
     def extract_from_s3(self, s3_address):
         """
@@ -229,6 +332,27 @@ class DataExtractor:
         except Exception as e:
             logging.error(f'Error in data_extraction method extract_from_s3: {e}')
 
+    def iter_s3_csv(self, s3_address, chunk_rows=10000):
+        """
+        Reads a CSV file from an S3 bucket in batches of rows while it downloads.
+        Unlike extract_from_s3, errors are raised to the caller, which is usually a pipeline thread.
+
+        Parameters:
+        ----------
+            - s3_address (string): The address in the format 's3://bucket_name/object_key'.
+            - chunk_rows (int): Rows per batch.
+
+        Yields:
+            - Pandas DataFrames of up to chunk_rows rows; the batches are also appended to csv_files/products_table.csv.
+        """
+
+        bucket_name, object_key = s3_address.replace('s3://', '').split('/', 1)
+        response = boto3.client('s3').get_object(Bucket=bucket_name, Key=object_key)
+
+        for chunk_number, df in enumerate(pd.read_csv(response['Body'], chunksize=chunk_rows)):
+            df.to_csv('csv_files/products_table.csv', mode='w' if chunk_number == 0 else 'a', header=chunk_number == 0, index=False)
+            yield df
+
 
     def extract_json_from_url(self, json_url):
         """
@@ -241,6 +365,12 @@ class DataExtractor:
             - pd.DataFrame: Pandas DataFrame with data from the JSON file.
         """
 
+        # Parse while downloading when requested and the streaming parser is available
+        if self.stream_json:
+            if ijson is not None:
+                return self.stream_json_from_url(json_url)
+            logging.warning('ijson is not installed, reading the JSON file in one go')
+
         try:
             # Send a GET request to the specified JSON URL.
             response = requests.get(json_url)
@@ -265,6 +395,156 @@ class DataExtractor:
             logging.error(f'Error in data_extraction method extract_json_from_url: {e}')
             return None
 
+    def stream_json_from_url(self, json_url, chunk_rows=None):
+        """
+        Parses a JSON file while it downloads into one buffer per column, without holding the body or a dictionary per row.
+        Supports the column-oriented layout of date_details.json ({column: {row_key: value}}) and lists of row objects.
+
+        Chunking only helps record-oriented feeds ([{column: value}, ...]): their first chunk is handed out as soon as it has been downloaded.
+        A column-oriented file such as date_details.json holds no complete row until its last column has arrived, 
+        so it is parsed in full before the first chunk is handed out, and each column briefly exists both as a Python list and as a Series.
+
+        Parameters:
+            - json_url (string): The URL of the JSON file.
+            - chunk_rows (int): If given, return an iterator of DataFrames with up to chunk_rows rows each. 
+
+        Returns:
+            - pd.DataFrame, or an iterator of DataFrames when chunk_rows is given. None if the download fails.
+              The iterator logs and raises a failed download or a malformed or truncated document to its consumer.
+        """
+
+        if chunk_rows:
+            def logged_chunks():
+                try:
+                    yield from self._iterate_json_chunks(json_url, chunk_rows)
+                except Exception as e:
+                    logging.error(f'Error in data_extraction method stream_json_from_url: {e}')
+                    raise
+            
+            return logged_chunks()
+
+        try:
+            chunks = list(self._iterate_json_chunks(json_url, None))
+            df = chunks[0] if chunks else pd.DataFrame()
+            
+            # Save the Pandas DataFrame to a local CSV file.
+            df.to_csv('csv_files/date_times_table.csv', index=False)
+            return df
+        
+        except Exception as e:
+            logging.error(f'Error in data_extraction method stream_json_from_url: {e}')
+            return None
+
+    def _iterate_json_chunks(self, json_url, chunk_rows):
+        """ Downloads and parses a JSON file incrementally, yielding DataFrames of up to chunk_rows rows (all rows if None)."""
+
+        with requests.get(json_url, stream=True) as response:
+            if response.status_code != 200:
+                raise ValueError(f'status code {response.status_code} for {json_url}')
+            
+            # Let urllib3 undo any gzip transfer encoding as the bytes arrive
+            response.raw.decode_content = True
+            events = ijson.parse(response.raw, use_float=True)
+            _, first_event, _ = next(events, (None, None, None))
+
+            if first_event == 'start_map':
+                df = self._parse_json_columns(events)
+                if not chunk_rows:
+                    yield df
+                    return
+                for start in range(0, len(df), chunk_rows):
+                    yield df.iloc[start:start + chunk_rows]
+            
+            elif first_event == 'start_array':
+                yield from self._parse_json_records(events, chunk_rows)
+            
+            elif first_event is None:
+                raise ValueError(f'empty JSON document at {json_url}')
+            
+            else:
+                raise ValueError(f'unsupported JSON layout starting with {first_event}')
+
+    @staticmethod
+    def _parse_json_columns(events):
+        """ Builds a DataFrame from the parser events of a {column: {row_key: value}} document, one column buffer at a time."""
+
+        columns = {}
+        index, index_keys = None, None
+        column_name, keys, values = None, [], []
+        depth = 1
+
+        for _, event, value in events:
+            if event in ('start_map', 'start_array'):
+                depth += 1
+                if depth > 2:
+                    raise ValueError('nested values are not supported')
+            
+            elif event in ('end_map', 'end_array'):
+                depth -= 1
+                if depth == 1:
+                    # Column finished: turn its buffer into a Series and release the Python lists
+                    if not keys:
+                        # {column: [values]} layout, positional rows
+                        columns[column_name] = pd.Series(values)
+                    else:
+                        if index is None:
+                            index, index_keys = pd.Index(keys), keys
+                        columns[column_name] = pd.Series(values, index=index if keys == index_keys else pd.Index(keys))
+                    keys, values = [], []
+            
+            elif event == 'map_key':
+                if depth == 1:
+                    column_name = value
+                else:
+                    keys.append(value)
+            
+            else:
+                values.append(value)
+
+        return pd.DataFrame(columns)
+
+    @staticmethod
+    def _parse_json_records(events, chunk_rows):
+        """ Yields DataFrames from the parser events of a [{column: value}, ...] document every chunk_rows rows."""
+
+        columns = {}
+        row_count = 0
+        field = None
+        depth = 1
+
+        for _, event, value in events:
+            if event in ('start_map', 'start_array'):
+                depth += 1
+                if depth > 2 or event == 'start_array':
+                    raise ValueError('nested values are not supported')
+                row_count += 1
+            
+            elif event == 'end_array':
+                depth -= 1
+            
+            elif event == 'map_key':
+                field = value
+                if field not in columns:
+                    # A column first seen part-way through gets missing values for the earlier rows
+                    columns[field] = [None] * (row_count - 1)
+            
+            elif event == 'end_map':
+                depth -= 1
+                # Fill the columns this row did not mention
+                for buffer in columns.values():
+                    if len(buffer) < row_count:
+                        buffer.append(None)
+                if chunk_rows and row_count == chunk_rows:
+                    yield pd.DataFrame(columns)
+                    columns = {name: [] for name in columns}
+                    row_count = 0
+            
+            else:
+                columns[field].append(value)
+
+        if row_count:
+            yield pd.DataFrame(columns)
+
 # Main Execution        
 if __name__ == "__main__":
     # Instantiate the DatabaseConnector
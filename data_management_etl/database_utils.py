@@ -9,8 +9,11 @@ Date: January 2024
 
 # External Libraries
 import logging
+import re
+import time
+import pandas as pd
 import yaml
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import create_engine, inspect, text
 
 # Logging Configuration
 logging.basicConfig(level=logging.INFO)
@@ -20,6 +23,26 @@ logging.basicConfig(level=logging.INFO)
 aws_credentials_file="db_creds.yaml"
 local_credentials_file="project_creds_local.yaml"
 
+# Table recording how many times each destination table has been loaded
+load_versions_table="etl_load_versions"
+
+# Table holding the row hashes of the last load, and the business keys used by the 'hash_diff' load mode
+row_hashes_table="etl_row_hashes"
+row_hash_columns_table="etl_row_hash_columns"
+dimension_business_keys={
+    'dim_users': 'user_uuid',
+    'dim_card_details': 'card_number',
+    'dim_store_details': 'store_code',
+    'dim_products': 'product_code',
+}
+
+# Fact tables that can be range partitioned by month: partition column, and the dimension whose year and month give it.
+# Content hashes of the loaded partitions let later loads skip the months that have not changed.
+partitioned_tables={
+    'orders_table': ('order_month', 'dim_date_times'),
+}
+partition_hashes_table="etl_partition_hashes"
+
 
 # DatabaseConnector Class and Methods 
 class DatabaseConnector: 
@@ -35,6 +58,10 @@ class DatabaseConnector:
         - creds2 (dict): Database credentials to run an engine for uploading cleaned data.
         - engine1 (sqlalchemy.engine.Engine): SQLAlchemy engine for downloading.
         - engine2 (sqlalchemy.engine.Engine): SQLAlchemy engine for uploading.
+        - load_mode (str): Default upload mode, one of 'replace', 'swap' or 'hash_diff'.
+        - unlogged_staging (bool): Whether staging tables are created without WAL logging.
+        - partition_facts (bool): Whether the tables in partitioned_tables are loaded as monthly range partitions.
+        - load_stats (dict): Rows and seconds of the last upload of every table.
 
     Methods:
     --------
@@ -44,7 +71,20 @@ class DatabaseConnector:
         - def init_db_engine_external(self): Initialises the SQLAlchemy engine to connect to external sources.
         - def init_db_engine_local(self): Initialises the SQLAlchemy engine to connect to local PostgreSQL database.
         - def list_db_tables(self): Creates a list of tables received from a source.
-        - def upload_to_db(self, df, destination_table_name): Uploads dataframes to local PostgreSQL database.
+        - def estimate_table_sizes(self, table_names): Estimates the size of source tables.
+        - def upload_to_db(self, df, destination_table_name, load_mode, unlogged): Uploads dataframes to local PostgreSQL database.
+        - def load_via_staging(self, df, destination_table_name, unlogged): Bulk loads a dataframe into a staging table and swaps it in.
+        - def create_staging_table(self, df, destination_table_name, unlogged): Creates an empty staging table.
+        - def append_to_staging(self, df, destination_table_name): Appends a batch of rows to a staging table.
+        - def swap_staging_table(self, destination_table_name): Replaces the live table with its staging table in one transaction.
+        - def find_dependent_objects(self, connection, table_name): Lists the foreign keys and views referencing a table.
+        - def load_changed_rows(self, df, destination_table_name, business_key): Writes only inserted, updated and deleted rows.
+        - def forget_row_hashes(self, connection, destination_table_name): Deletes the stored row hashes of a table written another way.
+        - def load_partitioned(self, df, destination_table_name): Replaces only the monthly partitions whose rows changed.
+        - def plan_partitions(df, destination_table_name, partition_column, existing_partitions, stored_hashes): Groups rows by month and picks the partitions to replace and drop.
+        - def add_partition_key(self, df, destination_table_name): Adds the month column a fact table is partitioned by.
+        - def record_load_version(self, destination_table_name): Increments the load version of a table.
+        - def read_load_versions(self, with_loaded_at): Returns the current load version of every loaded table.
     """
     
     def __init__(self, aws_credentials_file, local_credentials_file):
@@ -62,6 +102,17 @@ class DatabaseConnector:
         self.aws_credentials_file = aws_credentials_file
         self.local_credentials_file = local_credentials_file
 
+        # Default upload behaviour, can be changed by the pipeline entry point
+        self.load_mode = 'replace'
+        self.unlogged_staging = False
+        self.partition_facts = False
+
+        # Inspector of the external database, created on first use and reused so table reflection is cached
+        self.external_inspector = None
+
+        # Rows and seconds of the last upload of every table
+        self.load_stats = {}
+
         try:
             # Attempt to read credentials 
             self.creds1, self.creds2 = self.read_db_creds(aws_credentials_file, local_credentials_file)
@@ -133,6 +184,10 @@ class DatabaseConnector:
         """
         
         try:
+            # A full SQLAlchemy URL in the credentials file, e.g. from the load-test harness, takes precedence
+            if self.creds1.get('RDS_URL'):
+                return create_engine(self.creds1['RDS_URL'])
+
             # Construct a connection string for the external database
             external_data_engine = create_engine(f"postgresql://{self.creds1['RDS_USER']}:{self.creds1['RDS_PASSWORD']}@{self.creds1['RDS_HOST']}:{self.creds1['RDS_PORT']}/{self.creds1['RDS_DATABASE']}")
             return external_data_engine
@@ -149,6 +204,9 @@ class DatabaseConnector:
         """
 
         try:
+            if self.creds2.get('URL'):
+                return create_engine(self.creds2['URL'])
+
             # Construct a connection string to a local PostgreSQL database
             local_data_engine = create_engine(f"postgresql://{self.creds2['USER']}:{self.creds2['PASSWORD']}@{self.creds2['HOST']}:{self.creds2['PORT']}/{self.creds2['DATABASE']}")
             return local_data_engine
@@ -165,14 +223,47 @@ class DatabaseConnector:
         """
 
         try: 
-             # Use the inspector to get a list of table names
-            inspector = inspect(self.external_data_engine)
-            return inspector.get_table_names()
+            # Reuse one inspector, which caches the reflected table names between calls
+            if self.external_inspector is None:
+                self.external_inspector = inspect(self.external_data_engine)
+
+            # Use the inspector to get a list of table names
+            return self.external_inspector.get_table_names()
         
         except Exception as e:
             logging.error(f'Error in database_utils method init_db_engine_external: {e}')
 
-    def upload_to_db(self, df, destination_table_name):
+    def estimate_table_sizes(self, table_names):
+        """
+        Estimates the size of source tables, used to schedule the largest extractions first.
+
+        Parameters:
+        ----------
+            - table_names (list): Names of the tables in the external database.
+
+        Returns:
+            - dict: Table names mapped to their size in bytes on PostgreSQL, or their row count on other databases.
+        """
+
+        sizes = {table_name: 0 for table_name in table_names}
+        try:
+            with self.external_data_engine.connect() as connection:
+                if connection.dialect.name == 'postgresql':
+                    # Catalogue lookup, no table scans
+                    rows = connection.execute(text('SELECT relname, pg_total_relation_size(oid) FROM pg_class '
+                                                   "WHERE relkind IN ('r', 'p') AND relname = ANY(:table_names)"),
+                                              {'table_names': list(table_names)})
+                    sizes.update({table_name: size for table_name, size in rows})
+                else:
+                    for table_name in table_names:
+                        sizes[table_name] = connection.execute(text(f'SELECT COUNT(*) FROM "{table_name}"')).scalar()
+        
+        except Exception as e:
+            logging.error(f'Error in database_utils method estimate_table_sizes: {e}')
+        
+        return sizes
+
+    def upload_to_db(self, df, destination_table_name, load_mode=None, unlogged=None):
         """
         Uploads Pandas DataFrames to PostgreSQL.
 
@@ -180,20 +271,526 @@ class DatabaseConnector:
         ----------
             - df (pandas.DataFrame): Dataframe to be uploaded.
             - destination_table_name (str): The name of the destination table in PostgreSQL database.
+            - load_mode (str): 'replace' drops and recreates the live table, 'swap' loads a staging table and renames it in, 
+              'hash_diff' writes only the changed rows of the dimension tables (other tables are replaced). 
+              Defaults to the connector's load_mode.
+            - unlogged (bool): Create the staging table as UNLOGGED in 'swap' mode. Defaults to the connector's unlogged_staging.
         """
 
+        load_mode = load_mode or self.load_mode
+        unlogged = self.unlogged_staging if unlogged is None else unlogged
+
         try:
             # Check there is a dataframe for uploading
             if df is None:
                 logging.warning(f'Error in database_utils method upload_to_db, data processing')
                 return
             
-            # Use local_data_engine to upload cleaned dataframe to the specified destination table
-            df.to_sql(name=destination_table_name, con=self.local_data_engine, if_exists='replace', index=False)
+            start = time.perf_counter()
+            changed = True
+            if self.partition_facts and destination_table_name in partitioned_tables:
+                # Only the months whose rows differ from the previous load are rewritten
+                changed = self.load_partitioned(df, destination_table_name)
+            elif load_mode == 'hash_diff' and destination_table_name in dimension_business_keys:
+                # Compare row hashes with the previous load and only write the difference
+                changed = self.load_changed_rows(df, destination_table_name, dimension_business_keys[destination_table_name])
+            elif load_mode == 'swap':
+                # Load behind the scenes so readers keep seeing the previous table until the rename
+                self.load_via_staging(df, destination_table_name, unlogged)
+            else:
+                # The stored row hashes no longer describe the table once it is written another way
+                with self.local_data_engine.begin() as connection:
+                    self.forget_row_hashes(connection, destination_table_name)
+
+                # Use local_data_engine to upload cleaned dataframe to the specified destination table
+                df.to_sql(name=destination_table_name, con=self.local_data_engine, if_exists='replace', index=False)
+
+            # Let downstream caches know the table content has changed
+            if changed:
+                self.record_load_version(destination_table_name)
+
+            self.load_stats[destination_table_name] = {'rows': len(df), 'seconds': time.perf_counter() - start}
         
         except Exception as e:
             logging.error(f'Error in database_utils method upload_to_db: {e}')
+
+    def load_via_staging(self, df, destination_table_name, unlogged=False):
+        """
+        Bulk loads a dataframe into '<destination_table_name>_staging' and swaps it in for the live table.
+        Every destination has its own staging table, so several tables can be loaded in parallel.
+
+        Parameters:
+        ----------
+            - df (pandas.DataFrame): Dataframe to be uploaded.
+            - destination_table_name (str): The name of the live table to be replaced.
+            - unlogged (bool): Skip WAL logging while the staging table is filled. It is made LOGGED again before the swap,
+              so the live table survives a server crash and reaches the standbys.
+        """
+
+        self.create_staging_table(df, destination_table_name, unlogged)
+
+        # Bulk insert the rows while the live table remains untouched
+        self.append_to_staging(df, destination_table_name)
+        
+        self.swap_staging_table(destination_table_name)
+        logging.info(f'{destination_table_name} swapped in from {destination_table_name}_staging ({len(df)} rows)')
+
+    def create_staging_table(self, df, destination_table_name, unlogged=False):
+        """
+        Creates an empty '<destination_table_name>_staging' table with the dataframe's columns and no indexes.
+
+        Parameters:
+        ----------
+            - df (pandas.DataFrame): Dataframe, or first batch of rows, giving the columns and their types.
+            - destination_table_name (str): The name of the live table the staging table will replace.
+            - unlogged (bool): Skip WAL logging for the staging table.
+        """
+
+        staging_table_name = f'{destination_table_name}_staging'
+        df.head(0).to_sql(name=staging_table_name, con=self.local_data_engine, if_exists='replace', index=False)
+        
+        if unlogged and self.local_data_engine.dialect.name == 'postgresql':
+            with self.local_data_engine.begin() as connection:
+                connection.execute(text(f'ALTER TABLE "{staging_table_name}" SET UNLOGGED'))
+
+    def append_to_staging(self, df, destination_table_name):
+        """ Appends rows to the staging table of a destination, which can be called once per batch before the swap."""
+        df.to_sql(name=f'{destination_table_name}_staging', con=self.local_data_engine, if_exists='append', index=False, chunksize=10000)
+
+    def swap_staging_table(self, destination_table_name):
+        """
+        Replaces the live table with its staging table using renames inside a single transaction.
+        Readers are only blocked for the duration of the renames; the previous table is dropped afterwards.
+        Foreign keys and views follow a renamed table, so the swap is refused while anything depends on the live table:
+        they would end up on the retired table and block its drop.
+        An UNLOGGED staging table is made LOGGED first, outside the swap, as that rewrites it into the WAL.
+
+        Parameters:
+        ----------
+            - destination_table_name (str): The name of the live table to be replaced.
+        """
+
+        staging_table_name = f'{destination_table_name}_staging'
+        retired_table_name = f'{destination_table_name}_retired'
+
+        if self.local_data_engine.dialect.name == 'postgresql':
+            with self.local_data_engine.begin() as connection:
+                # A live UNLOGGED table would be truncated after a crash and missing from the standbys
+                if connection.execute(text("SELECT relpersistence = 'u' FROM pg_class WHERE oid = to_regclass(:table_name)"),
+                                      {'table_name': staging_table_name}).scalar():
+                    connection.execute(text(f'ALTER TABLE "{staging_table_name}" SET LOGGED'))
+
+        with self.local_data_engine.begin() as connection:
+            if connection.dialect.name == 'postgresql':
+                # Give up rather than queue behind a long-running query and block every reader behind the swap
+                connection.execute(text("SET LOCAL lock_timeout = '10s'"))
+
+            # A retired table left behind by an earlier failed drop is checked as well, as dropping it here would fail
+            dependents = self.find_dependent_objects(connection, destination_table_name) + self.find_dependent_objects(connection, retired_table_name)
+            if dependents:
+                raise ValueError(f"cannot swap {destination_table_name}, it is referenced by {', '.join(dependents)}; "
+                                 'drop these first, e.g. with --build-schema, which rebuilds the foreign keys after loading')
+            
+            connection.execute(text(f'DROP TABLE IF EXISTS "{retired_table_name}"'))
+            if inspect(connection).has_table(destination_table_name):
+                connection.execute(text(f'ALTER TABLE "{destination_table_name}" RENAME TO "{retired_table_name}"'))
+            connection.execute(text(f'ALTER TABLE "{staging_table_name}" RENAME TO "{destination_table_name}"'))
+
+            # The swapped-in rows were not hashed, so the next 'hash_diff' load has to be a full one
+            self.forget_row_hashes(connection, destination_table_name)
+        
+        # Drop the old table outside the swap transaction so its lock is not held any longer than the renames
+        with self.local_data_engine.begin() as connection:
+            connection.execute(text(f'DROP TABLE IF EXISTS "{retired_table_name}"'))
+
+    def find_dependent_objects(self, connection, table_name):
+        """
+        Lists the foreign keys and views of other tables that reference a table, on PostgreSQL or SQLite.
+
+        Parameters:
+        ----------
+            - connection (sqlalchemy.engine.Connection): Open connection to the local database.
+            - table_name (str): The name of the referenced table.
+
+        Returns:
+            - list: Descriptions such as 'foreign key fk_orders_users on orders_table' or 'view sales_view', empty if the table does not exist.
+        """
+
+        if connection.dialect.name == 'sqlite':
+            # SQLite keeps no dependency catalogue: views are found by name in their SQL, foreign keys through the pragma
+            dependents = []
+            for name, object_type, sql in connection.execute(text("SELECT name, type, sql FROM sqlite_master WHERE type IN ('table', 'view') AND name <> :table_name"),
+                                                             {'table_name': table_name}).all():
+                if object_type == 'view' and re.search(rf'\b{re.escape(table_name)}\b', sql or '', re.IGNORECASE):
+                    dependents.append(f'view {name}')
+                elif object_type == 'table':
+                    referenced_tables = {row[2] for row in connection.execute(text(f'PRAGMA foreign_key_list("{name}")'))}
+                    if table_name in referenced_tables:
+                        dependents.append(f'foreign key on {name}')
+            return dependents
+
+        if connection.dialect.name != 'postgresql':
+            return []
+
+        foreign_keys = connection.execute(text(
+            'SELECT conname, conrelid::regclass::text FROM pg_constraint '
+            "WHERE contype = 'f' AND confrelid = to_regclass(:table_name) AND conrelid <> confrelid"), {'table_name': table_name})
+        views = connection.execute(text(
+            'SELECT DISTINCT dependent.relname FROM pg_depend '
+            'JOIN pg_rewrite ON pg_rewrite.oid = pg_depend.objid '
+            'JOIN pg_class dependent ON dependent.oid = pg_rewrite.ev_class '
+            'WHERE pg_depend.refobjid = to_regclass(:table_name) AND dependent.oid <> pg_depend.refobjid'), {'table_name': table_name})
+
+        return ([f'foreign key {constraint_name} on {referencing_table}' for constraint_name, referencing_table in foreign_keys]
+                + [f'view {view_name}' for view_name in views.scalars()])
     
+    def load_changed_rows(self, df, destination_table_name, business_key):
+        """
+        Hashes every row, compares the hashes with those stored from the previous load and 
+        writes only the inserted, updated and deleted rows in one transaction.
+        Falls back to a full replace on the first load, when the columns or their types change (e.g. after the star schema script)
+        or when the business key is not unique.
+
+        Parameters:
+        ----------
+            - df (pandas.DataFrame): Dataframe to be uploaded.
+            - destination_table_name (str): The name of the destination table.
+            - business_key (str): Column identifying a row across loads.
+
+        Returns:
+            - bool: True if the destination table was modified.
+        """
+
+        # One vectorised 64-bit hash per row, stored as a signed BIGINT
+        current_hashes = pd.DataFrame({
+            'business_key': df[business_key].astype(str).to_numpy(),
+            'row_hash': pd.util.hash_pandas_object(df, index=False).to_numpy().view('int64'),
+        })
+
+        inspector = inspect(self.local_data_engine)
+        live_columns = inspector.get_columns(destination_table_name) if inspector.has_table(destination_table_name) else []
+        full_load = (
+            not live_columns
+            or not inspector.has_table(row_hashes_table)
+            or not inspector.has_table(row_hash_columns_table)
+            or [column['name'] for column in live_columns] != list(df.columns)
+            or current_hashes['business_key'].duplicated().any()
+        )
+
+        if not full_load:
+            # The hashes only describe the table while nothing else has changed its column types
+            with self.local_data_engine.connect() as connection:
+                hashed_columns = connection.execute(text(f'SELECT column_types FROM {row_hash_columns_table} WHERE table_name = :table_name'),
+                                                    {'table_name': destination_table_name}).scalar()
+            full_load = hashed_columns != self._column_types(live_columns)
+
+        if not full_load:
+            previous_hashes = pd.read_sql(text(f'SELECT business_key, row_hash FROM {row_hashes_table} WHERE table_name = :table_name'),
+                                          self.local_data_engine, params={'table_name': destination_table_name})
+            full_load = previous_hashes.empty
+
+        if full_load:
+            with self.local_data_engine.begin() as connection:
+                df.to_sql(name=destination_table_name, con=connection, if_exists='replace', index=False)
+                self._replace_row_hashes(connection, destination_table_name, current_hashes)
+            logging.info(f'{destination_table_name} fully loaded ({len(df)} rows), row hashes stored')
+            return True
+
+        # Outer join on the business key tells inserts, updates and deletes apart
+        comparison = current_hashes.merge(previous_hashes, on='business_key', how='outer', suffixes=('', '_previous'), indicator=True)
+        inserted = comparison['_merge'] == 'left_only'
+        deleted = comparison['_merge'] == 'right_only'
+        updated = (comparison['_merge'] == 'both') & (comparison['row_hash'] != comparison['row_hash_previous'])
+
+        if not (inserted.any() or deleted.any() or updated.any()):
+            logging.info(f'{destination_table_name} unchanged, nothing written')
+            return False
+
+        stale_keys = comparison.loc[deleted | updated, ['business_key']]
+        new_keys = comparison.loc[inserted | updated, 'business_key']
+        new_rows = df[current_hashes['business_key'].isin(new_keys).to_numpy()]
+        new_hashes = current_hashes[current_hashes['business_key'].isin(new_keys)]
+        delta_keys_table = f'{destination_table_name}_delta_keys'
+        # The keys are cast to the column type, not the column to text, so the primary key index can be used
+        key_type = next(column['type'] for column in live_columns if column['name'] == business_key).compile(dialect=self.local_data_engine.dialect)
+
+        with self.local_data_engine.begin() as connection:
+            # Remove deleted and outdated rows, then append the new versions
+            stale_keys.to_sql(name=delta_keys_table, con=connection, if_exists='replace', index=False)
+            connection.execute(text(f'DELETE FROM {destination_table_name} WHERE "{business_key}" IN (SELECT CAST(business_key AS {key_type}) FROM {delta_keys_table})'))
+            connection.execute(text(f'DELETE FROM {row_hashes_table} WHERE table_name = :table_name AND business_key IN (SELECT business_key FROM {delta_keys_table})'),
+                               {'table_name': destination_table_name})
+            connection.execute(text(f'DROP TABLE {delta_keys_table}'))
+            
+            new_rows.to_sql(name=destination_table_name, con=connection, if_exists='append', index=False)
+            new_hashes.assign(table_name=destination_table_name).to_sql(name=row_hashes_table, con=connection, if_exists='append', index=False)
+
+        logging.info(f'{destination_table_name} delta: {inserted.sum()} inserted, {updated.sum()} updated, {deleted.sum()} deleted')
+        return True
+
+    def forget_row_hashes(self, connection, destination_table_name):
+        """
+        Deletes the stored row hashes of a dimension table written other than by load_changed_rows,
+        so the next 'hash_diff' load compares against nothing and replaces the table in full.
+
+        Parameters:
+        ----------
+            - connection (sqlalchemy.engine.Connection): Connection inside the transaction writing the table.
+            - destination_table_name (str): The name of the table being written.
+        """
+
+        if destination_table_name in dimension_business_keys and inspect(connection).has_table(row_hashes_table):
+            connection.execute(text(f'DELETE FROM {row_hashes_table} WHERE table_name = :table_name'), {'table_name': destination_table_name})
+
+    def _column_types(self, columns):
+        """ Describes the names and types of reflected columns as one string, e.g. 'product_code VARCHAR(11), weight FLOAT'."""
+        return ', '.join(f"{column['name']} {column['type']}" for column in columns)
+
+    def _replace_row_hashes(self, connection, destination_table_name, row_hashes):
+        """ Replaces the stored row hashes of one table, together with the column types they were computed against."""
+        connection.execute(text(f'CREATE TABLE IF NOT EXISTS {row_hashes_table} '
+                                '(table_name VARCHAR(255) NOT NULL, business_key TEXT NOT NULL, row_hash BIGINT NOT NULL, '
+                                'PRIMARY KEY (table_name, business_key))'))
+        connection.execute(text(f'CREATE TABLE IF NOT EXISTS {row_hash_columns_table} '
+                                '(table_name VARCHAR(255) PRIMARY KEY, column_types TEXT NOT NULL)'))
+        connection.execute(text(f'DELETE FROM {row_hashes_table} WHERE table_name = :table_name'), {'table_name': destination_table_name})
+        connection.execute(text(f'DELETE FROM {row_hash_columns_table} WHERE table_name = :table_name'), {'table_name': destination_table_name})
+        row_hashes.assign(table_name=destination_table_name).to_sql(name=row_hashes_table, con=connection, if_exists='append', index=False)
+        connection.execute(text(f'INSERT INTO {row_hash_columns_table} (table_name, column_types) VALUES (:table_name, :column_types)'),
+                           {'table_name': destination_table_name, 'column_types': self._column_types(inspect(connection).get_columns(destination_table_name))})
+
+    def add_partition_key(self, df, destination_table_name):
+        """
+        Adds the first day of the month of every row, looked up through date_uuid in the already loaded date dimension.
+        Rows without a known year and month get NaT and land in the DEFAULT partition.
+
+        Parameters:
+        ----------
+            - df (pandas.DataFrame): Fact rows with a date_uuid column.
+            - destination_table_name (str): A table listed in partitioned_tables.
+
+        Returns:
+            - pandas.DataFrame: A copy of the dataframe with the partition column added.
+        """
+
+        partition_column, dates_table = partitioned_tables[destination_table_name]
+        dates = pd.read_sql(text(f'SELECT date_uuid, year, month FROM {dates_table}'), self.local_data_engine)
+        dates = dates.drop_duplicates('date_uuid')
+
+        months = pd.to_datetime(pd.DataFrame({'year': dates['year'], 'month': dates['month'], 'day': 1}), errors='coerce')
+        month_by_date = pd.Series(months.to_numpy(), index=dates['date_uuid'].astype(str))
+        return df.assign(**{partition_column: df['date_uuid'].astype(str).map(month_by_date).astype('datetime64[ns]')})
+
+    def load_partitioned(self, df, destination_table_name):
+        """
+        Loads a fact table as monthly range partitions, partitioned by the year and month of its date_uuid.
+        Each month is hashed; only months whose hash differs from the previous load are loaded into a staging table
+        and exchanged for the live partition with DETACH and ATTACH, and months that disappeared are dropped.
+        Other databases than PostgreSQL get a plain replace with the partition column.
+
+        Parameters:
+        ----------
+            - df (pandas.DataFrame): Dataframe to be uploaded.
+            - destination_table_name (str): A table listed in partitioned_tables.
+
+        Returns:
+            - bool: True if any partition was modified.
+        """
+
+        partition_column = partitioned_tables[destination_table_name][0]
+        df = self.add_partition_key(df, destination_table_name)
+
+        if self.local_data_engine.dialect.name != 'postgresql':
+            logging.warning(f'{destination_table_name} not partitioned, declarative partitioning needs PostgreSQL')
+            df.to_sql(name=destination_table_name, con=self.local_data_engine, if_exists='replace', index=False)
+            return True
+
+        stored_hashes = self._prepare_partitioned_table(df, destination_table_name, partition_column)
+
+        with self.local_data_engine.connect() as connection:
+            existing_partitions = set(connection.execute(text(
+                'SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+                'WHERE pg_inherits.inhparent = CAST(:table_name AS regclass)'), {'table_name': destination_table_name}).scalars())
+
+        partitions, content_hashes, changed_partitions, dropped_partitions = self.plan_partitions(
+            df, destination_table_name, partition_column, existing_partitions, stored_hashes)
+
+        for partition_name in changed_partitions:
+            bounds, rows = partitions[partition_name]
+            self._replace_partition(destination_table_name, partition_name, bounds, rows, partition_column)
+
+        with self.local_data_engine.begin() as connection:
+            # As in _replace_partition, give up rather than queue behind a long-running query on the fact table
+            connection.execute(text("SET LOCAL lock_timeout = '10s'"))
+            for partition_name in dropped_partitions:
+                connection.execute(text(f'ALTER TABLE {destination_table_name} DETACH PARTITION "{partition_name}"'))
+                connection.execute(text(f'DROP TABLE "{partition_name}"'))
+
+            connection.execute(text(f'DELETE FROM {partition_hashes_table} WHERE table_name = :table_name'), {'table_name': destination_table_name})
+            pd.DataFrame({
+                'table_name': destination_table_name,
+                'partition_name': list(content_hashes),
+                'content_hash': list(content_hashes.values()),
+                'rows': [len(rows) for _, rows in partitions.values()],
+            }).to_sql(name=partition_hashes_table, con=connection, if_exists='append', index=False)
+
+        logging.info(f'{destination_table_name}: {len(changed_partitions)} of {len(partitions)} partitions replaced, {len(dropped_partitions)} dropped')
+        return bool(changed_partitions or dropped_partitions)
+
+    @staticmethod
+    def plan_partitions(df, destination_table_name, partition_column, existing_partitions, stored_hashes):
+        """
+        Groups the rows of a fact table by month and compares every month with the previous load, without touching the database.
+
+        Parameters:
+        ----------
+            - df (pandas.DataFrame): Fact rows with the partition column added by add_partition_key.
+            - destination_table_name (str): Name of the partitioned table, used as the prefix of the partition names.
+            - partition_column (str): Datetime column holding the first day of the month; NaT rows go to the DEFAULT partition.
+            - existing_partitions (set): Names of the partitions currently attached.
+            - stored_hashes (dict): Partition names mapped to their content hashes from the previous load.
+
+        Returns:
+            - tuple: Partition names mapped to (bounds, rows), with bounds None for the DEFAULT partition;
+              partition names mapped to their content hashes; the names of the partitions to replace;
+              and the names of the existing partitions to drop.
+        """
+
+        # One group per month, plus the rows without a month for the DEFAULT partition
+        months = df[partition_column].dt.to_period('M')
+        partitions = {}
+        for month, rows in df.groupby(months, sort=True, dropna=False):
+            if pd.isna(month):
+                partitions[f'{destination_table_name}_pdefault'] = (None, rows)
+            else:
+                bounds = (month.start_time.strftime('%Y-%m-%d'), (month + 1).start_time.strftime('%Y-%m-%d'))
+                partitions[f"{destination_table_name}_p{month.strftime('%Y%m')}"] = (bounds, rows)
+
+        # Order-independent content hash of every month
+        content_hashes = {partition_name: int(pd.util.hash_pandas_object(rows, index=False).to_numpy().view('int64').sum())
+                          for partition_name, (_, rows) in partitions.items()}
+
+        changed_partitions = [partition_name for partition_name in partitions
+                              if partition_name not in existing_partitions or stored_hashes.get(partition_name) != content_hashes[partition_name]]
+        dropped_partitions = sorted(set(existing_partitions) - set(partitions))
+        return partitions, content_hashes, changed_partitions, dropped_partitions
+
+    def _prepare_partitioned_table(self, df, destination_table_name, partition_column):
+        """
+        Makes sure the destination is a partitioned table with the dataframe's columns, recreating it if it is a plain table
+        or its columns changed. Recreating is refused while views or foreign keys depend on the table.
+
+        Returns:
+            - dict: Partition names mapped to their stored content hashes, empty when the table was recreated.
+        """
+
+        with self.local_data_engine.begin() as connection:
+            connection.execute(text(f'CREATE TABLE IF NOT EXISTS {partition_hashes_table} '
+                                    '(table_name VARCHAR(255) NOT NULL, partition_name VARCHAR(255) NOT NULL, content_hash BIGINT NOT NULL, '
+                                    'rows BIGINT NOT NULL, PRIMARY KEY (table_name, partition_name))'))
+            is_partitioned = connection.execute(text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:table_name)"),
+                                                {'table_name': destination_table_name}).scalar()
+            columns = [column['name'] for column in inspect(connection).get_columns(destination_table_name)] if is_partitioned is not None else []
+
+        if is_partitioned and columns == list(df.columns):
+            with self.local_data_engine.connect() as connection:
+                rows = connection.execute(text(f'SELECT partition_name, content_hash FROM {partition_hashes_table} WHERE table_name = :table_name'),
+                                          {'table_name': destination_table_name})
+                return {partition_name: content_hash for partition_name, content_hash in rows}
+
+        # Views and foreign keys built on the old table would have to be dropped along with it
+        with self.local_data_engine.connect() as connection:
+            dependents = self.find_dependent_objects(connection, destination_table_name)
+        if dependents:
+            raise ValueError(f"cannot recreate {destination_table_name} as a partitioned table, it is referenced by {', '.join(dependents)}")
+
+        # Create the parent from an empty template carrying the column types pandas would give the table
+        template_table_name = f'{destination_table_name}_template'
+        df.head(0).to_sql(name=template_table_name, con=self.local_data_engine, if_exists='replace', index=False)
+        with self.local_data_engine.begin() as connection:
+            connection.execute(text(f'DROP TABLE IF EXISTS {destination_table_name}'))
+            connection.execute(text(f'CREATE TABLE {destination_table_name} (LIKE {template_table_name} INCLUDING DEFAULTS) '
+                                    f'PARTITION BY RANGE ({partition_column})'))
+            connection.execute(text(f'DROP TABLE {template_table_name}'))
+            connection.execute(text(f'DELETE FROM {partition_hashes_table} WHERE table_name = :table_name'), {'table_name': destination_table_name})
+        logging.info(f'{destination_table_name} recreated as a table partitioned by {partition_column}')
+        return {}
+
+    def _replace_partition(self, destination_table_name, partition_name, bounds, rows, partition_column):
+        """
+        Loads one month into a staging table and exchanges it for the live partition in one short transaction.
+        A CHECK constraint matching the bounds lets ATTACH PARTITION skip its validation scan. The DEFAULT partition keeps
+        a permanent CHECK that its partition column is NULL, which also spares it the scan PostgreSQL otherwise makes
+        whenever a range partition is attached next to it, so the partitions can be exchanged in any order.
+        """
+
+        staging_table_name = f'{partition_name}_staging'
+        with self.local_data_engine.begin() as connection:
+            connection.execute(text(f'DROP TABLE IF EXISTS "{staging_table_name}"'))
+            connection.execute(text(f'CREATE TABLE "{staging_table_name}" (LIKE {destination_table_name} INCLUDING DEFAULTS)'))
+            if bounds:
+                connection.execute(text(f'ALTER TABLE "{staging_table_name}" ADD CONSTRAINT "{partition_name}_bounds" '
+                                        f"CHECK ({partition_column} IS NOT NULL AND {partition_column} >= '{bounds[0]}' AND {partition_column} < '{bounds[1]}')"))
+            else:
+                connection.execute(text(f'ALTER TABLE "{staging_table_name}" ADD CONSTRAINT "{partition_name}_no_month" '
+                                        f'CHECK ({partition_column} IS NULL)'))
+
+        rows.to_sql(name=staging_table_name, con=self.local_data_engine, if_exists='append', index=False, chunksize=10000)
+
+        with self.local_data_engine.begin() as connection:
+            # Give up rather than queue behind a long-running query and block every reader of the fact table
+            connection.execute(text("SET LOCAL lock_timeout = '10s'"))
+            if connection.execute(text('SELECT to_regclass(:partition_name) IS NOT NULL'), {'partition_name': f'"{partition_name}"'}).scalar():
+                connection.execute(text(f'ALTER TABLE {destination_table_name} DETACH PARTITION "{partition_name}"'))
+                connection.execute(text(f'DROP TABLE "{partition_name}"'))
+            connection.execute(text(f'ALTER TABLE "{staging_table_name}" RENAME TO "{partition_name}"'))
+
+            partition_bounds = f"FOR VALUES FROM ('{bounds[0]}') TO ('{bounds[1]}')" if bounds else 'DEFAULT'
+            connection.execute(text(f'ALTER TABLE {destination_table_name} ATTACH PARTITION "{partition_name}" {partition_bounds}'))
+            if bounds:
+                connection.execute(text(f'ALTER TABLE "{partition_name}" DROP CONSTRAINT "{partition_name}_bounds"'))
+
+    def record_load_version(self, destination_table_name):
+        """
+        Increments the load version of a table in the etl_load_versions table.
+
+        Parameters:
+        ----------
+            - destination_table_name (str): The name of the table that has just been loaded.
+        """
+
+        with self.local_data_engine.begin() as connection:
+            connection.execute(text(f'CREATE TABLE IF NOT EXISTS {load_versions_table} '
+                                    '(table_name VARCHAR(255) PRIMARY KEY, version INTEGER NOT NULL, loaded_at TIMESTAMP)'))
+            connection.execute(text(f'INSERT INTO {load_versions_table} (table_name, version, loaded_at) '
+                                    'VALUES (:table_name, 1, CURRENT_TIMESTAMP) '
+                                    f'ON CONFLICT (table_name) DO UPDATE SET version = {load_versions_table}.version + 1, loaded_at = CURRENT_TIMESTAMP'),
+                               {'table_name': destination_table_name})
+
+    def read_load_versions(self, with_loaded_at=False):
+        """
+        Returns the current load version of every table loaded by the pipeline.
+
+        Parameters:
+        ----------
+            - with_loaded_at (bool): Also return when each version was loaded. Versions restart at 1 in a new database,
+              so the time tells apart the same version number loaded into different databases.
+
+        Returns:
+            - dict: Table names mapped to their load version, or to (version, loaded_at) tuples, empty if nothing has been recorded yet.
+        """
+
+        try:
+            if not inspect(self.local_data_engine).has_table(load_versions_table):
+                return {}
+            with self.local_data_engine.connect() as connection:
+                rows = connection.execute(text(f'SELECT table_name, version, loaded_at FROM {load_versions_table}'))
+                return {table_name: (version, str(loaded_at)) if with_loaded_at else version for table_name, version, loaded_at in rows}
+        
+        except Exception as e:
+            logging.error(f'Error in database_utils method read_load_versions: {e}')
+            return {}
+
 # Main Execution    
 if __name__ == "__main__":
     # Instantiating the DatabaseConnector
@@ -0,0 +1,541 @@
+"""
+File: load_test_harness.py
+Purpose: Putting the whole pipeline on the treadmill without going anywhere near the real sources.
+Author: Zulfia
+Date: January 2024
+
+# Example: `python load_test_harness.py --scales 1 5 --store-latency 0.02 --store-error-rate 0.01 --target-url postgresql://etl@localhost/etl_load_test -- --load-mode swap`
+# Only a PostgreSQL target gives meaningful load numbers; the SQLite default just checks the pipeline runs end to end.
+"""
+
+# External Libraries
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+import yaml
+from sqlalchemy import create_engine, inspect, text
+
+# Internal Libraries and Credentials
+from database_utils import aws_credentials_file, local_credentials_file
+import main as pipeline
+
+# Logging Configuration
+logging.basicConfig(level=logging.INFO)
+
+# Rows generated per source at scale 1, roughly the size of the real data sets
+base_row_counts = {
+    'users': 15000,
+    'orders': 120000,
+    'stores': 450,
+    'products': 1850,
+    'cards': 15000,
+}
+
+# Destination table written by each pipeline stage
+stage_tables = {
+    'etl_of_users_data': 'dim_users',
+    'etl_of_cards_data': 'dim_card_details',
+    'etl_of_stores_data': 'dim_store_details',
+    'etl_of_products_data': 'dim_products',
+    'etl_of_orders_data': 'orders_table',
+    'run_sharded_orders': 'orders_table',
+    'etl_of_datetimes_data': 'dim_date_times',
+    'pipelined_users_data': 'dim_users',
+    'pipelined_stores_data': 'dim_store_details',
+    'pipelined_products_data': 'dim_products',
+    'pipelined_orders_data': 'orders_table',
+    'pipelined_datetimes_data': 'dim_date_times',
+}
+
+# Names the stand-ins serve the files under
+s3_bucket = 'data-handling-public'
+products_key = 'products.csv'
+cards_path = '/files/card_details.pdf'
+dates_path = '/files/date_details.json'
+
+# Environment variable holding the default destination database URL, e.g. postgresql://etl@localhost/etl_load_test
+target_url_variable = 'ETL_LOAD_TEST_TARGET_URL'
+
+
+def generate_source_data(scale=1.0, seed=0):
+    """
+    Generates synthetic source data shaped like the real sources, including the junk rows the cleaning removes.
+    Orders reference the generated users, cards, stores, products and dates.
+
+    Parameters:
+    ----------
+        - scale (float): Multiplier applied to base_row_counts.
+        - seed (int): Seed of the random generator, so runs at the same scale see the same data.
+
+    Returns:
+        - dict: DataFrames keyed 'users', 'orders', 'stores', 'products', 'cards' and 'dates'.
+    """
+    rng = np.random.default_rng(seed)
+    counts = {name: max(1, int(count * scale)) for name, count in base_row_counts.items()}
+
+    def uuids(count):
+        return [str(uuid.UUID(int=int(value), version=4)) for value in rng.integers(0, 2**63, count)]
+
+    def junk_rows(df, share, value):
+        # Overwrite a share of the rows with 'NULL' strings or garbage codes, as found in the real sources
+        rows = rng.random(len(df)) < share
+        df.loc[rows, df.columns.difference(['index'])] = value
+        return df
+
+    countries = np.array([('United Kingdom', 'GB'), ('Germany', 'DE'), ('United States', 'US')])
+    country_rows = rng.integers(0, len(countries), counts['users'])
+    user_uuids = uuids(counts['users'])
+    dates_of_birth = pd.Timestamp('1940-01-01') + pd.to_timedelta(rng.integers(0, 60 * 365, counts['users']), unit='D')
+    join_dates = pd.Timestamp('1992-01-01') + pd.to_timedelta(rng.integers(0, 30 * 365, counts['users']), unit='D')
+    users = pd.DataFrame({
+        'index': np.arange(counts['users']),
+        'first_name': rng.choice(['Sigfried', 'Guy', 'Harry', 'Jessica', 'Ann'], counts['users']),
+        'last_name': rng.choice(['Noack', 'Allen', 'Lawrence', 'Bauer', 'Moore'], counts['users']),
+        'date_of_birth': [day.strftime('%Y %B %d') if position % 10 == 0 else day.strftime('%Y-%m-%d') for position, day in enumerate(dates_of_birth)],
+        'company': rng.choice(['Heydrich Junitz KG', 'Taylor Ltd', 'Bauer GmbH'], counts['users']),
+        'email_address': [f'user{position}@example.com' for position in range(counts['users'])],
+        'address': [f'{position} High Street' for position in range(counts['users'])],
+        'country': countries[country_rows, 0],
+        'country_code': np.where((countries[country_rows, 1] == 'GB') & (rng.random(counts['users']) < 0.05), 'GGB', countries[country_rows, 1]),
+        'phone_number': [f'+44 (0){7000000000 + position}' for position in range(counts['users'])],
+        'join_date': [day.strftime('%Y/%m/%d') if position % 7 == 0 else day.strftime('%Y-%m-%d') for position, day in enumerate(join_dates)],
+        'user_uuid': user_uuids,
+    })
+    users = junk_rows(junk_rows(users, 0.01, 'NULL'), 0.001, 'GMRBOMI0O1')
+
+    card_numbers = rng.integers(10**11, 10**16, counts['cards']).astype(str)
+    cards = pd.DataFrame({
+        'card_number': np.where(rng.random(counts['cards']) < 0.02, np.char.add('???', card_numbers), card_numbers),
+        'expiry_date': [f'{month:02d}/{year}' for month, year in zip(rng.integers(1, 13, counts['cards']), rng.integers(24, 31, counts['cards']))],
+        'card_provider': rng.choice(['VISA 16 digit', 'JCB 16 digit', 'Mastercard', 'American Express'], counts['cards']),
+        'date_payment_confirmed': (pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.integers(0, 3000, counts['cards']), unit='D')).strftime('%Y-%m-%d'),
+    })
+    cards = junk_rows(junk_rows(cards, 0.01, 'NULL'), 0.002, 'NB71VBAHJE')
+
+    store_codes = ['WEB-1388012W' if position == 0 else f'{rng.choice(["SO", "BL", "CH", "MI"])}-{position:08X}' for position in range(counts['stores'])]
+    stores = pd.DataFrame({
+        'index': np.arange(counts['stores']),
+        'address': [f'{position} Market Square' for position in range(counts['stores'])],
+        'longitude': rng.uniform(-5, 10, counts['stores']).round(5).astype(str),
+        'lat': None,
+        'locality': rng.choice(['High Wycombe', 'Belper', 'Freiburg', 'Chapletown'], counts['stores']),
+        'store_code': store_codes,
+        'staff_numbers': [f'J{value}' if value % 50 == 0 else str(value) for value in rng.integers(5, 100, counts['stores'])],
+        'opening_date': (pd.Timestamp('1995-01-01') + pd.to_timedelta(rng.integers(0, 9000, counts['stores']), unit='D')).strftime('%Y-%m-%d'),
+        'store_type': rng.choice(['Local', 'Super Store', 'Mall Kiosk', 'Outlet'], counts['stores']),
+        'latitude': rng.uniform(40, 58, counts['stores']).round(5).astype(str),
+        'country_code': rng.choice(['GB', 'DE', 'US'], counts['stores']),
+        'continent': rng.choice(['Europe', 'America', 'eeEurope', 'eeAmerica'], counts['stores'], p=[0.55, 0.4, 0.03, 0.02]),
+    })
+    stores.loc[rng.random(counts['stores']) < 0.02, 'country_code'] = 'YELVM536YT'
+
+    product_codes = [f'{rng.choice(list("ABCDEFGHIJ"))}{rng.integers(0, 10)}-{position}{rng.choice(list("abcdef"))}' for position in range(counts['products'])]
+    products = pd.DataFrame({
+        'Unnamed: 0': np.arange(counts['products']),
+        'product_name': [f'Product {position}' for position in range(counts['products'])],
+        'product_price': [f'£{value:.2f}' for value in rng.uniform(1, 200, counts['products'])],
+        'weight': rng.choice(['1.6kg', '12 x 100g', '500ml', '16oz', '590g', '0.45kg', '3 x 2g'], counts['products']),
+        'category': rng.choice(['toys-and-games', 'homeware', 'pets', 'food-and-drink', 'health-and-beauty'], counts['products']),
+        'EAN': rng.integers(10**12, 10**13, counts['products']).astype(str),
+        'date_added': (pd.Timestamp('2005-01-01') + pd.to_timedelta(rng.integers(0, 6000, counts['products']), unit='D')).strftime('%Y-%m-%d'),
+        'uuid': uuids(counts['products']),
+        'removed': rng.choice(['Still_avaliable', 'Removed'], counts['products'], p=[0.9, 0.1]),
+        'product_code': product_codes,
+    })
+    products.loc[rng.random(counts['products']) < 0.003, ['product_price', 'weight']] = ['CCAVRB79VV', '9GO9NZ5JTL']
+
+    date_uuids = uuids(counts['orders'])
+    dates = pd.DataFrame({
+        'timestamp': [f'{hour:02d}:{minute:02d}:{second:02d}' for hour, minute, second in rng.integers(0, [24, 60, 60], (counts['orders'], 3))],
+        'month': rng.integers(1, 13, counts['orders']).astype(str),
+        'year': rng.integers(1992, 2023, counts['orders']).astype(str),
+        'day': rng.integers(1, 29, counts['orders']).astype(str),
+        'time_period': rng.choice(['Morning', 'Midday', 'Evening', 'Late_Hours'], counts['orders']),
+        'date_uuid': date_uuids,
+    })
+    dates.loc[rng.random(counts['orders']) < 0.001, ['month', 'year']] = ['NULL', 'NULL']
+
+    valid_users = users['user_uuid'][users['user_uuid'].str.len() == 36].to_numpy()
+    valid_cards = cards['card_number'][cards['card_number'].str.isdigit()].to_numpy()
+    orders = pd.DataFrame({
+        'level_0': np.arange(counts['orders']),
+        'index': np.arange(counts['orders']),
+        'date_uuid': date_uuids,
+        'first_name': None,
+        'last_name': None,
+        'user_uuid': rng.choice(valid_users, counts['orders']),
+        'card_number': rng.choice(valid_cards, counts['orders']).astype(np.int64),
+        'store_code': rng.choice(stores['store_code'].to_numpy(), counts['orders']),
+        'product_code': rng.choice(products['product_code'].to_numpy(), counts['orders']),
+        '1': None,
+        'product_quantity': rng.integers(1, 14, counts['orders']),
+    })
+
+    return {'users': users, 'orders': orders, 'stores': stores, 'products': products, 'cards': cards, 'dates': dates}
+
+
+def build_cards_pdf(df_cards, rows_per_page=50):
+    """
+    Writes the cards table as a plain text PDF, one table with a header row per page, for tabula to read back.
+
+    Returns:
+        - bytes: The PDF document.
+    """
+    column_positions = [40, 160, 250, 400]
+    pages = []
+    for start in range(0, len(df_cards), rows_per_page):
+        rows = [df_cards.columns.tolist()] + df_cards.iloc[start:start + rows_per_page].astype(str).values.tolist()
+        commands = ['BT', '/F1 8 Tf']
+        for row_number, row in enumerate(rows):
+            for x, value in zip(column_positions, row):
+                value = value.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+                commands.append(f'1 0 0 1 {x} {800 - 14 * row_number} Tm ({value}) Tj')
+        commands.append('ET')
+        pages.append('\n'.join(commands).encode('latin-1'))
+
+    # Objects 1-3 are the catalog, the page tree and the font; each page adds a page object and its content stream
+    page_ids = [4 + 2 * position for position in range(len(pages))]
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        f"<< /Type /Pages /Kids [{' '.join(f'{page_id} 0 R' for page_id in page_ids)}] /Count {len(pages)} >>".encode(),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    for page_id, content in zip(page_ids, pages):
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {page_id + 1} 0 R >>'.encode())
+        objects.append(f'<< /Length {len(content)} >>\nstream\n'.encode() + content + b'\nendstream')
+
+    document = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for object_id, body in enumerate(objects, start=1):
+        offsets.append(len(document))
+        document += f'{object_id} 0 obj\n'.encode() + body + b'\nendobj\n'
+    xref_offset = len(document)
+    document += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    document += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode()
+    document += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n'.encode()
+    return bytes(document)
+
+
+# StubServer Class and Methods
+class StubServer:
+    """
+    Class for a local HTTP server standing in for the store API, the public file URLs and S3 GetObject.
+
+    Attributes:
+    ----------
+        - files (dict): Served paths mapped to (body, content type); S3 objects are served path-style as '/<bucket>/<key>'.
+        - stores (list): Store records returned by the store details endpoint.
+        - latency (float): Seconds every store API response is delayed by.
+        - error_rate (float): Share of store details requests answered with a 500 error.
+        - requests_served (int), errors_served (int): Store API counters.
+
+    Methods:
+    --------
+        - __init__(self, files, stores, latency, error_rate, seed): Initialises the StubServer instance.
+        - def start(self): Starts serving on a free local port and returns the base URL.
+        - def stop(self): Stops the server.
+    """
+
+    def __init__(self, files, stores, latency=0.0, error_rate=0.0, seed=0):
+        """
+        Initialises the StubServer instance.
+
+        Parameters:
+        ----------
+            - files (dict): Served paths mapped to (body, content type).
+            - stores (list): Store records, one dictionary per store.
+            - latency (float): Seconds every store API response is delayed by.
+            - error_rate (float): Share of store details requests answered with a 500 error.
+            - seed (int): Seed deciding which requests fail.
+        """
+        self.files = files
+        self.stores = stores
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests_served = 0
+        self.errors_served = 0
+        self.server = None
+
+    def _handler(self):
+        """ Builds the request handler class bound to this server's data."""
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, content_type='application/json'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path in stub.files:
+                    return self._send(200, *stub.files[path])
+
+                if path.startswith('/prod/'):
+                    time.sleep(stub.latency)
+                    with stub.lock:
+                        stub.requests_served += 1
+                        failing = stub.random.random() < stub.error_rate
+                        stub.errors_served += failing
+
+                    if path == '/prod/number_stores':
+                        return self._send(200, json.dumps({'statusCode': 200, 'number_stores': len(stub.stores)}).encode())
+                    store_number = path.rsplit('/', 1)[-1]
+                    if path.startswith('/prod/store_details/') and store_number.isdigit() and int(store_number) < len(stub.stores):
+                        if failing:
+                            return self._send(500, b'{"message": "Internal server error"}')
+                        return self._send(200, json.dumps(stub.stores[int(store_number)]).encode())
+
+                self._send(404, b'<Error><Code>NoSuchKey</Code></Error>', 'application/xml')
+
+        return Handler
+
+    def start(self):
+        """ Starts serving on a free local port. Returns the base URL."""
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def stop(self):
+        """ Stops the server."""
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+# LoadTestHarness Class and Methods
+class LoadTestHarness:
+    """
+    Class for running main.main end to end against local stand-ins of every source at a given data scale.
+
+    Attributes:
+    ----------
+        - scale (float): Multiplier applied to base_row_counts.
+        - store_latency (float): Seconds every store API response is delayed by.
+        - store_error_rate (float): Share of store details requests that fail.
+        - target_url (str): SQLAlchemy URL of the destination database, defaults to a SQLite file in the working directory.
+          UNLOGGED staging, monthly partitions and lock timeouts are skipped on SQLite and its single writer serialises sharded loads,
+          so throughput is only meaningful against a dedicated PostgreSQL database.
+        - keep_files (bool): Whether the working directory is left in place after the run.
+        - seed (int): Seed of the generated data and of the failing requests.
+
+    Methods:
+    --------
+        - __init__(self, scale, store_latency, store_error_rate, target_url, keep_files, seed): Initialises the LoadTestHarness instance.
+        - def start(self): Seeds the sources, starts the stand-ins and writes the configuration files.
+        - def run(self, pipeline_arguments): Runs the pipeline once and returns its throughput report.
+        - def stop(self): Stops the stand-ins and removes the working directory.
+    """
+
+    def __init__(self, scale=1.0, store_latency=0.0, store_error_rate=0.0, target_url=None, keep_files=False, seed=0):
+        """
+        Initialises the LoadTestHarness instance.
+
+        Parameters:
+        ----------
+            - scale (float): Multiplier applied to base_row_counts.
+            - store_latency (float): Seconds every store API response is delayed by.
+            - store_error_rate (float): Share of store details requests that fail.
+            - target_url (str): SQLAlchemy URL of the destination database.
+            - keep_files (bool): Leave the working directory in place after the run.
+            - seed (int): Seed of the generated data and of the failing requests.
+        """
+        self.scale = scale
+        self.store_latency = store_latency
+        self.store_error_rate = store_error_rate
+        self.target_url = target_url
+        self.keep_files = keep_files
+        self.seed = seed
+        self.working_directory = None
+        self.stub_server = None
+        self.base_url = None
+        self.source_rows = {}
+        self.saved_environment = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """ Seeds the SQLite source, starts the stub server and writes the credential and API files the pipeline reads."""
+        self.working_directory = tempfile.mkdtemp(prefix='etl_load_test_')
+        os.makedirs(os.path.join(self.working_directory, 'csv_files'))
+
+        data = generate_source_data(self.scale, self.seed)
+        self.source_rows = {name: len(df) for name, df in data.items()}
+
+        source_url = f"sqlite:///{os.path.join(self.working_directory, 'source.db')}"
+        source_engine = create_engine(source_url)
+        data['users'].to_sql('legacy_users', source_engine, index=False, chunksize=10000)
+        data['orders'].to_sql('orders_table', source_engine, index=False, chunksize=10000)
+        source_engine.dispose()
+
+        # The date details JSON is column oriented, like the real file
+        dates_json = json.dumps({column: {str(row): value for row, value in enumerate(values)} for column, values in data['dates'].items()})
+        files = {
+            cards_path: (build_cards_pdf(data['cards']), 'application/pdf'),
+            dates_path: (dates_json.encode(), 'application/json'),
+            f'/{s3_bucket}/{products_key}': (data['products'].to_csv(index=False).encode(), 'text/csv'),
+        }
+        stores = data['stores'].astype(object).where(data['stores'].notna(), None).to_dict('records')
+        self.stub_server = StubServer(files, stores, self.store_latency, self.store_error_rate, self.seed)
+        self.base_url = self.stub_server.start()
+
+        target_url = self.target_url or f"sqlite:///{os.path.join(self.working_directory, 'target.db')}"
+        if not target_url.startswith('postgresql'):
+            logging.warning(f'load test target is {target_url.split(":", 1)[0]}, not PostgreSQL: the throughput report does not reflect production loads')
+        configuration = {
+            aws_credentials_file: {'RDS_URL': source_url},
+            local_credentials_file: {'URL': target_url},
+            'api_config.yaml': {
+                'api_key': 'load-test',
+                'number_of_stores_endpoint': f'{self.base_url}/prod/number_stores',
+                'store_details_endpoint': f'{self.base_url}/prod/store_details/',
+            },
+        }
+        for file_name, content in configuration.items():
+            with open(os.path.join(self.working_directory, file_name), 'w') as config_file:
+                yaml.safe_dump(content, config_file)
+
+        # boto3 sends S3 requests to AWS_ENDPOINT_URL, path-style for a local endpoint
+        environment = {
+            'AWS_ENDPOINT_URL': self.base_url,
+            'AWS_ACCESS_KEY_ID': 'load-test',
+            'AWS_SECRET_ACCESS_KEY': 'load-test',
+            'AWS_DEFAULT_REGION': 'eu-west-1',
+        }
+        for name, value in environment.items():
+            self.saved_environment[name] = os.environ.get(name)
+            os.environ[name] = value
+
+        logging.info(f'load test sources ready at scale {self.scale}: {self.source_rows}')
+
+    def run(self, pipeline_arguments=()):
+        """
+        Runs the pipeline once inside the working directory.
+
+        Parameters:
+        ----------
+            - pipeline_arguments (list): Extra main.py options, e.g. ['--load-mode', 'swap'].
+
+        Returns:
+            - list: One dictionary per stage with its seconds, rows loaded and rows per second, plus an 'end_to_end' row.
+        """
+        argv = list(pipeline_arguments) + [
+            '--pdf-url', f'{self.base_url}{cards_path}',
+            '--json-url', f'{self.base_url}{dates_path}',
+            '--s3-address', f's3://{s3_bucket}/{products_key}',
+        ]
+
+        previous_directory = os.getcwd()
+        os.chdir(self.working_directory)
+        try:
+            run_report = pipeline.main(argv)
+            table_rows = self._count_target_rows()
+        finally:
+            os.chdir(previous_directory)
+
+        report = []
+        for stage_name, seconds in run_report['stages'].items():
+            table_name = stage_tables.get(stage_name)
+            rows = run_report['loads'].get(table_name, {}).get('rows', table_rows.get(table_name, 0))
+            report.append({'scale': self.scale, 'stage': stage_name, 'table': table_name, 'seconds': seconds,
+                           'rows': rows, 'rows_per_second': rows / seconds if seconds else None})
+
+        total_rows = sum(row['rows'] for row in report)
+        report.append({'scale': self.scale, 'stage': 'end_to_end', 'table': None, 'seconds': run_report['seconds'],
+                       'rows': total_rows, 'rows_per_second': total_rows / run_report['seconds'] if run_report['seconds'] else None})
+
+        logging.info(f'store API served {self.stub_server.requests_served} requests, {self.stub_server.errors_served} failed on purpose')
+        return report
+
+    def _count_target_rows(self):
+        """ Counts the rows of every destination table present in the target database."""
+        with open(local_credentials_file, 'r') as credentials:
+            engine = create_engine(yaml.safe_load(credentials)['URL'])
+        try:
+            existing_tables = set(inspect(engine).get_table_names())
+            with engine.connect() as connection:
+                return {table_name: connection.execute(text(f'SELECT COUNT(*) FROM {table_name}')).scalar()
+                        for table_name in set(stage_tables.values()) if table_name in existing_tables}
+        finally:
+            engine.dispose()
+
+    def stop(self):
+        """ Stops the stub server, restores the environment and removes the working directory unless keep_files is set."""
+        if self.stub_server:
+            self.stub_server.stop()
+        for name, value in self.saved_environment.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        self.saved_environment = {}
+
+        if self.working_directory and not self.keep_files:
+            shutil.rmtree(self.working_directory, ignore_errors=True)
+        elif self.working_directory:
+            logging.info(f'load test files kept in {self.working_directory}')
+
+
+def run_load_test(scales, store_latency=0.0, store_error_rate=0.0, target_url=None, pipeline_arguments=(), keep_files=False):
+    """
+    Runs the pipeline once per data scale, each against freshly seeded stand-ins.
+
+    Returns:
+        - pd.DataFrame: The stage reports of every scale.
+    """
+    reports = []
+    for scale in scales:
+        try:
+            with LoadTestHarness(scale, store_latency, store_error_rate, target_url, keep_files) as harness:
+                reports.extend(harness.run(pipeline_arguments))
+        except Exception as e:
+            logging.error(f'Error in load_test_harness at scale {scale}: {e}')
+    return pd.DataFrame(reports)
+
+
+# Main Execution
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Runs the pipeline end to end against local stand-ins at several data scales. '
+                                                 'Options after -- are passed on to main.py.')
+    parser.add_argument('--scales', type=float, nargs='+', default=[1.0], help='Data scales to run, 1 being roughly the real data size.')
+    parser.add_argument('--store-latency', type=float, default=0.0, help='Seconds every store API response is delayed by.')
+    parser.add_argument('--store-error-rate', type=float, default=0.0, help='Share of store details requests answered with an error.')
+    parser.add_argument('--target-url', default=os.environ.get(target_url_variable),
+                        help=f'SQLAlchemy URL of a dedicated PostgreSQL database to load into, needed for meaningful results; '
+                             f'defaults to ${target_url_variable}, else a SQLite file per run.')
+    parser.add_argument('--keep-files', action='store_true', help='Keep the working directory of every run.')
+    parser.add_argument('--report', help='Also write the throughput report to this CSV file.')
+    parser.add_argument('pipeline_arguments', nargs=argparse.REMAINDER, help='Options passed on to main.py.')
+    arguments = parser.parse_args()
+
+    pipeline_arguments = [argument for argument in arguments.pipeline_arguments if argument != '--']
+    report = run_load_test(arguments.scales, arguments.store_latency, arguments.store_error_rate, arguments.target_url,
+                           pipeline_arguments, arguments.keep_files)
+    print(report.to_string(index=False))
+    if arguments.report:
+        report.to_csv(arguments.report, index=False)
+
+# The script ends here
@@ -9,19 +9,36 @@ Date: January 2024
 
 
 # External Libraries
+import argparse
 import logging
+import time
+import pandas as pd
 
 # Internal Libraries and Credentials
 from database_utils import DatabaseConnector, aws_credentials_file, local_credentials_file
 from data_extraction import DataExtractor, pdf_url, json_url, s3_address
 from data_cleaning import DataCleaning
+from schema_builder import SchemaBuilder
+from profiling import StageProfiler
+from sharded_orders import run_sharded_orders
+import pipelining
+from analytics_extract import publish_sales_extract
 
 # Logging Configuration
 logging.basicConfig(level=logging.INFO)
 
+# Table and key column of the dimension loaded by each stage, checked against the orders by --quarantine-orphans
+dimension_key_columns = {
+    'etl_of_users_data': ('dim_users', 'user_uuid'),
+    'etl_of_cards_data': ('dim_card_details', 'card_number'),
+    'etl_of_stores_data': ('dim_store_details', 'store_code'),
+    'etl_of_products_data': ('dim_products', 'product_code'),
+    'etl_of_datetimes_data': ('dim_date_times', 'date_uuid'),
+}
+
 
 # Class Definition and Methods 
-def initialise_classes(aws_credentials_file, local_credentials_file):
+def initialise_classes(aws_credentials_file, local_credentials_file, use_rule_engine=False):
     """
     Initialises instances of DatabaseConnector, DataExtractor, and DataCleaning classes.
 
@@ -29,6 +46,7 @@ def initialise_classes(aws_credentials_file, local_credentials_file):
     ----------
         - aws_credentials_file (str): File path for AWS credentials.
         - local_credentials_file (str): File path for local credentials.
+        - use_rule_engine (bool): Clean with the single-pass CleaningRuleEngine.
 
     Returns:
     --------
@@ -39,7 +57,7 @@ def initialise_classes(aws_credentials_file, local_credentials_file):
     try:
         db_connector = DatabaseConnector(aws_credentials_file, local_credentials_file)
         data_extractor = DataExtractor(db_connector)
-        data_cleaner = DataCleaning(data_extractor)
+        data_cleaner = DataCleaning(data_extractor, use_rule_engine)
         return db_connector, data_extractor, data_cleaner
     
     except Exception as e:
@@ -54,10 +72,15 @@ def etl_of_users_data(db_connector, data_cleaner):
     ----------
         - db_connector (DatabaseConnector): Instance of DatabaseConnector class.
         - data_cleaner (DataCleaning): Instance of DataCleaning class.
+
+    Returns:
+    --------
+        - pd.DataFrame: The cleaned users, or None if the stage failed.
     """
     try: 
         df = data_cleaner.clean_user_data('legacy_users')
         db_connector.upload_to_db(df, 'dim_users')       
+        return df
     
     except Exception as e:
         logging.error(f'Error in main method etl_of_users_data: {e}')
@@ -72,10 +95,15 @@ def etl_of_cards_data(db_connector, data_cleaner, pdf_url):
         - db_connector (DatabaseConnector): Instance of DatabaseConnector class.
         - data_cleaner (DataCleaning): Instance of DataCleaning class.
         - pdf_url (str): URL of the PDF containing card data.
+
+    Returns:
+    --------
+        - pd.DataFrame: The cleaned cards, or None if the stage failed.
     """
     try:
         df = data_cleaner.clean_card_data(pdf_url)
         db_connector.upload_to_db(df, 'dim_card_details')
+        return df
 
     except Exception as e:
         logging.error(f'Error in main method etl_of_cards_data: {e}')
@@ -89,6 +117,10 @@ def etl_of_stores_data(db_connector, data_extractor, data_cleaner):
         - db_connector (DatabaseConnector): Instance of DatabaseConnector class.
         - data_extractor (DataExtractor): Instance of DataExtractor class.
         - data_cleaner (DataCleaning): Instance of DataCleaning class.
+
+    Returns:
+    --------
+        - pd.DataFrame: The cleaned stores, or None if the stage failed.
     """
     try: 
         number_of_stores = data_extractor.list_number_of_stores()
@@ -97,6 +129,7 @@ def etl_of_stores_data(db_connector, data_extractor, data_cleaner):
         df_stores = data_extractor.retrieve_stores_data(store_details_endpoint, number_of_stores)
         df_stores = data_cleaner.clean_store_data(df_stores)
         db_connector.upload_to_db(df_stores, 'dim_store_details')
+        return df_stores
 
     except Exception as e:
         logging.error(f'Error in main method etl_of_stores_data: {e}')
@@ -111,6 +144,10 @@ def etl_of_products_data(db_connector, data_extractor, data_cleaner, s3_address)
         - data_extractor (DataExtractor): Instance of DataExtractor class.
         - data_cleaner (DataCleaning): Instance of DataCleaning class.
         - s3_address (str): S3 address containing products data.
+
+    Returns:
+    --------
+        - pd.DataFrame: The cleaned products, or None if the stage failed.
     """
 
     try: 
@@ -118,12 +155,13 @@ def etl_of_products_data(db_connector, data_extractor, data_cleaner, s3_address)
         df_products = data_cleaner.convert_product_weights(df_products)
         df_products = data_cleaner.clean_product_data(df_products)
         db_connector.upload_to_db(df_products, 'dim_products')
+        return df_products
 
     except Exception as e:
         logging.error(f'Error in main method etl_of_products_data: {e}')
 
 
-def etl_of_orders_data(db_connector, data_cleaner):
+def etl_of_orders_data(db_connector, data_cleaner, dimension_frames=None):
     """
     Extracts, transforms, and loads orders data.
 
@@ -131,10 +169,19 @@ def etl_of_orders_data(db_connector, data_cleaner):
     ----------
         - db_connector (DatabaseConnector): Instance of DatabaseConnector class.
         - data_cleaner (DataCleaning): Instance of DataCleaning class.
+        - dimension_frames (dict): Key columns mapped to the cleaned dimension frames; when given, orders with a key
+          missing from its dimension are written to 'orders_quarantine' instead of 'orders_table'.
     """
     try:
         db_connector.list_db_tables()
         df_orders = data_cleaner.clean_orders_data('orders_table')
+
+        if dimension_frames and df_orders is not None:
+            # Route orphan orders aside in one bulk write, so the foreign keys can be added on the first try
+            df_orders, df_orphans = data_cleaner.split_orphan_orders(df_orders, dimension_frames)
+            db_connector.upload_to_db(df_orphans, 'orders_quarantine', load_mode='replace')
+            logging.info(f'{len(df_orphans)} orphan orders quarantined, {len(df_orders)} orders kept')
+
         db_connector.upload_to_db(df_orders, 'orders_table')
 
     except Exception as e:
@@ -145,29 +192,199 @@ def etl_of_datetimes_data(db_connector, data_extractor, data_cleaner, json_url):
         df_dates = data_extractor.extract_json_from_url(json_url)
         df_dates = data_cleaner.clean_dates(df_dates)
         db_connector.upload_to_db(df_dates, 'dim_date_times')
+        return df_dates
 
     except Exception as e:
         logging.error(f'Error in main method etl_of_datetimes_data: {e}')
+
+
+def parse_arguments(argv=None):
+    """
+    Parses the command line options of the pipeline.
+
+    Parameters:
+    ----------
+        - argv (list): Command line arguments, defaults to sys.argv.
+
+    Returns:
+    --------
+        - argparse.Namespace: Parsed options.
+    """
+    parser = argparse.ArgumentParser(description='Extracts, cleans and loads the retail data into PostgreSQL.')
+    parser.add_argument('--load-mode', choices=['replace', 'swap', 'hash_diff'], default='replace',
+                        help="'replace' recreates each table in place, 'swap' loads a staging table and renames it in atomically, "
+                             "'hash_diff' writes only the changed rows of the dimension tables.")
+    parser.add_argument('--unlogged-staging', action='store_true',
+                        help="Fill staging tables without WAL logging in 'swap' mode; they are made LOGGED before being swapped in.")
+    parser.add_argument('--partition-orders', action='store_true',
+                        help='Load orders_table as monthly range partitions and rewrite only the months that changed (PostgreSQL).')
+    parser.add_argument('--quarantine-orphans', action='store_true',
+                        help="Move orders whose keys are missing from the dimensions just loaded into 'orders_quarantine'.")
+    parser.add_argument('--build-schema', action='store_true',
+                        help='Add the star schema keys and join indexes after all tables are loaded.')
+    parser.add_argument('--bulk-extract', action='store_true',
+                        help='Read the RDS tables concurrently, largest first, before the ETL stages run.')
+    parser.add_argument('--stream-json', action='store_true',
+                        help='Parse the date details JSON while it downloads (requires ijson).')
+    parser.add_argument('--rule-engine', action='store_true',
+                        help='Clean every table with the declarative rules of cleaning_rules.py in a single pass per column.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile every ETL stage with cProfile and write the reports to --profile-dir.')
+    parser.add_argument('--profile-dir', default='profiles',
+                        help='Folder receiving the per-stage profiles and summary.txt.')
+    parser.add_argument('--profile-top', type=int, default=25,
+                        help='Number of hot functions listed in each profile report.')
+    parser.add_argument('--trace-allocations', action='store_true',
+                        help='Also trace memory allocations with tracemalloc while profiling.')
+    parser.add_argument('--publish-extract', action='store_true',
+                        help='Publish the denormalised Parquet sales extract for the notebooks after loading.')
+    parser.add_argument('--extract-dir', default='analytics_extract',
+                        help='Folder receiving the Parquet sales extract.')
+    parser.add_argument('--pdf-url', default=pdf_url, help='Location of the card details PDF.')
+    parser.add_argument('--json-url', default=json_url, help='Location of the date details JSON.')
+    parser.add_argument('--s3-address', default=s3_address, help='S3 address of the products CSV.')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='Overlap extraction, cleaning and loading of each stage (except cards) through bounded queues of batches.')
+    parser.add_argument('--batch-rows', type=int, default=10000,
+                        help='Rows per batch in --pipelined mode.')
+    parser.add_argument('--store-batch', type=int, default=pipelining.store_batch_rows,
+                        help='Stores per batch in --pipelined mode, each store being one API request.')
+    parser.add_argument('--queue-size', type=int, default=4,
+                        help='Batches allowed to wait between two steps in --pipelined mode.')
+    parser.add_argument('--sharded-orders', type=int, default=0, metavar='WORKERS',
+                        help='Load the orders table in key-range shards with this many worker processes.')
+    parser.add_argument('--order-shards', type=int, default=16,
+                        help='Number of key ranges the orders table is split into with --sharded-orders.')
+    parser.add_argument('--shard-queue', default='orders_shards.db',
+                        help='SQLite shard queue file, on a shared path when workers on other hosts join in.')
+    arguments = parser.parse_args(argv)
+
+    # Pipelined and sharded stages always load through a staging table swapped in whole, bypassing upload_to_db
+    if arguments.pipelined and arguments.load_mode == 'hash_diff':
+        parser.error('--load-mode hash_diff cannot be combined with --pipelined, whose stages always swap in a full staging table')
+    for option, requested in (('--partition-orders', arguments.partition_orders), ('--quarantine-orphans', arguments.quarantine_orphans)):
+        if requested and (arguments.pipelined or arguments.sharded_orders):
+            parser.error(f'{option} cannot be combined with --pipelined or --sharded-orders, which load orders without upload_to_db')
+    return arguments
+
         
-def main():
+def main(argv=None):
+    """
+    Runs the pipeline.
+
+    Parameters:
+    ----------
+        - argv (list): Command line arguments, defaults to sys.argv.
+
+    Returns:
+    --------
+        - dict: Total seconds, seconds per stage, the rows and seconds of every table upload and the failed star schema statements.
+    """
+    arguments = parse_arguments(argv)
+    run_start = time.perf_counter()
+    stage_seconds = {}
+    schema_failures = []
+    db_connector = None
+
     try:
         # Call initialise_classes with credentials and configurations
-        db_connector, data_extractor, data_cleaner = initialise_classes(aws_credentials_file, local_credentials_file)
+        db_connector, data_extractor, data_cleaner = initialise_classes(aws_credentials_file, local_credentials_file, arguments.rule_engine)
         
+        # Apply the requested loading behaviour to every upload
+        db_connector.load_mode = arguments.load_mode
+        db_connector.unlogged_staging = arguments.unlogged_staging
+        db_connector.partition_facts = arguments.partition_orders
+        data_extractor.stream_json = arguments.stream_json
+
     except Exception as e:
         logging.error(f'Error in main function initialisation: {e}')
 
     try:
-        etl_of_users_data(db_connector, data_cleaner)
-        etl_of_cards_data(db_connector, data_cleaner, pdf_url)
-        etl_of_stores_data(db_connector, data_extractor, data_cleaner)
-        etl_of_products_data(db_connector, data_extractor, data_cleaner, s3_address)    
-        etl_of_orders_data(db_connector, data_cleaner)
-        etl_of_datetimes_data(db_connector, data_extractor, data_cleaner, json_url)
+        # Foreign keys are dropped before loading and rebuilt once every table has landed
+        schema_builder = SchemaBuilder(db_connector) if arguments.build_schema else None
+        if schema_builder:
+            schema_builder.drop_foreign_keys()
+
+        if arguments.bulk_extract:
+            # Pipelined and sharded stages read their tables in batches themselves, so prefetching those would read them twice
+            prefetched_tables = [table_name for table_name, read_in_batches in (
+                ('legacy_users', arguments.pipelined),
+                ('orders_table', arguments.pipelined or arguments.sharded_orders),
+            ) if not read_in_batches]
+            if len(prefetched_tables) < 2:
+                logging.warning('--bulk-extract skips the RDS tables read in batches by --pipelined or --sharded-orders')
+            if prefetched_tables:
+                data_extractor.read_rds_tables(prefetched_tables)
+
+        # Cleaned dimension frames, filled in as their stages finish and used to check the orders keys
+        dimension_frames = {}
+
+        stages = [
+            (etl_of_users_data, (db_connector, data_cleaner)),
+            (etl_of_cards_data, (db_connector, data_cleaner, arguments.pdf_url)),
+            (etl_of_stores_data, (db_connector, data_extractor, data_cleaner)),
+            (etl_of_products_data, (db_connector, data_extractor, data_cleaner, arguments.s3_address)),
+            # Dates load before orders, whose monthly partitions are looked up in dim_date_times
+            (etl_of_datetimes_data, (db_connector, data_extractor, data_cleaner, arguments.json_url)),
+            (etl_of_orders_data, (db_connector, data_cleaner, dimension_frames if arguments.quarantine_orphans else None)),
+        ]
+
+        # Pipelined stages load through a staging table swapped in after the last batch
+        if arguments.pipelined:
+            stages[0] = (pipelining.pipelined_users_data, (db_connector, data_extractor, data_cleaner, arguments.batch_rows, arguments.queue_size))
+            stages[2] = (pipelining.pipelined_stores_data, (db_connector, data_extractor, data_cleaner, arguments.store_batch, arguments.queue_size))
+            stages[3] = (pipelining.pipelined_products_data, (db_connector, data_extractor, data_cleaner, arguments.s3_address, arguments.batch_rows, arguments.queue_size))
+            stages[4] = (pipelining.pipelined_datetimes_data, (db_connector, data_extractor, data_cleaner, arguments.json_url, arguments.batch_rows, arguments.queue_size))
+            stages[5] = (pipelining.pipelined_orders_data, (db_connector, data_extractor, data_cleaner, arguments.batch_rows, arguments.queue_size))
+
+        # Orders can instead be spread over worker processes, one key range at a time
+        if arguments.sharded_orders:
+            stages[5] = (run_sharded_orders, (db_connector, data_cleaner, arguments.order_shards, arguments.sharded_orders, arguments.shard_queue))
+
+        # cProfile only sees the main thread, not the worker threads and processes of these modes
+        if arguments.profile and (arguments.pipelined or arguments.sharded_orders or arguments.bulk_extract):
+            logging.warning('--profile only records the main thread: with --pipelined, --sharded-orders or --bulk-extract the reports '
+                            'show the waits on worker threads and processes, not their extraction and cleaning work')
+
+        # Each stage runs on its own under the profiler when profiling is requested
+        profiler = StageProfiler(arguments.profile_dir, arguments.profile_top, arguments.trace_allocations) if arguments.profile else None
+        for stage_function, stage_arguments in stages:
+            stage_start = time.perf_counter()
+            dimension_table, key_column = dimension_key_columns.get(stage_function.__name__, (None, None))
+            previous_load = db_connector.load_stats.get(dimension_table)
+            if profiler:
+                result = profiler.run(stage_function.__name__, stage_function, *stage_arguments)
+            else:
+                result = stage_function(*stage_arguments)
+
+            # upload_to_db logs and swallows its errors, so only a new load_stats entry shows the keys reached the database
+            uploaded = dimension_table is not None and db_connector.load_stats.get(dimension_table, previous_load) is not previous_load
+            if uploaded and isinstance(result, pd.DataFrame):
+                dimension_frames[key_column] = result
+            stage_seconds[stage_function.__name__] = time.perf_counter() - stage_start
+
+        if profiler:
+            profiler.write_summary()
+
+        if schema_builder:
+            schema_failures = schema_builder.build()
+            if schema_failures:
+                logging.error(f'Error in main function, {len(schema_failures)} star schema statements failed: '
+                              + '; '.join(description for description, _ in schema_failures))
+
+        if arguments.publish_extract:
+            publish_sales_extract(db_connector, arguments.extract_dir)
 
     except Exception as e:
         logging.error(f'Error in main function ETL methods: {e}')
 
+    return {
+        'seconds': time.perf_counter() - run_start,
+        'stages': stage_seconds,
+        'loads': dict(db_connector.load_stats) if db_connector else {},
+        'schema_failures': schema_failures,
+    }
+
 
 # Main Execution 
 if __name__ == "__main__":
@@ -0,0 +1,290 @@
+"""
+File: pipelining.py
+Purpose: Keeping the network, the CPU and the database busy at the same time.
+Author: Zulfia
+Date: January 2024
+
+# Each pipelined stage logs how long its extract, clean and load threads worked and waited, which points at the bottleneck.
+"""
+
+# External Libraries
+import logging
+import queue
+import threading
+import time
+
+# Internal Libraries and Credentials
+from data_extraction import ijson
+
+# Logging Configuration
+logging.basicConfig(level=logging.INFO)
+
+# Marks the end of the batches passed down a queue
+end_of_batches = object()
+
+# Stores per batch of the pipelined stores stage; each store is a separate API request
+store_batch_rows = 50
+
+
+# BatchPipeline Class and Methods
+class BatchPipeline:
+    """
+    Class for running the extract, clean and load steps of one stage on separate threads,
+    connected by bounded queues of DataFrame batches. A full queue holds the upstream step back (backpressure),
+    so no more than queue_size batches wait between two steps.
+
+    Attributes:
+    ----------
+        - stage_name (str): Name used in the log messages.
+        - queue_size (int): Maximum number of batches waiting in each queue.
+        - metrics (dict): Per step: batches, rows, busy seconds and seconds waiting for input or for room in the output queue.
+          Per queue: highest and average depth seen when a batch was added.
+        - errors (list): Exceptions raised by the steps of the last run.
+
+    Methods:
+    --------
+        - __init__(self, stage_name, queue_size): Initialises the BatchPipeline instance.
+        - def run(self, batches, clean_batch, load_batch, finish_load): Runs the three steps until the batches are used up.
+        - def bottleneck(self): Names the step that spent the most time working.
+    """
+
+    def __init__(self, stage_name, queue_size=4):
+        """
+        Initialises the BatchPipeline instance.
+
+        Parameters:
+        ----------
+            - stage_name (str): Name used in the log messages.
+            - queue_size (int): Maximum number of batches waiting in each queue.
+        """
+        self.stage_name = stage_name
+        self.queue_size = queue_size
+        self.metrics = {}
+        self.errors = []
+        self.stopped = threading.Event()
+
+    def _put(self, batch_queue, queue_name, batch, step_metrics):
+        """ Adds a batch to a queue, waiting while it is full unless another step has failed."""
+        start = time.perf_counter()
+        while not self.stopped.is_set():
+            try:
+                batch_queue.put(batch, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        step_metrics['output_wait_seconds'] += time.perf_counter() - start
+
+        depth = batch_queue.qsize()
+        queue_metrics = self.metrics[queue_name]
+        queue_metrics['max_depth'] = max(queue_metrics['max_depth'], depth)
+        queue_metrics['depth_samples'] += 1
+        queue_metrics['depth_total'] += depth
+
+    def _get(self, batch_queue, step_metrics):
+        """ Takes the next batch from a queue, or end_of_batches if another step has failed."""
+        start = time.perf_counter()
+        try:
+            while not self.stopped.is_set():
+                try:
+                    return batch_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return end_of_batches
+        finally:
+            step_metrics['input_wait_seconds'] += time.perf_counter() - start
+
+    def _run_step(self, step_name, work):
+        """ Runs one step, recording its error and stopping the other steps if it fails."""
+        try:
+            work(self.metrics[step_name])
+        except Exception as e:
+            self.errors.append(e)
+            self.stopped.set()
+            logging.error(f'Error in pipelining, {self.stage_name} {step_name} step: {e}')
+
+    def run(self, batches, clean_batch, load_batch, finish_load=None):
+        """
+        Runs extraction, cleaning and loading concurrently until every batch has been loaded.
+
+        Parameters:
+        ----------
+            - batches (iterable): Yields the extracted DataFrame batches; iterating it is the extract step.
+            - clean_batch (callable): Cleans one batch and returns it; None stops the pipeline as a failure.
+            - load_batch (callable): Writes one cleaned batch.
+            - finish_load (callable): Called once after the last batch has been written, e.g. to swap a staging table in.
+
+        Returns:
+            - bool: True if every step finished without error.
+        """
+        extracted = queue.Queue(maxsize=self.queue_size)
+        cleaned = queue.Queue(maxsize=self.queue_size)
+        self.errors = []
+        self.stopped.clear()
+        self.metrics = {step_name: {'batches': 0, 'rows': 0, 'busy_seconds': 0.0, 'input_wait_seconds': 0.0, 'output_wait_seconds': 0.0}
+                        for step_name in ('extract', 'clean', 'load')}
+        self.metrics.update({queue_name: {'max_depth': 0, 'depth_samples': 0, 'depth_total': 0}
+                             for queue_name in ('extracted', 'cleaned')})
+
+        def extract(step_metrics):
+            try:
+                iterator = iter(batches)
+                while not self.stopped.is_set():
+                    start = time.perf_counter()
+                    df = next(iterator, end_of_batches)
+                    step_metrics['busy_seconds'] += time.perf_counter() - start
+                    if df is end_of_batches:
+                        break
+                    step_metrics['batches'] += 1
+                    step_metrics['rows'] += len(df)
+                    self._put(extracted, 'extracted', df, step_metrics)
+            except Exception:
+                # Stop before the end marker goes out, or the load step could take it for a complete run and swap in a partial table
+                self.stopped.set()
+                raise
+            finally:
+                self._put(extracted, 'extracted', end_of_batches, step_metrics)
+
+        def clean(step_metrics):
+            try:
+                while True:
+                    df = self._get(extracted, step_metrics)
+                    if df is end_of_batches:
+                        break
+                    if df.empty:
+                        continue
+                    start = time.perf_counter()
+                    df = clean_batch(df)
+                    step_metrics['busy_seconds'] += time.perf_counter() - start
+                    if df is None:
+                        # The cleaning methods log their error and return None; loading the other batches would silently lose rows
+                        raise ValueError(f"cleaning failed for batch {step_metrics['batches'] + 1}")
+                    step_metrics['batches'] += 1
+                    step_metrics['rows'] += len(df)
+                    self._put(cleaned, 'cleaned', df, step_metrics)
+            except Exception:
+                self.stopped.set()
+                raise
+            finally:
+                self._put(cleaned, 'cleaned', end_of_batches, step_metrics)
+
+        def load(step_metrics):
+            while True:
+                df = self._get(cleaned, step_metrics)
+                if df is end_of_batches:
+                    break
+                start = time.perf_counter()
+                load_batch(df)
+                step_metrics['busy_seconds'] += time.perf_counter() - start
+                step_metrics['batches'] += 1
+                step_metrics['rows'] += len(df)
+
+            if finish_load and not self.stopped.is_set():
+                start = time.perf_counter()
+                finish_load()
+                step_metrics['busy_seconds'] += time.perf_counter() - start
+
+        threads = [threading.Thread(target=self._run_step, args=(step_name, work), name=f'{self.stage_name}-{step_name}')
+                   for step_name, work in (('extract', extract), ('clean', clean), ('load', load))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self._log_metrics()
+        return not self.errors
+
+    def bottleneck(self):
+        """ Returns the name of the step that spent the most time working in the last run."""
+        return max(('extract', 'clean', 'load'), key=lambda step_name: self.metrics[step_name]['busy_seconds'])
+
+    def _log_metrics(self):
+        """ Logs the work and wait times of every step and the average depth of both queues."""
+        for step_name in ('extract', 'clean', 'load'):
+            step = self.metrics[step_name]
+            logging.info(f"{self.stage_name} {step_name}: {step['batches']} batches, {step['rows']} rows, busy {step['busy_seconds']:.2f}s, "
+                         f"waiting for input {step['input_wait_seconds']:.2f}s, for output {step['output_wait_seconds']:.2f}s")
+        for queue_name in ('extracted', 'cleaned'):
+            queue_metrics = self.metrics[queue_name]
+            average_depth = queue_metrics['depth_total'] / queue_metrics['depth_samples'] if queue_metrics['depth_samples'] else 0
+            logging.info(f"{self.stage_name} {queue_name} queue: average depth {average_depth:.1f}, max {queue_metrics['max_depth']} of {self.queue_size}")
+        logging.info(f'{self.stage_name} bottleneck: {self.bottleneck()}')
+
+
+def run_pipelined_stage(db_connector, destination_table_name, batches, clean_batch, queue_size=4):
+    """
+    Pipelines one stage into a staging table that is swapped in once the last batch is loaded,
+    so the live table is never seen half loaded.
+
+    Parameters:
+    ----------
+        - db_connector (DatabaseConnector): An instance of the DatabaseConnector class.
+        - destination_table_name (str): The name of the live table to be replaced.
+        - batches (iterable): Yields the extracted DataFrame batches.
+        - clean_batch (callable): Cleans one batch.
+        - queue_size (int): Maximum number of batches waiting between two steps.
+
+    Returns:
+        - BatchPipeline: The pipeline, with the metrics of the run.
+    """
+    start = time.perf_counter()
+    staging_created = []
+
+    def load_batch(df):
+        # The first batch gives the staging table its columns
+        if not staging_created:
+            db_connector.create_staging_table(df, destination_table_name, db_connector.unlogged_staging)
+            staging_created.append(True)
+        db_connector.append_to_staging(df, destination_table_name)
+
+    def finish_load():
+        if not staging_created:
+            logging.warning(f'Error in pipelining, no rows to load into {destination_table_name}')
+            return
+        db_connector.swap_staging_table(destination_table_name)
+        db_connector.record_load_version(destination_table_name)
+
+    pipeline = BatchPipeline(destination_table_name, queue_size)
+    if pipeline.run(batches, clean_batch, load_batch, finish_load) and staging_created:
+        db_connector.load_stats[destination_table_name] = {'rows': pipeline.metrics['load']['rows'], 'seconds': time.perf_counter() - start}
+    return pipeline
+
+
+def pipelined_users_data(db_connector, data_extractor, data_cleaner, batch_rows=10000, queue_size=4):
+    """ Pipelined version of main.etl_of_users_data."""
+    return run_pipelined_stage(db_connector, 'dim_users', data_extractor.iter_rds_table('legacy_users', batch_rows),
+                               data_cleaner.clean_users_frame, queue_size)
+
+
+def pipelined_stores_data(db_connector, data_extractor, data_cleaner, batch_rows=store_batch_rows, queue_size=4):
+    """ Pipelined version of main.etl_of_stores_data; batches hold batch_rows stores."""
+    number_of_stores = data_extractor.list_number_of_stores()
+    store_details_endpoint = data_extractor.api_config['store_details_endpoint']
+    return run_pipelined_stage(db_connector, 'dim_store_details',
+                               data_extractor.iter_stores_data(store_details_endpoint, number_of_stores, batch_rows),
+                               data_cleaner.clean_store_data, queue_size)
+
+
+def pipelined_products_data(db_connector, data_extractor, data_cleaner, s3_address, batch_rows=10000, queue_size=4):
+    """ Pipelined version of main.etl_of_products_data."""
+    def clean_products(df_products):
+        df_products = data_cleaner.convert_product_weights(df_products)
+        return data_cleaner.clean_product_data(df_products) if df_products is not None else None
+
+    return run_pipelined_stage(db_connector, 'dim_products', data_extractor.iter_s3_csv(s3_address, batch_rows), clean_products, queue_size)
+
+
+def pipelined_orders_data(db_connector, data_extractor, data_cleaner, batch_rows=10000, queue_size=4):
+    """ Pipelined version of main.etl_of_orders_data."""
+    return run_pipelined_stage(db_connector, 'orders_table', data_extractor.iter_rds_table('orders_table', batch_rows),
+                               data_cleaner.clean_orders_frame, queue_size)
+
+
+def pipelined_datetimes_data(db_connector, data_extractor, data_cleaner, json_url, batch_rows=10000, queue_size=4):
+    """ Pipelined version of main.etl_of_datetimes_data; without ijson the JSON arrives as a single batch."""
+    if ijson is not None:
+        batches = data_extractor.stream_json_from_url(json_url, chunk_rows=batch_rows)
+    else:
+        batches = [data_extractor.extract_json_from_url(json_url)]
+    return run_pipelined_stage(db_connector, 'dim_date_times', batches, data_cleaner.clean_dates, queue_size)
+
+# The script ends here
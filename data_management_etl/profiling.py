@@ -0,0 +1,157 @@
+"""
+File: profiling.py
+Purpose: Shining a torch on where the pipeline spends its time and memory.
+Author: Zulfia
+Date: January 2024
+
+# Profiles can be opened with pstats or snakeviz, e.g. `snakeviz profiles/etl_of_products_data.prof`.
+"""
+
+# External Libraries
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+
+# Logging Configuration
+logging.basicConfig(level=logging.INFO)
+
+# Project modules whose functions the hot spot reports single out
+project_modules_pattern = r'data_cleaning|data_extraction|database_utils'
+
+
+# StageProfiler Class and Methods
+class StageProfiler:
+    """
+    Class for profiling pipeline stages one at a time with cProfile and, optionally, tracemalloc.
+
+    Attributes:
+    ----------
+        - output_directory (str): Folder receiving one .prof and one .txt report per stage plus summary.txt.
+        - top_n (int): Number of functions and allocation sites listed in each report.
+        - trace_allocations (bool): Whether memory allocations are traced with tracemalloc.
+        - summaries (list): Wall time, peak traced memory and profile of every profiled stage.
+
+    Methods:
+    --------
+        - __init__(self, output_directory, top_n, trace_allocations): Initialises the StageProfiler instance.
+        - def run(self, stage_name, stage_function, *args, **kwargs): Runs one stage under the profiler.
+        - def write_summary(self): Writes the hot function summary across all profiled stages.
+    """
+
+    def __init__(self, output_directory='profiles', top_n=25, trace_allocations=False):
+        """
+        Initialises the StageProfiler instance.
+
+        Parameters:
+        ----------
+            - output_directory (str): Folder receiving the profile files.
+            - top_n (int): Number of functions and allocation sites listed in each report.
+            - trace_allocations (bool): Trace memory allocations with tracemalloc (slows the stage down noticeably).
+        """
+        self.output_directory = output_directory
+        self.top_n = top_n
+        self.trace_allocations = trace_allocations
+        self.summaries = []
+
+    def run(self, stage_name, stage_function, *args, **kwargs):
+        """
+        Runs one stage under cProfile and writes '<stage_name>.prof' and '<stage_name>.txt'.
+        Only the calling thread is profiled; work done on threads or processes started by the stage appears as waiting time.
+
+        Parameters:
+        ----------
+            - stage_name (str): Name used for the report files.
+            - stage_function (callable): The stage to run, e.g. etl_of_users_data.
+            - *args, **kwargs: Arguments passed on to the stage.
+
+        Returns:
+            - The return value of the stage.
+        """
+        os.makedirs(self.output_directory, exist_ok=True)
+        profiler = cProfile.Profile()
+
+        if self.trace_allocations:
+            tracemalloc.start(25)
+
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            return stage_function(*args, **kwargs)
+
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - start
+
+            snapshot, peak_memory = None, None
+            if self.trace_allocations:
+                # Leave out the allocations made by the tracing and reporting machinery itself
+                snapshot = tracemalloc.take_snapshot().filter_traces([
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, __file__),
+                ])
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+            try:
+                self._write_stage_report(stage_name, profiler, elapsed, snapshot, peak_memory)
+            except Exception as e:
+                logging.error(f'Error in profiling method run, writing report for {stage_name}: {e}')
+
+    def _write_stage_report(self, stage_name, profiler, elapsed, snapshot, peak_memory):
+        """ Dumps the raw profile and a readable top-N report for one stage."""
+        profiler.dump_stats(os.path.join(self.output_directory, f'{stage_name}.prof'))
+
+        report = io.StringIO()
+        report.write(f'{stage_name}: {elapsed:.3f}s wall time\n')
+        if peak_memory is not None:
+            report.write(f'peak traced memory: {peak_memory / 2**20:.1f} MiB\n')
+
+        stats = pstats.Stats(profiler, stream=report)
+        stats.strip_dirs()
+        report.write(f'\n=== top {self.top_n} functions by own time ===\n')
+        stats.sort_stats('tottime').print_stats(self.top_n)
+        report.write(f'\n=== top {self.top_n} project functions by cumulative time ===\n')
+        stats.sort_stats('cumulative').print_stats(project_modules_pattern, self.top_n)
+
+        if snapshot is not None:
+            report.write(f'\n=== top {self.top_n} allocation sites ===\n')
+            for statistic in snapshot.statistics('lineno')[:self.top_n]:
+                report.write(f'{statistic}\n')
+
+        text_report = report.getvalue()
+        with open(os.path.join(self.output_directory, f'{stage_name}.txt'), 'w') as report_file:
+            report_file.write(text_report)
+
+        self.summaries.append({'stage': stage_name, 'seconds': elapsed, 'peak_memory': peak_memory, 'profiler': profiler})
+        logging.info(f'profiled {stage_name} in {elapsed:.3f}s, report in {self.output_directory}')
+
+    def write_summary(self):
+        """ Writes summary.txt with the timing of every stage and the hottest functions across all of them."""
+        if not self.summaries:
+            return
+
+        try:
+            report = io.StringIO()
+            report.write('=== stages ===\n')
+            for summary in sorted(self.summaries, key=lambda summary: summary['seconds'], reverse=True):
+                memory = f", peak {summary['peak_memory'] / 2**20:.1f} MiB" if summary['peak_memory'] is not None else ''
+                report.write(f"{summary['stage']}: {summary['seconds']:.3f}s{memory}\n")
+
+            # Merge the stage profiles to rank functions over the whole run
+            combined_stats = pstats.Stats(self.summaries[0]['profiler'], stream=report)
+            for summary in self.summaries[1:]:
+                combined_stats.add(summary['profiler'])
+            report.write(f'\n=== top {self.top_n} functions by own time, all stages ===\n')
+            combined_stats.strip_dirs().sort_stats('tottime').print_stats(self.top_n)
+
+            with open(os.path.join(self.output_directory, 'summary.txt'), 'w') as summary_file:
+                summary_file.write(report.getvalue())
+
+        except Exception as e:
+            logging.error(f'Error in profiling method write_summary: {e}')
+
+# The script ends here
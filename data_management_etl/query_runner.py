@@ -0,0 +1,199 @@
+"""
+File: query_runner.py
+Purpose: Asking the business questions all at once and remembering the answers until the data changes.
+Author: Zulfia
+Date: January 2024
+
+# Queries are read straight from scripts_business_queries.sql, so the SQL stays in one place.
+"""
+
+# External Libraries
+import hashlib
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+# Internal Libraries and Credentials
+from database_utils import DatabaseConnector, aws_credentials_file, local_credentials_file
+
+# Logging Configuration
+logging.basicConfig(level=logging.INFO)
+
+# Default Locations
+business_queries_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'analytics_and_schema_design', 'scripts_business_queries.sql')
+query_cache_directory = 'query_cache'
+
+# Block comments introducing each query, e.g. /* TASK 3: Query the database ... */
+query_header_pattern = re.compile(r'/\*\s*task\s*(\d+)\s*:(.*?)\*/', re.IGNORECASE | re.DOTALL)
+
+# Tables of the star schema that a query may read from
+table_name_pattern = re.compile(r'\b(orders_table|dim_\w+)\b')
+
+
+def parse_query_script(script_path=business_queries_file):
+    """
+    Splits a SQL script into named queries using its '/* TASK n: ... */' headers.
+
+    Parameters:
+    ----------
+        - script_path (str): Path of the SQL script.
+
+    Returns:
+    --------
+        - list: One dictionary per query with 'name', 'description', 'sql' and 'tables' keys.
+          Repeated task numbers are suffixed, e.g. 'task_6' and 'task_6_2'.
+    """
+    with open(script_path, 'r') as script_file:
+        script = script_file.read()
+
+    headers = list(query_header_pattern.finditer(script))
+    queries = []
+    seen_names = {}
+
+    for position, header in enumerate(headers):
+        end = headers[position + 1].start() if position + 1 < len(headers) else len(script)
+        sql = script[header.end():end].strip().rstrip(';').strip()
+        if not sql:
+            continue
+
+        name = f'task_{header.group(1)}'
+        seen_names[name] = seen_names.get(name, 0) + 1
+        if seen_names[name] > 1:
+            name = f'{name}_{seen_names[name]}'
+
+        queries.append({
+            'name': name,
+            'description': ' '.join(header.group(2).split()),
+            'sql': sql,
+            'tables': sorted(set(table_name_pattern.findall(sql))),
+        })
+
+    return queries
+
+
+# QueryRunner Class and Methods
+class QueryRunner:
+    """
+    Class for running the business queries concurrently with a result cache keyed on the database and its table load versions.
+
+    Attributes:
+    ----------
+        - db_connector (DatabaseConnector): An instance of the DatabaseConnector class.
+        - cache_directory (str): Folder where query results are pickled.
+        - max_workers (int): Number of queries run at the same time, each on its own pooled connection.
+        - timings (dict): Seconds taken by each query in the last run and whether it came from the cache.
+
+    Methods:
+    --------
+        - __init__(self, db_connector, cache_directory, max_workers): Initialises the QueryRunner instance.
+        - def cache_key(self, query, load_versions): Builds the cache key of a query.
+        - def run_query(self, query, load_versions): Runs one query or returns its cached result.
+        - def run(self, queries): Runs several queries concurrently.
+    """
+
+    def __init__(self, db_connector, cache_directory=query_cache_directory, max_workers=4):
+        """
+        Initialises the QueryRunner instance.
+
+        Parameters:
+        ----------
+            - db_connector (DatabaseConnector): An instance of the DatabaseConnector class.
+            - cache_directory (str): Folder where query results are pickled.
+            - max_workers (int): Number of queries run at the same time.
+        """
+        self.db_connector = db_connector
+        self.cache_directory = cache_directory
+        self.max_workers = max_workers
+        self.timings = {}
+
+    def cache_key(self, query, load_versions):
+        """
+        Builds the cache key of a query from its SQL, the database it runs on and the load version and load time
+        of the tables it reads. The cache folder can be shared by several databases whose versions all start at 1.
+
+        Returns:
+            - str or None: Hex digest, or None if any table has no recorded version and the result cannot be cached.
+        """
+        database = self.db_connector.local_data_engine.url.render_as_string(hide_password=True)
+        versions = []
+        for table_name in query['tables']:
+            if table_name not in load_versions:
+                return None
+            version, loaded_at = load_versions[table_name]
+            versions.append(f'{table_name}={version}@{loaded_at}')
+
+        return hashlib.sha256('\n'.join([query['sql'], database] + versions).encode('utf-8')).hexdigest()
+
+    def run_query(self, query, load_versions):
+        """
+        Runs one query, or reads its result from the cache if none of its tables has been reloaded since.
+
+        Parameters:
+        ----------
+            - query (dict): A query as returned by parse_query_script.
+            - load_versions (dict): Table load versions and load times read at the start of the run.
+
+        Returns:
+            - pd.DataFrame: The query result, or None if the query failed.
+        """
+        start = time.perf_counter()
+        try:
+            key = self.cache_key(query, load_versions)
+            cache_file = os.path.join(self.cache_directory, f"{query['name']}-{key[:16]}.pkl") if key else None
+
+            if cache_file and os.path.exists(cache_file):
+                df = pd.read_pickle(cache_file)
+                cached = True
+            else:
+                with self.db_connector.local_data_engine.connect() as connection:
+                    df = pd.read_sql(query['sql'], connection)
+                cached = False
+                if cache_file:
+                    os.makedirs(self.cache_directory, exist_ok=True)
+                    df.to_pickle(cache_file)
+
+            elapsed = time.perf_counter() - start
+            self.timings[query['name']] = {'seconds': elapsed, 'cached': cached}
+            logging.info(f"query {query['name']} took {elapsed:.3f}s{' (cached)' if cached else ''}")
+            return df
+
+        except Exception as e:
+            logging.error(f"Error in query_runner method run_query, {query['name']}: {e}")
+            return None
+
+    def run(self, queries=None):
+        """
+        Runs the business queries concurrently.
+
+        Parameters:
+        ----------
+            - queries (list): Queries from parse_query_script, defaults to every query in scripts_business_queries.sql.
+
+        Returns:
+            - dict: Query names mapped to their result DataFrames.
+        """
+        if queries is None:
+            queries = parse_query_script()
+
+        # Read the versions once so every query in the run sees the same snapshot
+        load_versions = self.db_connector.read_load_versions(with_loaded_at=True)
+        self.timings = {}
+
+        # The business queries only read from the schema, so they can all run at the same time
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = executor.map(lambda query: self.run_query(query, load_versions), queries)
+            return {query['name']: df for query, df in zip(queries, results)}
+
+
+# Main Execution
+if __name__ == "__main__":
+    db_connector = DatabaseConnector(aws_credentials_file, local_credentials_file)
+    query_runner = QueryRunner(db_connector)
+
+    for name, df in query_runner.run().items():
+        print(f'\n{name}:\n{df}')
+
+# The script ends here
@@ -0,0 +1,216 @@
+"""
+File: schema_builder.py
+Purpose: Raising the star schema scaffolding once the data has landed.
+Author: Zulfia
+Date: January 2024
+
+# The keys and indexes mirror Tasks 8 and 9 of scripts_star_schema_design.sql and the joins in scripts_business_queries.sql.
+"""
+
+# External Libraries
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import inspect, text
+
+# Internal Libraries and Credentials
+from database_utils import DatabaseConnector, aws_credentials_file, local_credentials_file
+
+# Logging Configuration
+logging.basicConfig(level=logging.INFO)
+
+
+# Key columns that must share a datatype across the fact and dimension tables before foreign keys can be added
+KEY_COLUMN_TYPES = [
+    ('orders_table', 'card_number', 'VARCHAR'),
+    ('orders_table', 'user_uuid', 'UUID'),
+    ('orders_table', 'date_uuid', 'UUID'),
+    ('dim_card_details', 'card_number', 'VARCHAR'),
+    ('dim_users', 'user_uuid', 'UUID'),
+    ('dim_date_times', 'date_uuid', 'UUID'),
+]
+
+# Primary keys of the dimension tables (Task 8)
+PRIMARY_KEYS = {
+    'dim_date_times': 'date_uuid',
+    'dim_products': 'product_code',
+    'dim_store_details': 'store_code',
+    'dim_users': 'user_uuid',
+    'dim_card_details': 'card_number',
+}
+
+# Foreign keys from the orders fact table (Task 9): constraint name, column, referenced table
+FOREIGN_KEYS = [
+    ('fk_orders_user', 'user_uuid', 'dim_users'),
+    ('fk_orders_card', 'card_number', 'dim_card_details'),
+    ('fk_orders_date', 'date_uuid', 'dim_date_times'),
+    ('fk_orders_store', 'store_code', 'dim_store_details'),
+    ('fk_orders_products', 'product_code', 'dim_products'),
+]
+
+# Join and covering indexes: index name, table, key columns, included columns.
+# Included columns are the ones the business queries aggregate or group by after the join,
+# so PostgreSQL can answer them with index-only scans.
+# The dimension primary keys are not indexed again: the small dimensions are hashed whole into the joins,
+# so a second btree on the key column would only slow down the loads.
+INDEXES = [
+    ('ix_orders_user_uuid', 'orders_table', ['user_uuid'], []),
+    ('ix_orders_card_number', 'orders_table', ['card_number'], []),
+    ('ix_orders_product_code', 'orders_table', ['product_code'], ['product_quantity']),
+    ('ix_orders_store_code', 'orders_table', ['store_code'], ['product_code', 'product_quantity']),
+    ('ix_orders_date_uuid', 'orders_table', ['date_uuid'], ['product_code', 'product_quantity']),
+    ('ix_stores_country_code', 'dim_store_details', ['country_code'], ['store_code', 'staff_numbers']),
+    ('ix_stores_locality', 'dim_store_details', ['locality'], ['store_code']),
+]
+
+
+# SchemaBuilder Class and Methods
+class SchemaBuilder:
+    """
+    Class for building the star schema keys and join indexes after the tables have been bulk loaded.
+
+    Attributes:
+    ----------
+        - db_connector (DatabaseConnector): An instance of the DatabaseConnector class.
+        - max_workers (int): Number of index builds run concurrently, each on its own connection.
+        - parallel_maintenance_workers (int): PostgreSQL workers available to each individual index build.
+        - failures (list): (description, error) pairs of the statements that failed.
+
+    Methods:
+    --------
+        - __init__(self, db_connector, max_workers, parallel_maintenance_workers): Initialises the SchemaBuilder instance.
+        - def drop_foreign_keys(self): Drops the orders foreign keys so the dimension tables can be reloaded.
+        - def align_key_types(self): Casts key columns to matching datatypes.
+        - def add_primary_keys(self): Adds the dimension primary keys in parallel.
+        - def add_foreign_keys(self): Adds the orders foreign keys.
+        - def create_indexes(self): Builds the join and covering indexes in parallel.
+        - def build(self): Runs every step in order and returns the failures.
+    """
+
+    def __init__(self, db_connector, max_workers=4, parallel_maintenance_workers=2):
+        """
+        Initialises the SchemaBuilder instance.
+
+        Parameters:
+        ----------
+            - db_connector (DatabaseConnector): An instance of the DatabaseConnector class.
+            - max_workers (int): Number of index builds run concurrently.
+            - parallel_maintenance_workers (int): Value of max_parallel_maintenance_workers for each build session.
+        """
+        self.db_connector = db_connector
+        self.max_workers = max_workers
+        self.parallel_maintenance_workers = parallel_maintenance_workers
+        self.failures = []
+
+    def _execute(self, statement, description):
+        """
+        Executes one DDL statement in its own transaction, logging and recording rather than raising on failure,
+        so the remaining keys and indexes are still built.
+
+        Returns:
+            - bool: True if the statement succeeded.
+        """
+        try:
+            with self.db_connector.local_data_engine.begin() as connection:
+                connection.execute(text(f'SET LOCAL max_parallel_maintenance_workers = {int(self.parallel_maintenance_workers)}'))
+                connection.execute(text(statement))
+            logging.info(f'schema builder: {description}')
+            return True
+
+        except Exception as e:
+            logging.error(f'Error in schema_builder, {description}: {e}')
+            self.failures.append((description, str(e)))
+            return False
+
+    def _existing_tables(self):
+        """ Returns the names of the tables present in the local database."""
+        return set(inspect(self.db_connector.local_data_engine).get_table_names())
+
+    def drop_foreign_keys(self):
+        """ Drops the orders foreign keys, which would otherwise stop the dimension tables from being replaced."""
+        if 'orders_table' not in self._existing_tables():
+            return
+        for constraint_name, _, _ in FOREIGN_KEYS:
+            self._execute(f'ALTER TABLE orders_table DROP CONSTRAINT IF EXISTS {constraint_name}', f'dropped {constraint_name}')
+
+    def align_key_types(self):
+        """ Casts the key columns to the same datatype on both sides of each join."""
+        tables = self._existing_tables()
+        for table_name, column_name, datatype in KEY_COLUMN_TYPES:
+            if table_name in tables:
+                self._execute(f'ALTER TABLE {table_name} ALTER COLUMN {column_name} TYPE {datatype} USING {column_name}::{datatype}',
+                              f'{table_name}.{column_name} cast to {datatype}')
+
+    def add_primary_keys(self):
+        """ Adds the dimension primary keys, one table per connection."""
+        inspector = inspect(self.db_connector.local_data_engine)
+        tables = set(inspector.get_table_names())
+
+        statements = []
+        for table_name, column_name in PRIMARY_KEYS.items():
+            if table_name not in tables or inspector.get_pk_constraint(table_name)['constrained_columns']:
+                continue
+            statements.append((f'ALTER TABLE {table_name} ADD PRIMARY KEY ({column_name})', f'primary key on {table_name}'))
+
+        self._run_in_parallel(statements)
+
+    def add_foreign_keys(self):
+        """ Adds the orders foreign keys one after another, as each one locks the orders table."""
+        inspector = inspect(self.db_connector.local_data_engine)
+        if 'orders_table' not in inspector.get_table_names():
+            return
+        existing_constraints = {foreign_key['name'] for foreign_key in inspector.get_foreign_keys('orders_table')}
+
+        for constraint_name, column_name, referenced_table in FOREIGN_KEYS:
+            if constraint_name in existing_constraints:
+                continue
+            self._execute(f'ALTER TABLE orders_table ADD CONSTRAINT {constraint_name} FOREIGN KEY ({column_name}) '
+                          f'REFERENCES {referenced_table}({column_name})', f'added {constraint_name}')
+
+    def create_indexes(self):
+        """ Builds the join and covering indexes concurrently, one connection per build."""
+        tables = self._existing_tables()
+
+        statements = []
+        for index_name, table_name, key_columns, included_columns in INDEXES:
+            if table_name not in tables:
+                continue
+            columns = ', '.join(f'"{column}"' for column in key_columns)
+            include = ', '.join(f'"{column}"' for column in included_columns)
+            include = f' INCLUDE ({include})' if include else ''
+            statements.append((f'CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({columns}){include}', f'index {index_name}'))
+
+        self._run_in_parallel(statements)
+
+    def _run_in_parallel(self, statements):
+        """ Executes independent (statement, description) pairs on a thread pool."""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(lambda statement: self._execute(*statement), statements))
+
+    def build(self):
+        """
+        Aligns key types, then adds primary keys, foreign keys and indexes.
+
+        Returns:
+            - list: (description, error) pairs of every statement that failed, including drop_foreign_keys; empty on success.
+        """
+        try:
+            self.align_key_types()
+            self.add_primary_keys()
+            self.add_foreign_keys()
+            self.create_indexes()
+
+        except Exception as e:
+            logging.error(f'Error in schema_builder method build: {e}')
+            self.failures.append(('build', str(e)))
+
+        return list(self.failures)
+
+
+# Main Execution
+if __name__ == "__main__":
+    # Build the schema on whatever tables are currently loaded
+    db_connector = DatabaseConnector(aws_credentials_file, local_credentials_file)
+    for description, error in SchemaBuilder(db_connector).build():
+        print(f'failed: {description}: {error}')
+
+# The script ends here
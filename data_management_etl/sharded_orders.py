@@ -0,0 +1,464 @@
+"""
+File: sharded_orders.py
+Purpose: Splitting the orders table into key ranges so several workers can carry it across at once.
+Author: Zulfia
+Date: January 2024
+
+# Workers on other hosts can join a run with `python sharded_orders.py --worker --queue <shared path>/orders_shards.db`.
+"""
+
+# External Libraries
+import argparse
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+# Internal Libraries and Credentials
+from database_utils import DatabaseConnector, aws_credentials_file, local_credentials_file
+from data_extraction import DataExtractor
+from data_cleaning import DataCleaning
+
+# Logging Configuration
+logging.basicConfig(level=logging.INFO)
+
+# Defaults
+orders_source_table = 'orders_table'
+orders_destination_table = 'orders_table'
+orders_key_column = 'index'
+shard_queue_file = 'orders_shards.db'
+shard_loads_table = 'etl_shard_loads'
+
+# Seconds between the heartbeats of a worker holding a shard, and without one before the shard is handed out again
+heartbeat_interval = 30
+stale_shard_seconds = 300
+
+
+# ShardQueue Class and Methods
+class ShardQueue:
+    """
+    Class for a SQLite-backed queue of key-range shards that worker processes claim one at a time.
+
+    Attributes:
+    ----------
+        - queue_path (str): Path of the SQLite file, on a shared file system when workers run on several hosts.
+        - stale_after (float): Seconds after which a running shard without a heartbeat is handed out again.
+
+    Methods:
+    --------
+        - __init__(self, queue_path, stale_after): Initialises the ShardQueue instance.
+        - def create(self, shards): Starts a new run with the given (lower_bound, upper_bound) shards.
+        - def run_id(self): Returns the identifier of the current run.
+        - def claim(self, worker_name, max_attempts): Claims the next pending or retryable shard.
+        - def complete(self, shard_id, worker_name, rows): Marks a shard held by a worker as loaded.
+        - def fail(self, shard_id, worker_name, error): Marks a shard held by a worker as failed so it can be retried.
+        - def heartbeat(self, shard_id, worker_name): Records that a worker is still processing its shard.
+        - def release_stale(self): Hands shards of workers without a recent heartbeat out again.
+        - def release_worker(self, worker_name): Hands the shards of a worker known to have exited out again.
+        - def claimable(self, max_attempts): Counts the shards that can still be claimed.
+        - def loaded_rows(self): Sums the rows of the finished shards.
+        - def progress(self): Counts the shards per status.
+    """
+
+    def __init__(self, queue_path=shard_queue_file, stale_after=stale_shard_seconds):
+        """
+        Initialises the ShardQueue instance.
+
+        Parameters:
+        ----------
+            - queue_path (str): Path of the SQLite file.
+            - stale_after (float): Seconds without a heartbeat after which a running shard is considered abandoned.
+        """
+        self.queue_path = queue_path
+        self.stale_after = stale_after
+
+    def _connect(self):
+        """ Opens a connection in autocommit mode; writes take the database lock with BEGIN IMMEDIATE."""
+        return sqlite3.connect(self.queue_path, timeout=60, isolation_level=None)
+
+    def create(self, shards):
+        """
+        Starts a new run, replacing any previous queue.
+
+        Parameters:
+        ----------
+            - shards (list): (lower_bound, upper_bound) pairs, the upper bound being exclusive.
+
+        Returns:
+            - str: Identifier of the new run.
+        """
+        run_id = uuid.uuid4().hex
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('DROP TABLE IF EXISTS shards')
+            connection.execute('DROP TABLE IF EXISTS run')
+            connection.execute('CREATE TABLE run (run_id TEXT NOT NULL)')
+            connection.execute('CREATE TABLE shards (shard_id INTEGER PRIMARY KEY, lower_bound INTEGER NOT NULL, upper_bound INTEGER NOT NULL, '
+                               "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, worker TEXT, "
+                               'rows INTEGER, error TEXT, updated_at REAL)')
+            connection.execute('INSERT INTO run (run_id) VALUES (?)', (run_id,))
+            connection.executemany('INSERT INTO shards (shard_id, lower_bound, upper_bound) VALUES (?, ?, ?)',
+                                   [(shard_id, lower_bound, upper_bound) for shard_id, (lower_bound, upper_bound) in enumerate(shards)])
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+        return run_id
+
+    def run_id(self):
+        """ Returns the identifier of the current run."""
+        connection = self._connect()
+        try:
+            return connection.execute('SELECT run_id FROM run').fetchone()[0]
+        finally:
+            connection.close()
+
+    def claim(self, worker_name, max_attempts=3):
+        """
+        Claims the next pending shard, or a failed one with attempts left.
+
+        Returns:
+            - tuple or None: (shard_id, lower_bound, upper_bound), or None when nothing is left to claim.
+        """
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute("SELECT shard_id, lower_bound, upper_bound FROM shards "
+                                     "WHERE status = 'pending' OR (status = 'failed' AND attempts < ?) "
+                                     'ORDER BY attempts, shard_id LIMIT 1', (max_attempts,)).fetchone()
+            if row:
+                connection.execute("UPDATE shards SET status = 'running', attempts = attempts + 1, worker = ?, updated_at = ? "
+                                   'WHERE shard_id = ?', (worker_name, time.time(), row[0]))
+            connection.execute('COMMIT')
+            return row
+        finally:
+            connection.close()
+
+    def _set_status(self, shard_id, worker_name, status, rows=None, error=None):
+        """
+        Records the outcome of a shard, as long as the worker still holds it. A shard released as stale may since have
+        been claimed by another worker, whose claim the late outcome must not overwrite.
+
+        Returns:
+            - bool: Whether the worker still held the shard.
+        """
+        connection = self._connect()
+        try:
+            return connection.execute("UPDATE shards SET status = ?, rows = ?, error = ?, updated_at = ? "
+                                      "WHERE shard_id = ? AND worker = ? AND status = 'running'",
+                                      (status, rows, error, time.time(), shard_id, worker_name)).rowcount == 1
+        finally:
+            connection.close()
+
+    def complete(self, shard_id, worker_name, rows):
+        """ Marks a shard held by worker_name as loaded. Returns whether the worker still held it."""
+        return self._set_status(shard_id, worker_name, 'done', rows=rows)
+
+    def fail(self, shard_id, worker_name, error):
+        """ Marks a shard held by worker_name as failed; it is claimed again while it has attempts left."""
+        return self._set_status(shard_id, worker_name, 'failed', error=str(error)[:1000])
+
+    def heartbeat(self, shard_id, worker_name):
+        """ Refreshes the updated_at time of a running shard, as long as the worker still holds it."""
+        connection = self._connect()
+        try:
+            connection.execute("UPDATE shards SET updated_at = ? WHERE shard_id = ? AND worker = ? AND status = 'running'",
+                               (time.time(), shard_id, worker_name))
+        finally:
+            connection.close()
+
+    def release_stale(self):
+        """ Puts running shards that have not had a heartbeat for stale_after seconds back up for claiming."""
+        connection = self._connect()
+        try:
+            released = connection.execute("UPDATE shards SET status = 'failed', error = 'worker stopped responding' "
+                                          "WHERE status = 'running' AND updated_at < ?", (time.time() - self.stale_after,)).rowcount
+            if released:
+                logging.warning(f'released {released} stale shards')
+        finally:
+            connection.close()
+
+    def release_worker(self, worker_name):
+        """
+        Puts the running shards of a worker that has exited back up for claiming.
+
+        Returns:
+            - int: Number of shards released.
+        """
+        connection = self._connect()
+        try:
+            released = connection.execute("UPDATE shards SET status = 'failed', error = 'worker exited', updated_at = ? "
+                                          "WHERE status = 'running' AND worker = ?", (time.time(), worker_name)).rowcount
+            if released:
+                logging.warning(f'released {released} shards held by exited worker {worker_name}')
+            return released
+        finally:
+            connection.close()
+
+    def claimable(self, max_attempts=3):
+        """ Returns the number of pending shards plus failed shards with attempts left."""
+        connection = self._connect()
+        try:
+            return connection.execute("SELECT COUNT(*) FROM shards WHERE status = 'pending' OR (status = 'failed' AND attempts < ?)",
+                                      (max_attempts,)).fetchone()[0]
+        finally:
+            connection.close()
+
+    def loaded_rows(self):
+        """ Returns the number of rows loaded by the finished shards."""
+        connection = self._connect()
+        try:
+            return connection.execute("SELECT COALESCE(SUM(rows), 0) FROM shards WHERE status = 'done'").fetchone()[0]
+        finally:
+            connection.close()
+
+    def progress(self):
+        """ Returns a dictionary of shard counts per status."""
+        connection = self._connect()
+        try:
+            return dict(connection.execute('SELECT status, COUNT(*) FROM shards GROUP BY status').fetchall())
+        finally:
+            connection.close()
+
+
+def plan_order_shards(db_connector, shard_count, key_column=orders_key_column):
+    """
+    Splits the key range of the orders table into equal, half-open ranges.
+
+    Parameters:
+    ----------
+        - db_connector (DatabaseConnector): An instance of the DatabaseConnector class.
+        - shard_count (int): Number of ranges.
+        - key_column (str): Indexed integer column of the orders table.
+
+    Returns:
+        - list: (lower_bound, upper_bound) pairs covering every key.
+    """
+    with db_connector.external_data_engine.connect() as connection:
+        lowest, highest = connection.execute(text(f'SELECT MIN("{key_column}"), MAX("{key_column}") FROM {orders_source_table}')).one()
+
+    if lowest is None:
+        return []
+
+    step = max(1, -(-(highest - lowest + 1) // shard_count))
+    return [(lower_bound, min(lower_bound + step, highest + 1)) for lower_bound in range(lowest, highest + 1, step)]
+
+
+def process_shard(db_connector, data_cleaner, run_id, shard_id, lower_bound, upper_bound, key_column=orders_key_column):
+    """
+    Extracts, cleans and loads one key range of the orders table into its staging table.
+    The rows and a marker in etl_shard_loads are written in one transaction, so a retried shard is never loaded twice:
+    when another worker's marker for the shard is committed first, this transaction is rolled back and the shard counts as already loaded.
+
+    Returns:
+        - int: Number of rows loaded.
+    """
+    with db_connector.local_data_engine.begin() as connection:
+        connection.execute(text(f'CREATE TABLE IF NOT EXISTS {shard_loads_table} '
+                                '(run_id VARCHAR(32) NOT NULL, shard_id INTEGER NOT NULL, rows INTEGER, PRIMARY KEY (run_id, shard_id))'))
+        loaded_rows = connection.execute(text(f'SELECT rows FROM {shard_loads_table} WHERE run_id = :run_id AND shard_id = :shard_id'),
+                                         {'run_id': run_id, 'shard_id': shard_id}).scalar()
+    if loaded_rows is not None:
+        # Loaded by an earlier attempt that did not get to report back
+        return loaded_rows
+
+    df_orders = pd.read_sql(text(f'SELECT * FROM {orders_source_table} WHERE "{key_column}" >= :lower_bound AND "{key_column}" < :upper_bound'),
+                            db_connector.external_data_engine, params={'lower_bound': lower_bound, 'upper_bound': upper_bound})
+    df_orders = data_cleaner.clean_orders_frame(df_orders) if not df_orders.empty else df_orders.iloc[:0, :0]
+    if df_orders is None:
+        raise ValueError(f'cleaning failed for shard {shard_id}')
+
+    try:
+        with db_connector.local_data_engine.begin() as connection:
+            if len(df_orders):
+                df_orders.to_sql(name=f'{orders_destination_table}_staging', con=connection, if_exists='append', index=False, chunksize=10000)
+            connection.execute(text(f'INSERT INTO {shard_loads_table} (run_id, shard_id, rows) VALUES (:run_id, :shard_id, :rows)'),
+                               {'run_id': run_id, 'shard_id': shard_id, 'rows': len(df_orders)})
+    except IntegrityError:
+        # Another worker loaded the shard while this one was processing it, e.g. after a stale release
+        with db_connector.local_data_engine.connect() as connection:
+            loaded_rows = connection.execute(text(f'SELECT rows FROM {shard_loads_table} WHERE run_id = :run_id AND shard_id = :shard_id'),
+                                             {'run_id': run_id, 'shard_id': shard_id}).scalar()
+        if loaded_rows is None:
+            raise
+        logging.warning(f'shard {shard_id} was already loaded by another worker')
+        return loaded_rows
+    return len(df_orders)
+
+
+def send_heartbeats(shard_queue, shard_id, worker_name, stopped):
+    """ Refreshes the claim on a shard every heartbeat_interval seconds until stopped is set."""
+    while not stopped.wait(heartbeat_interval):
+        try:
+            shard_queue.heartbeat(shard_id, worker_name)
+        except Exception as e:
+            logging.error(f'Error in sharded_orders worker {worker_name}, heartbeat for shard {shard_id}: {e}')
+
+
+def run_worker(queue_path=shard_queue_file, worker_name=None, max_attempts=3, use_rule_engine=False):
+    """
+    Claims and processes shards until none are left. Each worker opens its own database connections,
+    and a heartbeat thread keeps its claim on the current shard fresh while it is being processed.
+
+    Parameters:
+    ----------
+        - queue_path (str): Path of the SQLite shard queue.
+        - worker_name (str): Name recorded against claimed shards, defaults to host and process id.
+        - max_attempts (int): Attempts per shard before it is left failed.
+        - use_rule_engine (bool): Clean with the single-pass CleaningRuleEngine, as with main.py --rule-engine.
+    """
+    worker_name = worker_name or f'{socket.gethostname()}-{os.getpid()}'
+    shard_queue = ShardQueue(queue_path)
+
+    try:
+        db_connector = DatabaseConnector(aws_credentials_file, local_credentials_file)
+        data_cleaner = DataCleaning(DataExtractor(db_connector), use_rule_engine)
+        run_id = shard_queue.run_id()
+    except Exception as e:
+        logging.error(f'Error in sharded_orders worker {worker_name}, initialisation: {e}')
+        return
+
+    while True:
+        shard = shard_queue.claim(worker_name, max_attempts)
+        if shard is None:
+            break
+
+        shard_id, lower_bound, upper_bound = shard
+        stopped = threading.Event()
+        heartbeat = threading.Thread(target=send_heartbeats, args=(shard_queue, shard_id, worker_name, stopped), daemon=True)
+        heartbeat.start()
+        try:
+            rows = process_shard(db_connector, data_cleaner, run_id, shard_id, lower_bound, upper_bound)
+            if shard_queue.complete(shard_id, worker_name, rows):
+                logging.info(f'{worker_name} loaded shard {shard_id} [{lower_bound}, {upper_bound}): {rows} rows')
+            else:
+                logging.warning(f'{worker_name} finished shard {shard_id} after it was handed to another worker')
+        except Exception as e:
+            shard_queue.fail(shard_id, worker_name, e)
+            logging.error(f'Error in sharded_orders worker {worker_name}, shard {shard_id}: {e}')
+        finally:
+            stopped.set()
+            heartbeat.join()
+
+
+def run_sharded_orders(db_connector, data_cleaner, shard_count=16, workers=4, queue_path=shard_queue_file, max_attempts=3):
+    """
+    Coordinates a sharded load of the orders table: plans the shards, creates an empty staging table,
+    starts local worker processes and waits until every shard is done or out of attempts.
+    Shards held by a local worker that exits are retried at once by a replacement worker. The staging table is only
+    swapped in for the live table when every shard has loaded, so readers never see a partial orders table.
+
+    Parameters:
+    ----------
+        - db_connector (DatabaseConnector): An instance of the DatabaseConnector class.
+        - data_cleaner (DataCleaning): Instance of DataCleaning class.
+        - shard_count (int): Number of key ranges.
+        - workers (int): Number of local worker processes; workers on other hosts may join through the same queue file.
+        - queue_path (str): Path of the SQLite shard queue.
+        - max_attempts (int): Attempts per shard.
+
+    Returns:
+        - dict: Shard counts per status at the end of the run.
+    """
+    try:
+        shards = plan_order_shards(db_connector, shard_count)
+        if not shards:
+            logging.warning('Error in sharded_orders method run_sharded_orders, orders table is empty')
+            return {}
+
+        # Create the empty staging table once, with the columns of a cleaned sample row; the live table stays untouched
+        start = time.perf_counter()
+        sample = pd.read_sql(text(f'SELECT * FROM {orders_source_table} LIMIT 1'), db_connector.external_data_engine)
+        db_connector.create_staging_table(data_cleaner.clean_orders_frame(sample), orders_destination_table, db_connector.unlogged_staging)
+
+        shard_queue = ShardQueue(queue_path)
+        run_id = shard_queue.create(shards)
+        logging.info(f'orders split into {len(shards)} shards for {workers} workers')
+
+        use_rule_engine = data_cleaner.rule_engine is not None
+        started_workers = []
+
+        def start_worker():
+            worker_name = f'{socket.gethostname()}-{os.getpid()}-worker{len(started_workers)}'
+            process = multiprocessing.Process(target=run_worker, args=(queue_path, worker_name, max_attempts, use_rule_engine))
+            process.start()
+            started_workers.append(worker_name)
+            return worker_name, process
+
+        processes = dict(start_worker() for _ in range(workers))
+        progress = {}
+        # Every crash uses up an attempt of the shard it held, but a worker failing before its first claim would not
+        replacements_left = workers * max_attempts
+
+        while True:
+            # Wake up when a worker exits, or every few seconds to check on progress
+            if processes:
+                multiprocessing.connection.wait([process.sentinel for process in processes.values()], timeout=5)
+            else:
+                time.sleep(5)
+
+            for worker_name, process in list(processes.items()):
+                if not process.is_alive():
+                    process.join()
+                    del processes[worker_name]
+                    # A crashed worker cannot send heartbeats, so its shard is released now rather than after stale_after
+                    shard_queue.release_worker(worker_name)
+
+            shard_queue.release_stale()
+            if shard_queue.progress() != progress:
+                progress = shard_queue.progress()
+                logging.info(f'orders shards: {progress}')
+            claimable = shard_queue.claimable(max_attempts)
+
+            while claimable > len(processes) and len(processes) < workers and replacements_left > 0:
+                worker_name, process = start_worker()
+                processes[worker_name] = process
+                replacements_left -= 1
+
+            # Shards still running without local workers belong to workers on other hosts
+            if not processes and (not claimable or not replacements_left) and not progress.get('running'):
+                break
+
+        if progress.get('done', 0) == len(shards):
+            db_connector.swap_staging_table(orders_destination_table)
+            db_connector.record_load_version(orders_destination_table)
+            # The markers of earlier runs guard staging tables that no longer exist
+            with db_connector.local_data_engine.begin() as connection:
+                connection.execute(text(f'DELETE FROM {shard_loads_table} WHERE run_id <> :run_id'), {'run_id': run_id})
+            db_connector.load_stats[orders_destination_table] = {'rows': shard_queue.loaded_rows(), 'seconds': time.perf_counter() - start}
+        else:
+            logging.error(f'Error in sharded_orders method run_sharded_orders, unfinished shards: {progress}; '
+                          f'{orders_destination_table} left unchanged')
+        return progress
+
+    except Exception as e:
+        logging.error(f'Error in sharded_orders method run_sharded_orders: {e}')
+        return {}
+
+
+# Main Execution
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Loads the orders table in key-range shards.')
+    parser.add_argument('--worker', action='store_true', help='Only join an existing run as a worker.')
+    parser.add_argument('--queue', default=shard_queue_file, help='Path of the SQLite shard queue.')
+    parser.add_argument('--shards', type=int, default=16, help='Number of key ranges.')
+    parser.add_argument('--workers', type=int, default=4, help='Number of local worker processes.')
+    parser.add_argument('--rule-engine', action='store_true', help='Clean with the single-pass cleaning rule engine.')
+    arguments = parser.parse_args()
+
+    if arguments.worker:
+        run_worker(arguments.queue, use_rule_engine=arguments.rule_engine)
+    else:
+        db_connector = DatabaseConnector(aws_credentials_file, local_credentials_file)
+        data_cleaner = DataCleaning(DataExtractor(db_connector), arguments.rule_engine)
+        print(run_sharded_orders(db_connector, data_cleaner, arguments.shards, arguments.workers, arguments.queue))
+
+# The script ends here
@@ -0,0 +1,89 @@
+"""
+File: test_analytics_extract.py
+Purpose: Checking the business queries give the same answers with DuckDB and with pandas.
+Author: Zulfia
+Date: January 2024
+
+# Publishes from a SQLite file, so no PostgreSQL server or credentials are needed: python -m pytest data_management_etl/tests
+"""
+
+# External Libraries
+import json
+import os
+import sys
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+# Internal Libraries and Credentials
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from analytics_extract import SALES_QUERIES, SalesExtract, publish_sales_extract
+from database_utils import DatabaseConnector
+
+pytest.importorskip('pyarrow')
+
+
+@pytest.fixture
+def extract_directory(tmp_path):
+    """ Publishes the extract of a small star schema, with two months tied on total sales."""
+    db_connector = DatabaseConnector(str(tmp_path / 'missing_db_creds.yaml'), str(tmp_path / 'missing_local_creds.yaml'))
+    db_connector.local_data_engine = create_engine(f"sqlite:///{tmp_path / 'local.db'}")
+
+    tables = {
+        'dim_products': pd.DataFrame({'product_code': ['P1', 'P2', 'P3'], 'product_price': ['£2.50', '£10.00', '£4.00'],
+                                      'category': ['toys', 'diy', 'pets']}),
+        'dim_store_details': pd.DataFrame({'store_code': ['S1', 'S2', 'S3', 'WEB'], 'store_type': ['Local', 'Super Store', 'Local', 'Web Portal'],
+                                           'country_code': ['GB', 'DE', 'DE', 'GB'], 'locality': ['Leeds', 'Berlin', 'Bonn', None],
+                                           'staff_numbers': ['10', '45', '12', '300']}),
+        'dim_date_times': pd.DataFrame({'date_uuid': [f'd{number}' for number in range(6)],
+                                        'year': ['2021', '2021', '2020', '2022', '2020', '2021'], 'month': ['5', '3', '11', '5', '3', '12'],
+                                        'day': ['1', '2', '3', '4', '5', '6'],
+                                        'timestamp': ['10:00:00', '11:30:00', '09:15:00', '23:59:59', '00:00:01', '12:00:00'],
+                                        'time_period': ['Morning', 'Midday', 'Morning', 'Late_Hours', 'Late_Hours', 'Midday']}),
+        # d0 and d1 both total 20.00, so task_6 has to break the tie on year and month
+        'orders_table': pd.DataFrame({'date_uuid': ['d1', 'd0', 'd2', 'd3', 'd4', 'd5', 'd0'],
+                                      'user_uuid': ['u1', 'u2', 'u3', 'u1', 'u2', 'u3', 'u4'],
+                                      'store_code': ['S1', 'S2', 'S3', 'WEB', 'S2', 'WEB', 'S1'],
+                                      'product_code': ['P2', 'P1', 'P3', 'P2', 'P3', 'P1', 'P1'],
+                                      'product_quantity': [2, 4, 3, 1, 7, 5, 4]}),
+    }
+    for table_name, df in tables.items():
+        df.to_sql(table_name, db_connector.local_data_engine, index=False)
+        db_connector.record_load_version(table_name)
+
+    directory = str(tmp_path / 'analytics_extract')
+    assert publish_sales_extract(db_connector, directory) is not None
+    return directory
+
+
+def test_publish_writes_the_manifest_last(extract_directory):
+    manifest_time = os.stat(os.path.join(extract_directory, 'manifest.json')).st_mtime_ns
+    with open(os.path.join(extract_directory, 'manifest.json')) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    assert sorted(os.listdir(extract_directory)) == ['manifest.json', 'sales.parquet', 'stores.parquet']
+    assert all(os.stat(os.path.join(extract_directory, file_name)).st_mtime_ns <= manifest_time for file_name in ('sales.parquet', 'stores.parquet'))
+    assert manifest['rows'] == {'sales': 7, 'stores': 4}
+    assert manifest['load_versions']['orders_table'] == 1
+
+
+def with_none_for_missing_text(df):
+    """ DuckDB returns missing text as None and pandas as NaN; both mean NULL."""
+    text_columns = df.select_dtypes(object).columns
+    return df.assign(**{column: df[column].where(df[column].notna(), None) for column in text_columns})
+
+
+@pytest.mark.parametrize('name', list(SALES_QUERIES))
+def test_duckdb_and_pandas_give_the_same_answer(extract_directory, name):
+    pytest.importorskip('duckdb')
+    with_duckdb = SalesExtract(extract_directory, 'duckdb').run_query(name)
+    with_pandas = SalesExtract(extract_directory, 'pandas').run_query(name)
+
+    pd.testing.assert_frame_equal(with_none_for_missing_text(with_duckdb), with_none_for_missing_text(with_pandas), check_dtype=False)
+
+
+def test_task_6_breaks_ties_on_year_and_month(extract_directory):
+    result = SalesExtract(extract_directory, 'pandas').run_query('task_6')
+
+    tied = result[result['total_sales'] == 20.0]
+    assert tied[['year', 'month']].values.tolist() == [[2021, 3], [2021, 5]]
@@ -0,0 +1,41 @@
+"""
+File: test_cleaning_rules.py
+Purpose: Checking the declarative cleaning rules give the same tables as the step-by-step cleaning.
+Author: Zulfia
+Date: January 2024
+
+# The raw tables come from the load-test harness generator, junk rows included, so no csv_files/ are needed.
+"""
+
+# External Libraries
+import os
+import sys
+import pytest
+
+# Internal Libraries and Credentials
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cleaning_rules import CleaningRuleEngine
+from data_cleaning import DataCleaning
+from load_test_harness import generate_source_data
+
+
+@pytest.fixture(scope='module')
+def raw_tables():
+    """ Small synthetic raw tables shaped like the real sources."""
+    return generate_source_data(scale=0.02, seed=1)
+
+
+@pytest.mark.parametrize('table_kind, legacy_method', [
+    ('users', 'clean_users_frame'),
+    ('cards', 'clean_cards_frame'),
+    ('stores', 'clean_store_data'),
+    ('products', 'clean_product_data'),
+    ('orders', 'clean_orders_frame'),
+    ('dates', 'clean_dates'),
+])
+def test_rule_engine_matches_step_by_step_cleaning(raw_tables, table_kind, legacy_method):
+    legacy_function = getattr(DataCleaning(None), legacy_method)
+    report = CleaningRuleEngine().compare(table_kind, raw_tables[table_kind].copy(), legacy_function)
+
+    assert report['identical']
+    assert report['engine_column_copies'] <= report['legacy_column_copies_estimate']
@@ -0,0 +1,55 @@
+"""
+File: test_data_cleaning.py
+Purpose: Checking orphan orders are told apart by every key column, whatever the dtype of the keys.
+Author: Zulfia
+Date: January 2024
+
+# Needs no database or source files: python -m pytest data_management_etl/tests
+"""
+
+# External Libraries
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# Internal Libraries and Credentials
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_cleaning import DataCleaning
+
+key_columns = ['user_uuid', 'card_number', 'store_code', 'product_code', 'date_uuid']
+
+
+def dimension_frames():
+    """ One dimension frame per key column; card numbers are read from the PDF as floats."""
+    return {
+        'user_uuid': pd.DataFrame({'user_uuid': ['u1', 'u2']}),
+        'card_number': pd.DataFrame({'card_number': [4111111111111.0, 30012345678901.0, np.nan]}),
+        'store_code': pd.DataFrame({'store_code': ['S1', 'WEB']}),
+        'product_code': pd.DataFrame({'product_code': ['P1', 'P2']}),
+        'date_uuid': pd.DataFrame({'date_uuid': ['d1', 'd2']}),
+    }
+
+
+def test_split_orphan_orders_finds_one_orphan_per_key_column():
+    valid = {'user_uuid': 'u1', 'card_number': 4111111111111, 'store_code': 'S1', 'product_code': 'P1', 'date_uuid': 'd1'}
+    orphan_values = {'user_uuid': 'u9', 'card_number': 5555, 'store_code': 'S9', 'product_code': 'P9', 'date_uuid': 'd9'}
+    rows = [valid, dict(valid, card_number=30012345678901)] + [dict(valid, **{key_column: orphan_values[key_column]}) for key_column in key_columns]
+    df_orders = pd.DataFrame(rows)
+
+    df_kept, df_orphans = DataCleaning(None).split_orphan_orders(df_orders, dimension_frames())
+
+    assert list(df_kept.index) == [0, 1]
+    assert list(df_orphans['orphan_keys']) == key_columns
+    assert list(df_orphans.index) == [2, 3, 4, 5, 6]
+
+
+def test_split_orphan_orders_compares_numeric_keys_across_dtypes():
+    # Integer, float and text card numbers, next to a missing one that must not match the missing dimension key
+    df_orders = pd.DataFrame({'card_number': pd.Series([4111111111111, 4111111111111.0, '30012345678901', np.nan, '4111111111111.0'], dtype=object)})
+
+    df_kept, df_orphans = DataCleaning(None).split_orphan_orders(df_orders, {'card_number': dimension_frames()['card_number']})
+
+    assert list(df_kept.index) == [0, 1, 2]
+    assert list(df_orphans.index) == [3, 4]
+    assert list(df_orphans['orphan_keys']) == ['card_number', 'card_number']
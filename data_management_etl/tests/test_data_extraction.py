@@ -0,0 +1,163 @@
+"""
+File: test_data_extraction.py
+Purpose: Checking the streaming JSON parser reads both layouts of the date details feed.
+Author: Zulfia
+Date: January 2024
+
+# The download is replaced by an in-memory response, so no network access is needed: python -m pytest data_management_etl/tests
+"""
+
+# External Libraries
+import io
+import json
+import os
+import sys
+import pandas as pd
+import pytest
+
+# Internal Libraries and Credentials
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data_extraction
+from data_extraction import DataExtractor
+from database_utils import DatabaseConnector
+
+pytest.importorskip('ijson')
+
+stores = [{'store_code': f'ST-{number}', 'staff_numbers': str(number)} for number in range(5)]
+
+date_details = pd.DataFrame({
+    'timestamp': ['22:00:06', '22:44:06', '10:03:59', '07:14:34', '21:59:17'],
+    'month': ['9', '2', '4', '12', '1'],
+    'year': ['2012', '1997', '1994', '2005', '2016'],
+    'day': [19, 10, 17, 1, 4],
+})
+
+
+class FakeResponse:
+    """ Stands in for a streamed requests response serving a fixed body."""
+
+    def __init__(self, body, status_code=200):
+        self.raw = io.BytesIO(body)
+        self.status_code = status_code
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class StoreResponse:
+    """ Stands in for a store details API response."""
+
+    def __init__(self, status_code, store=None):
+        self.status_code = status_code
+        self.store = store
+
+    def json(self):
+        return self.store
+
+
+@pytest.fixture
+def data_extractor(monkeypatch, tmp_path):
+    """ A DataExtractor writing its CSV files under tmp_path."""
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('csv_files')
+    connector = DatabaseConnector(str(tmp_path / 'missing_db_creds.yaml'), str(tmp_path / 'missing_local_creds.yaml'))
+    data_extractor = DataExtractor(connector)
+    data_extractor.api_config = {'headers': {'x-api-key': 'test'}}
+    return data_extractor
+
+
+@pytest.fixture
+def serve(monkeypatch, data_extractor):
+    """ Serves a body to requests.get and returns the DataExtractor reading it."""
+    def serve_body(body, status_code=200):
+        monkeypatch.setattr(data_extraction.requests, 'get', lambda url, **kwargs: FakeResponse(body, status_code))
+        return data_extractor
+    
+    return serve_body
+
+
+def column_layout():
+    """ date_details.json as published: {column: {row_key: value}}."""
+    return date_details.to_json(orient='columns').encode()
+
+
+def record_layout():
+    """ The same rows as a list of row objects."""
+    return date_details.to_json(orient='records').encode()
+
+
+@pytest.mark.parametrize('layout', [column_layout, record_layout])
+def test_stream_reads_the_whole_file(serve, layout):
+    df = serve(layout()).stream_json_from_url('http://feed/date_details.json')
+
+    pd.testing.assert_frame_equal(df.reset_index(drop=True), date_details)
+    assert os.path.exists('csv_files/date_times_table.csv')
+
+
+@pytest.mark.parametrize('layout', [column_layout, record_layout])
+def test_stream_hands_out_chunks_of_rows(serve, layout):
+    chunks = list(serve(layout()).stream_json_from_url('http://feed/date_details.json', chunk_rows=2))
+
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    pd.testing.assert_frame_equal(pd.concat(chunks).reset_index(drop=True), date_details)
+
+
+def test_stream_fills_columns_missing_from_some_records(serve):
+    body = json.dumps([{'day': 1}, {'day': 2, 'month': '5'}, {'month': '6'}]).encode()
+    df = serve(body).stream_json_from_url('http://feed/date_details.json')
+
+    pd.testing.assert_frame_equal(df, pd.DataFrame({'day': [1, 2, None], 'month': [None, '5', '6']}))
+
+
+@pytest.mark.parametrize('layout', [column_layout, record_layout])
+def test_stream_raises_a_truncated_file_in_chunked_mode(serve, layout):
+    body = layout()
+    chunks = serve(body[:len(body) // 2]).stream_json_from_url('http://feed/date_details.json', chunk_rows=2)
+
+    with pytest.raises(Exception):
+        list(chunks)
+
+
+@pytest.mark.parametrize('body', [b'', b'"not a table"', b'[{"day": 1}, {"day": ]'])
+def test_stream_raises_a_malformed_file_in_chunked_mode(serve, body):
+    chunks = serve(body).stream_json_from_url('http://feed/date_details.json', chunk_rows=2)
+
+    with pytest.raises(Exception):
+        list(chunks)
+
+
+def test_stream_returns_none_for_a_malformed_file_read_whole(serve):
+    assert serve(b'{"day": {"0": 1').stream_json_from_url('http://feed/date_details.json') is None
+
+
+def test_stream_raises_a_failed_download_in_chunked_mode(serve):
+    chunks = serve(b'', status_code=403).stream_json_from_url('http://feed/date_details.json', chunk_rows=2)
+
+    with pytest.raises(ValueError, match='status code 403'):
+        list(chunks)
+
+
+@pytest.mark.parametrize('failing_stores', [set(), {1, 4}])
+def test_retrieve_stores_data_reads_every_store_in_one_frame(data_extractor, monkeypatch, failing_stores):
+    def get(url, headers):
+        store_number = int(url.rsplit('/', 1)[-1])
+        return StoreResponse(500) if store_number in failing_stores else StoreResponse(200, stores[store_number])
+    monkeypatch.setattr(data_extraction.requests, 'get', get)
+
+    df = data_extractor.retrieve_stores_data('http://api/store_details/', len(stores))
+
+    expected = pd.DataFrame([store for number, store in enumerate(stores) if number not in failing_stores])
+    pd.testing.assert_frame_equal(df, expected)
+    pd.testing.assert_frame_equal(pd.read_csv('csv_files/stores_table.csv', dtype=str), expected)
+
+
+def test_iter_stores_data_hands_out_batches_of_stores(data_extractor, monkeypatch):
+    monkeypatch.setattr(data_extraction.requests, 'get', lambda url, headers: StoreResponse(200, stores[int(url.rsplit('/', 1)[-1])]))
+
+    batches = list(data_extractor.iter_stores_data('http://api/store_details/', len(stores), batch_size=2))
+
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    pd.testing.assert_frame_equal(pd.concat(batches, ignore_index=True), pd.DataFrame(stores))
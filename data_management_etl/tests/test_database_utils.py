@@ -0,0 +1,131 @@
+"""
+File: test_database_utils.py
+Purpose: Checking the load modes of the DatabaseConnector keep the live tables whole.
+Author: Zulfia
+Date: January 2024
+
+# Runs against a SQLite file, so no PostgreSQL server or credentials are needed: python -m pytest data_management_etl/tests
+"""
+
+# External Libraries
+import os
+import sys
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, inspect, text
+
+# Internal Libraries and Credentials
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from database_utils import DatabaseConnector
+
+
+@pytest.fixture
+def db_connector(tmp_path):
+    """ A DatabaseConnector uploading to a fresh SQLite file instead of the local PostgreSQL database."""
+    connector = DatabaseConnector(str(tmp_path / 'missing_db_creds.yaml'), str(tmp_path / 'missing_local_creds.yaml'))
+    connector.local_data_engine = create_engine(f"sqlite:///{tmp_path / 'local.db'}")
+    return connector
+
+
+def products(*weights):
+    """ Builds a small dim_products frame, one product per weight."""
+    return pd.DataFrame({'product_code': [f'P{number}' for number in range(len(weights))], 'weight': list(weights)})
+
+
+@pytest.mark.parametrize('other_load_mode', ['replace', 'swap'])
+def test_hash_diff_reloads_a_table_replaced_by_another_load_mode(db_connector, other_load_mode):
+    products_a = products(1.0, 2.0, 3.0)
+    products_b = products(1.0, 5.0)
+
+    db_connector.upload_to_db(products_a, 'dim_products', load_mode='hash_diff')
+    db_connector.upload_to_db(products_b, 'dim_products', load_mode=other_load_mode)
+    db_connector.upload_to_db(products_a, 'dim_products', load_mode='hash_diff')
+
+    loaded = pd.read_sql('SELECT * FROM dim_products ORDER BY product_code', db_connector.local_data_engine)
+    pd.testing.assert_frame_equal(loaded, products_a)
+
+
+def test_hash_diff_writes_only_the_changed_rows(db_connector):
+    db_connector.upload_to_db(products(1.0, 2.0, 3.0), 'dim_products', load_mode='hash_diff')
+    db_connector.upload_to_db(products(1.0, 4.0), 'dim_products', load_mode='hash_diff')
+
+    loaded = pd.read_sql('SELECT * FROM dim_products ORDER BY product_code', db_connector.local_data_engine)
+    pd.testing.assert_frame_equal(loaded, products(1.0, 4.0))
+    assert db_connector.read_load_versions() == {'dim_products': 2}
+
+
+def test_swap_keeps_the_rows_of_the_staging_table(db_connector):
+    db_connector.upload_to_db(products(1.0, 2.0, 3.0), 'dim_products', load_mode='swap')
+    db_connector.upload_to_db(products(4.0, 5.0), 'dim_products', load_mode='swap')
+
+    loaded = pd.read_sql('SELECT * FROM dim_products ORDER BY product_code', db_connector.local_data_engine)
+    pd.testing.assert_frame_equal(loaded, products(4.0, 5.0))
+    assert not inspect(db_connector.local_data_engine).has_table('dim_products_staging')
+    assert not inspect(db_connector.local_data_engine).has_table('dim_products_retired')
+
+
+def test_swap_is_refused_while_a_view_depends_on_the_live_table(db_connector):
+    db_connector.upload_to_db(products(1.0, 2.0, 3.0), 'dim_products', load_mode='swap')
+    with db_connector.local_data_engine.begin() as connection:
+        connection.execute(text('CREATE VIEW heavy_products AS SELECT * FROM dim_products WHERE weight > 1'))
+
+    db_connector.create_staging_table(products(4.0), 'dim_products')
+    db_connector.append_to_staging(products(4.0), 'dim_products')
+    with pytest.raises(ValueError, match='view heavy_products'):
+        db_connector.swap_staging_table('dim_products')
+
+    loaded = pd.read_sql('SELECT * FROM dim_products ORDER BY product_code', db_connector.local_data_engine)
+    pd.testing.assert_frame_equal(loaded, products(1.0, 2.0, 3.0))
+
+
+def test_hash_diff_reloads_a_table_whose_column_types_changed(db_connector):
+    db_connector.upload_to_db(products(1.0, 2.0), 'dim_products', load_mode='hash_diff')
+
+    # Stand-in for the star schema script, which changes the column types and values in place
+    with db_connector.local_data_engine.begin() as connection:
+        connection.execute(text('ALTER TABLE dim_products RENAME TO dim_products_old'))
+        connection.execute(text('CREATE TABLE dim_products (product_code VARCHAR(2), weight NUMERIC)'))
+        connection.execute(text("INSERT INTO dim_products SELECT product_code, 0 FROM dim_products_old"))
+        connection.execute(text('DROP TABLE dim_products_old'))
+
+    db_connector.upload_to_db(products(1.0, 2.0), 'dim_products', load_mode='hash_diff')
+
+    loaded = pd.read_sql('SELECT * FROM dim_products ORDER BY product_code', db_connector.local_data_engine)
+    pd.testing.assert_frame_equal(loaded, products(1.0, 2.0))
+
+
+def orders(*months):
+    """ Builds a small orders_table frame with its order_month partition column, one order per month ('' for unknown)."""
+    return pd.DataFrame({'product_quantity': range(1, len(months) + 1),
+                         'order_month': pd.to_datetime([month or None for month in months]).astype('datetime64[ns]')})
+
+
+def test_plan_partitions_groups_months_and_finds_changes():
+    df = orders('2024-01-01', '2024-02-01', '2024-01-01', '')
+    partitions, content_hashes, _, _ = DatabaseConnector.plan_partitions(df, 'orders_table', 'order_month', set(), {})
+
+    assert list(partitions) == ['orders_table_p202401', 'orders_table_p202402', 'orders_table_pdefault']
+    assert partitions['orders_table_p202401'][0] == ('2024-01-01', '2024-02-01')
+    assert partitions['orders_table_pdefault'][0] is None
+    assert list(partitions['orders_table_p202401'][1]['product_quantity']) == [1, 3]
+
+    # January unchanged but stored in another row order, February changed, December gone, DEFAULT new
+    stored_hashes = dict(content_hashes, orders_table_p202402=content_hashes['orders_table_p202402'] + 1)
+    existing_partitions = {'orders_table_p202312', 'orders_table_p202401', 'orders_table_p202402'}
+    reordered = df.iloc[[2, 1, 0, 3]]
+    _, reordered_hashes, changed, dropped = DatabaseConnector.plan_partitions(reordered, 'orders_table', 'order_month',
+                                                                             existing_partitions, stored_hashes)
+
+    assert reordered_hashes == content_hashes
+    assert changed == ['orders_table_p202402', 'orders_table_pdefault']
+    assert dropped == ['orders_table_p202312']
+
+
+def test_plan_partitions_replaces_a_month_whose_rows_changed():
+    _, content_hashes, _, _ = DatabaseConnector.plan_partitions(orders('2024-01-01', '2024-01-01'), 'orders_table', 'order_month', set(), {})
+    changed_orders = orders('2024-01-01', '2024-01-01').assign(product_quantity=[1, 5])
+
+    _, _, changed, dropped = DatabaseConnector.plan_partitions(changed_orders, 'orders_table', 'order_month', {'orders_table_p202401'}, content_hashes)
+
+    assert changed == ['orders_table_p202401']
+    assert dropped == []
@@ -0,0 +1,74 @@
+"""
+File: test_pipelining.py
+Purpose: Checking a failed pipeline step never swaps a partial staging table in.
+Author: Zulfia
+Date: January 2024
+
+# Runs against a SQLite file, so no PostgreSQL server or credentials are needed: python -m pytest data_management_etl/tests
+"""
+
+# External Libraries
+import os
+import sys
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, inspect
+
+# Internal Libraries and Credentials
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from database_utils import DatabaseConnector
+from pipelining import BatchPipeline, run_pipelined_stage
+
+
+def batches(count, rows=3):
+    """ Yields count small batches with consecutive codes."""
+    for number in range(count):
+        yield pd.DataFrame({'product_code': [f'P{number * rows + row}' for row in range(rows)], 'weight': [1.0] * rows})
+
+
+def failing_on(batch_number):
+    """ Builds a clean_batch that raises on the given batch, counting from 1."""
+    cleaned = []
+
+    def clean_batch(df):
+        cleaned.append(df)
+        if len(cleaned) == batch_number:
+            raise ValueError('bad batch')
+        return df
+    
+    return clean_batch
+
+
+@pytest.mark.parametrize('failing_batch', [1, 2, 5])
+def test_failed_cleaning_never_finishes_the_load(failing_batch):
+    loaded, finished = [], []
+    pipeline = BatchPipeline('test', queue_size=1)
+
+    succeeded = pipeline.run(batches(5), failing_on(failing_batch), loaded.append, lambda: finished.append(True))
+
+    assert not succeeded
+    assert not finished
+    assert len(loaded) < failing_batch
+    assert [str(error) for error in pipeline.errors] == ['bad batch']
+
+
+def test_completed_run_finishes_the_load_once():
+    loaded, finished = [], []
+
+    assert BatchPipeline('test', queue_size=1).run(batches(5), lambda df: df, loaded.append, lambda: finished.append(True))
+    assert len(loaded) == 5
+    assert finished == [True]
+
+
+def test_failed_stage_leaves_the_live_table_unchanged(tmp_path):
+    db_connector = DatabaseConnector(str(tmp_path / 'missing_db_creds.yaml'), str(tmp_path / 'missing_local_creds.yaml'))
+    db_connector.local_data_engine = create_engine(f"sqlite:///{tmp_path / 'local.db'}")
+    live = next(batches(1))
+    db_connector.upload_to_db(live, 'dim_products', load_mode='swap')
+
+    pipeline = run_pipelined_stage(db_connector, 'dim_products', batches(5), failing_on(3), queue_size=1)
+
+    assert pipeline.errors
+    pd.testing.assert_frame_equal(pd.read_sql('SELECT * FROM dim_products', db_connector.local_data_engine), live)
+    assert db_connector.read_load_versions() == {'dim_products': 1}
+    assert 'dim_products_retired' not in inspect(db_connector.local_data_engine).get_table_names()
@@ -0,0 +1,120 @@
+"""
+File: test_sharded_orders.py
+Purpose: Checking the shard queue hands every key range to exactly one worker at a time.
+Author: Zulfia
+Date: January 2024
+
+# Runs against SQLite files, so no PostgreSQL server or credentials are needed: python -m pytest data_management_etl/tests
+"""
+
+# External Libraries
+import os
+import sys
+import time
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+# Internal Libraries and Credentials
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sharded_orders
+from database_utils import DatabaseConnector
+from sharded_orders import ShardQueue, process_shard
+
+
+@pytest.fixture
+def shard_queue(tmp_path):
+    """ A queue of three shards in a fresh SQLite file."""
+    queue = ShardQueue(str(tmp_path / 'orders_shards.db'), stale_after=60)
+    queue.create([(0, 10), (10, 20), (20, 30)])
+    return queue
+
+
+def test_claim_hands_each_shard_out_once(shard_queue):
+    claimed = [shard_queue.claim(f'worker{number}') for number in range(4)]
+
+    assert claimed == [(0, 0, 10), (1, 10, 20), (2, 20, 30), None]
+    assert shard_queue.progress() == {'running': 3}
+
+
+def test_failed_shard_is_claimed_again_until_out_of_attempts(shard_queue):
+    shard_queue.create([(0, 10)])
+    for _ in range(2):
+        assert shard_queue.claim('worker0', max_attempts=2) == (0, 0, 10)
+        assert shard_queue.fail(0, 'worker0', 'source unavailable')
+
+    assert shard_queue.claim('worker0', max_attempts=2) is None
+    assert shard_queue.claimable(max_attempts=2) == 0
+    assert shard_queue.progress() == {'failed': 1}
+
+
+def test_heartbeat_keeps_a_shard_from_being_released(shard_queue):
+    shard_queue.stale_after = 0.5
+    shard_queue.claim('worker0')
+    shard_queue.claim('worker1')
+
+    time.sleep(0.6)
+    shard_queue.heartbeat(0, 'worker0')
+    shard_queue.release_stale()
+
+    assert shard_queue.progress() == {'running': 1, 'failed': 1, 'pending': 1}
+    assert shard_queue.claim('worker2') == (2, 20, 30)
+    assert shard_queue.claim('worker2') == (1, 10, 20)
+
+
+def test_released_shard_keeps_the_outcome_of_its_new_worker(shard_queue):
+    shard_queue.create([(0, 10)])
+    shard_queue.stale_after = 0
+    shard_queue.claim('worker0')
+    time.sleep(0.01)
+    shard_queue.release_stale()
+    shard_queue.stale_after = 60
+    shard_queue.claim('worker1')
+
+    # The first worker comes back late: neither its failure nor its completion may overwrite the new claim
+    assert not shard_queue.fail(0, 'worker0', 'timed out')
+    assert not shard_queue.complete(0, 'worker0', 5)
+    shard_queue.heartbeat(0, 'worker0')
+    assert shard_queue.complete(0, 'worker1', 7)
+
+    assert shard_queue.progress() == {'done': 1}
+    assert shard_queue.loaded_rows() == 7
+
+
+def test_release_worker_only_releases_its_own_shards(shard_queue):
+    shard_queue.claim('worker0')
+    shard_queue.claim('worker1')
+
+    assert shard_queue.release_worker('worker0') == 1
+    assert shard_queue.progress() == {'failed': 1, 'running': 1, 'pending': 1}
+    assert shard_queue.complete(1, 'worker1', 4)
+
+
+class MarkingCleaner:
+    """ Cleans nothing, but commits another worker's marker for the shard first, as if that worker had won the race."""
+
+    def __init__(self, db_connector, run_id, shard_id):
+        self.db_connector = db_connector
+        self.run_id = run_id
+        self.shard_id = shard_id
+
+    def clean_orders_frame(self, df):
+        with self.db_connector.local_data_engine.begin() as connection:
+            connection.execute(text(f'INSERT INTO {sharded_orders.shard_loads_table} (run_id, shard_id, rows) VALUES (:run_id, :shard_id, 2)'),
+                               {'run_id': self.run_id, 'shard_id': self.shard_id})
+        return df
+
+
+def test_shard_loaded_by_another_worker_meanwhile_counts_as_loaded(tmp_path):
+    db_connector = DatabaseConnector(str(tmp_path / 'missing_db_creds.yaml'), str(tmp_path / 'missing_local_creds.yaml'))
+    db_connector.external_data_engine = create_engine(f"sqlite:///{tmp_path / 'source.db'}")
+    db_connector.local_data_engine = create_engine(f"sqlite:///{tmp_path / 'local.db'}")
+    orders = pd.DataFrame({'index': [0, 1, 2], 'product_quantity': [1, 2, 3]})
+    orders.to_sql('orders_table', db_connector.external_data_engine, index=False)
+    db_connector.create_staging_table(orders, 'orders_table')
+
+    rows = process_shard(db_connector, MarkingCleaner(db_connector, 'run1', 0), 'run1', 0, 0, 2)
+
+    assert rows == 2
+    staged = pd.read_sql('SELECT COUNT(*) AS n FROM orders_table_staging', db_connector.local_data_engine)
+    assert staged['n'][0] == 0